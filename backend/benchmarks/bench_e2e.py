@@ -0,0 +1,402 @@
+"""
+End-to-end benchmark of the upload -> process -> insights flow.
+
+Generates synthetic CSV, XLSX, TXT and DOCX files of the requested sizes and
+drives them through the real ASGI app (in process, over httpx), with the model
+replaced by a stub that answers after a configurable latency and jitter. Each
+stage reports p50/p95/p99 latency, throughput and the peak RSS seen while it
+ran, and the results can be written to JSON and compared with an earlier run:
+
+    cd backend/src
+    python ../benchmarks/bench_e2e.py --rows 1000,100000 --output before.json
+    # ... change things ...
+    python ../benchmarks/bench_e2e.py --rows 1000,100000 --compare before.json
+
+The app runs against a scratch database and media directory, so benchmarks
+never touch real uploads.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+STAGES = ("upload", "process", "insights")
+FORMATS = ("csv", "xlsx", "txt", "docx")
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "txt": "text/plain",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+}
+
+
+# -- synthetic files -------------------------------------------------------
+
+
+def generate_file(fmt: str, rows: int, seed: int, directory: Path) -> Path:
+    """
+    Write a synthetic file of `rows` rows (lines, for text documents).
+
+    The seed goes into the content, so every file is unique and none of them
+    is deduplicated by the content-addressed upload.
+    """
+    rng = random.Random(seed)
+    path = directory / f"bench_{seed}_{rows}.{fmt}"
+    if fmt in ("csv", "xlsx"):
+        frame = _table(rows, seed)
+        if fmt == "csv":
+            frame.to_csv(path, index=False)
+        else:
+            frame.to_excel(path, index=False)
+    elif fmt == "txt":
+        with open(path, "w") as f:
+            f.writelines(_log_line(i, rng, seed) + "\n" for i in range(rows))
+    elif fmt == "docx":
+        import docx
+
+        document = docx.Document()
+        for i in range(rows):
+            document.add_paragraph(_log_line(i, rng, seed))
+        document.save(path)
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+    return path
+
+
+def _table(rows: int, seed: int):
+    import numpy as np
+    import pandas as pd
+
+    np_rng = np.random.default_rng(seed)
+    units = np_rng.integers(1, 500, rows)
+    price = np_rng.gamma(2.0, 20.0, rows).round(2)
+    return pd.DataFrame(
+        {
+            "order_id": np.arange(rows) + seed * 10_000_000,
+            "date": pd.Timestamp("2024-01-01")
+            + pd.to_timedelta(np_rng.integers(0, 365, rows), unit="D"),
+            "region": np_rng.choice(["north", "south", "east", "west"], rows),
+            "product": np_rng.choice([f"sku-{i}" for i in range(50)], rows),
+            "units": units,
+            "price": price,
+            "revenue": (units * price).round(2),
+        }
+    )
+
+
+def _log_line(i: int, rng: random.Random, seed: int) -> str:
+    level = rng.choice(["INFO", "INFO", "INFO", "WARN", "ERROR"])
+    return (
+        f"2024-01-01T00:{i // 60 % 60:02d}:{i % 60:02d} {level} run={seed} "
+        f"request {i} served in {rng.randint(1, 900)}ms by worker {rng.randint(1, 16)}"
+    )
+
+
+# -- fake model ------------------------------------------------------------
+
+
+def stub_model(latency: float, jitter: float) -> None:
+    """
+    Replace the model calls made by `services` with stubs that wait
+    `latency` seconds, plus up to `jitter` seconds, then answer.
+    """
+    import services
+
+    def answer(count: int) -> list:
+        return [
+            {
+                "title": f"Benchmark insight {i + 1}",
+                "description": "Synthetic insight returned by the benchmark stub.",
+                "confidence_score": 0.8,
+                "reference_rows": [i],
+            }
+            for i in range(count)
+        ]
+
+    def delay() -> float:
+        return latency + random.uniform(0, jitter)
+
+    async def agenerate(prompt, count: int = 3):
+        await asyncio.sleep(delay())
+        return answer(count)
+
+    def generate(prompt):
+        time.sleep(delay())
+        return answer(3)
+
+    services.agenerate_ai_insights = agenerate
+    services.areduce_ai_insights = agenerate
+    services.generate_ai_insights = generate
+
+
+# -- measurements ----------------------------------------------------------
+
+
+class RSSSampler:
+    """Samples the resident set size in the background, tracking its peak."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        # no procfs (e.g. macOS): fall back to the lifetime peak
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: List[float], errors: int, wall: float, rss: int) -> dict:
+    summary = {"count": len(latencies), "errors": errors}
+    if latencies:
+        summary.update(
+            p50_ms=percentile(latencies, 50) * 1000,
+            p95_ms=percentile(latencies, 95) * 1000,
+            p99_ms=percentile(latencies, 99) * 1000,
+            mean_ms=sum(latencies) / len(latencies) * 1000,
+        )
+    summary["throughput_rps"] = len(latencies) / wall if wall else 0.0
+    summary["peak_rss_mb"] = rss / 2**20
+    return summary
+
+
+# -- stages ----------------------------------------------------------------
+
+
+async def run_stage(make_call, count: int, concurrency: int) -> dict:
+    """Run `count` calls of `make_call(i)`, at most `concurrency` at once."""
+    slots = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(i: int) -> None:
+        nonlocal errors
+        async with slots:
+            start = time.perf_counter()
+            try:
+                await make_call(i)
+            except Exception as e:
+                errors += 1
+                print(f"  call {i} failed: {e}", file=sys.stderr)
+                return
+            latencies.append(time.perf_counter() - start)
+
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(count)))
+        wall = time.perf_counter() - start
+    return summarize(latencies, errors, wall, rss.peak)
+
+
+async def bench_case(client, fmt: str, rows: int, args, workdir: Path) -> List[dict]:
+    seeds = [random.randrange(1, 10**6) for _ in range(args.files)]
+    paths = [generate_file(fmt, rows, seed, workdir) for seed in seeds]
+    file_ids: List[Optional[str]] = [None] * len(paths)
+
+    async def upload(i: int) -> None:
+        with open(paths[i], "rb") as f:
+            files = {"file": (paths[i].name, f, CONTENT_TYPES[fmt])}
+            response = await client.post("/api/upload", files=files)
+        response.raise_for_status()
+        file_ids[i] = response.json()["file_id"]
+
+    async def process(i: int) -> None:
+        response = await client.post(
+            "/api/process", json={"file_id": file_ids[i], "force": True}
+        )
+        response.raise_for_status()
+        job = response.json()
+        while job["status"] in ("queued", "running"):
+            await asyncio.sleep(args.poll_interval)
+            response = await client.get(f"/api/jobs/{job['job_id']}")
+            response.raise_for_status()
+            job = response.json()
+        if job["status"] != "succeeded":
+            raise RuntimeError(f"job {job['job_id']} {job['status']}: {job['error']}")
+
+    async def insights(i: int) -> None:
+        file_id = file_ids[i % len(file_ids)]
+        response = await client.get("/api/insights", params={"file_id": file_id})
+        response.raise_for_status()
+
+    calls = {
+        "upload": (upload, len(paths)),
+        "process": (process, len(paths)),
+        "insights": (insights, len(paths) * args.reads),
+    }
+    results = []
+    size = sum(path.stat().st_size for path in paths) // len(paths)
+    for stage in STAGES:
+        make_call, count = calls[stage]
+        summary = await run_stage(make_call, count, args.concurrency)
+        results.append({"format": fmt, "rows": rows, "bytes": size, "stage": stage, **summary})
+        print(format_row(results[-1]))
+        if stage == "upload" and None in file_ids:
+            break  # nothing to process
+    for path in paths:
+        path.unlink()
+    return results
+
+
+# -- reporting -------------------------------------------------------------
+
+HEADER = (
+    f"{'format':<6}{'rows':>9}{'stage':>10}{'n':>6}{'err':>5}"
+    f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'rss MB':>9}"
+)
+
+
+def format_row(result: dict) -> str:
+    def ms(key: str) -> str:
+        return f"{result[key]:>10.1f}" if key in result else f"{'-':>10}"
+
+    return (
+        f"{result['format']:<6}{result['rows']:>9}{result['stage']:>10}"
+        f"{result['count']:>6}{result['errors']:>5}{ms('p50_ms')}{ms('p95_ms')}"
+        f"{ms('p99_ms')}{result['throughput_rps']:>9.1f}{result['peak_rss_mb']:>9.1f}"
+    )
+
+
+def compare(results: List[dict], baseline_path: str) -> None:
+    """Print how p50/p95 latency and peak RSS moved against a baseline run."""
+    baseline = json.loads(Path(baseline_path).read_text())
+    before = {(r["format"], r["rows"], r["stage"]): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('commit', '?')}):")
+    for result in results:
+        old = before.get((result["format"], result["rows"], result["stage"]))
+        if old is None or "p50_ms" not in old or "p50_ms" not in result:
+            continue
+        changes = "  ".join(
+            f"{key} {_change(old[key], result[key])}"
+            for key in ("p50_ms", "p95_ms", "peak_rss_mb")
+        )
+        print(f"{result['format']:<6}{result['rows']:>9}{result['stage']:>10}  {changes}")
+
+
+def _change(old: float, new: float) -> str:
+    if not old:
+        return f"{new:.1f}"
+    return f"{old:.1f} -> {new:.1f} ({(new - old) / old:+.0%})"
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SRC_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# -- main ------------------------------------------------------------------
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--rows", default="1000,50000", help="comma separated sizes")
+    parser.add_argument("--files", type=int, default=10, help="files per format and size")
+    parser.add_argument("--reads", type=int, default=5, help="insight reads per file")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="seconds")
+    parser.add_argument("--poll-interval", type=float, default=0.02, help="seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a previous --output file to compare with")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace, workdir: Path) -> List[dict]:
+    import httpx
+
+    from main import app
+
+    stub_model(args.llm_latency, args.llm_jitter)
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            print(HEADER)
+            for fmt in args.formats.split(","):
+                for rows in map(int, args.rows.split(",")):
+                    results += await bench_case(client, fmt, rows, args, workdir)
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory(prefix="insights-bench-") as scratch:
+        workdir = Path(scratch)
+        # point the app at a scratch database and media directory; this has to
+        # happen before any of its modules are imported
+        os.environ["DATABASE_URL"] = f"sqlite:///{workdir / 'bench.db'}"
+        os.environ["MEDIA_ROOT"] = str(workdir / "media")
+        os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+        sys.path.insert(0, str(SRC_DIR))
+
+        results = asyncio.run(main(args, workdir))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,134 @@
+"""
+Benchmark of insight extraction from raw model responses.
+
+Runs the response extractor (`extraction.extract_insights`) and the regex
+pipeline it replaced over a corpus of response shapes we get from models in
+practice, and reports for each how many of the expected insights were
+recovered and how long parsing took.
+
+Run from `backend/src`:
+
+    python ../benchmarks/bench_extraction.py [--repeat N]
+"""
+
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from extraction import extract_insights  # noqa: E402
+
+
+def insight(i: int, **overrides) -> dict:
+    item = {
+        "title": f"Insight {i}: revenue [Q{i}] grew {{fast}}",
+        "description": f'Sales in region "{i}" rose, see rows [1, 2]. ' * 5,
+        "confidence_score": 0.9 - i / 10,
+        "reference_rows": [i, i + 1],
+    }
+    item.update(overrides)
+    return item
+
+
+def as_json(items, **kwargs) -> str:
+    return json.dumps(items, **kwargs)
+
+
+ANSWER = [insight(i) for i in range(3)]
+PREAMBLE = (
+    "Okay, let me look at the data. Rows [3] and [7] stand out; a {draft} of\n"
+    'the answer: [{"title": "draft", "confidence_score": 0.1}]. Now the answer.\n'
+)
+
+# (name, response, number of insights that should be recovered)
+CORPUS = [
+    ("clean", as_json(ANSWER), 3),
+    ("pretty printed", as_json(ANSWER, indent=2), 3),
+    ("code fence", f"```json\n{as_json(ANSWER, indent=2)}\n```", 3),
+    ("reasoning preamble", PREAMBLE + as_json(ANSWER), 3),
+    (
+        "multiple code blocks",
+        f"```json\n{as_json(ANSWER[:1])}\n```\nRevised:\n```json\n{as_json(ANSWER)}\n```",
+        3,
+    ),
+    ("trailing prose", as_json(ANSWER) + "\nLet me know if [you] need more!", 3),
+    ("truncated array", as_json(ANSWER, indent=2)[:-40], 2),
+    ("trailing commas", as_json(ANSWER).replace("]}", "],}").replace("}]", "},]"), 3),
+    ("single quotes", str([insight(i, description="plain text") for i in range(3)]), 3),
+    (
+        "python literals",
+        as_json(ANSWER).replace('"reference_rows"', '"flag": True, "reference_rows"'),
+        3,
+    ),
+    ("wrapped in object", as_json({"insights": ANSWER}), 3),
+    ("bare object", as_json(ANSWER[0]), 1),
+    (
+        "one broken object",
+        as_json(ANSWER).replace('"confidence_score": 0.8', '"confidence_score": high', 1),
+        2,
+    ),
+    ("no json", "I could not find any meaningful pattern in this data.", 0),
+]
+
+
+def legacy_parse(raw_response: str):
+    """The regex pipeline `mcp_client.parse_ai_response` used to run."""
+    match = re.search(r"```(?:json)?\s*(\[.*?\])\s*```", raw_response, re.DOTALL)
+    json_str = match.group(1) if match else raw_response.strip()
+    json_str = json_str.strip()
+    json_str = re.sub(r"^[^\[]*", "", json_str)
+    json_str = re.sub(r"[^\]]*$", "", json_str)
+    return json.loads(json_str)
+
+
+def run(parser, response: str, repeat: int):
+    """Insights `parser` recovers from `response`, and seconds per parse."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        try:
+            found = parser(response)
+        except Exception:
+            found = []
+    elapsed = (time.perf_counter() - start) / repeat
+    if isinstance(found, dict):
+        found = [found]
+    # drafts from the reasoning don't count as recovered insights
+    recovered = [
+        item for item in found if isinstance(item, dict) and item.get("title") != "draft"
+    ]
+    return len(recovered), elapsed
+
+
+def main() -> None:
+    args = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    args.add_argument("--repeat", type=int, default=200)
+    repeat = args.parse_args().repeat
+
+    parsers = {"legacy": legacy_parse, "extractor": extract_insights}
+    totals = {name: [0, 0.0] for name in parsers}
+    expected_total = sum(expected for _, _, expected in CORPUS)
+
+    print(f"{'case':<22}{'expected':>9}" + "".join(f"{n:>12}{'us':>8}" for n in parsers))
+    for name, response, expected in CORPUS:
+        line = f"{name:<22}{expected:>9}"
+        for parser_name, parser in parsers.items():
+            recovered, elapsed = run(parser, response, repeat)
+            totals[parser_name][0] += min(recovered, expected)
+            totals[parser_name][1] += elapsed
+            line += f"{recovered:>12}{elapsed * 1e6:>8.0f}"
+        print(line)
+
+    print()
+    for parser_name, (recovered, elapsed) in totals.items():
+        print(
+            f"{parser_name:<10} recovered {recovered}/{expected_total} insights, "
+            f"{elapsed / len(CORPUS) * 1e6:.0f}us per response on average"
+        )
+
+
+if __name__ == "__main__":
+    main()
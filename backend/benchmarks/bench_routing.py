@@ -0,0 +1,238 @@
+"""
+Benchmark of model routing and hedged requests.
+
+Serves an OpenAI-compatible stub on localhost, with a scripted latency (and
+optionally slow tail and error rate) per model name, points the model client
+at it through `OPENROUTER_BASE_URL`, and sends it a stream of prompts through
+`mcp_client.agenerate_ai_insights`, once with hedging and once without. Each
+run reports p50/p95/p99 latency, errors, how many requests were hedged and
+which models answered:
+
+    cd backend/src
+    python ../benchmarks/bench_routing.py \\
+        --model "big=1.0,tail=0.05,stall=8" \\
+        --model "fast=0.3" \\
+        --model "flaky=0.5,errors=0.3"
+
+A model is given as NAME=LATENCY[,tail=P,stall=SECONDS][,errors=P]: it
+answers after about LATENCY seconds, except that a share P of its answers
+take STALL seconds instead, and a share P of its requests fail with a 503.
+Prompts alternate between the `--prompt-tokens` sizes, so both small-prompt
+and large-prompt routing are exercised.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+
+
+# -- the stub --------------------------------------------------------------
+
+
+def parse_model(spec: str) -> dict:
+    name, _, script = spec.partition("=")
+    latency, *options = script.split(",")
+    model = {"name": name, "latency": float(latency), "tail": 0.0, "stall": 0.0, "errors": 0.0}
+    for option in options:
+        key, _, value = option.partition("=")
+        if key not in ("tail", "stall", "errors"):
+            raise SystemExit(f"Unknown option {key!r} in --model {spec!r}")
+        model[key] = float(value)
+    return model
+
+
+def stub_app(models: Dict[str, dict], rng: random.Random):
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    async def completions(request):
+        body = await request.json()
+        script = models.get(body["model"])
+        if script is None:
+            return JSONResponse({"error": {"message": "No such model"}}, status_code=404)
+        if rng.random() < script["errors"]:
+            return JSONResponse({"error": {"message": "Overloaded"}}, status_code=503)
+        if rng.random() < script["tail"]:
+            delay = script["stall"]
+        else:
+            delay = script["latency"] * rng.uniform(0.8, 1.2)
+        await asyncio.sleep(delay)
+        # the title says who answered, so the benchmark can count winners
+        insights = [
+            {
+                "title": f"answered by {body['model']}",
+                "description": "Stub insight.",
+                "confidence_score": 0.9,
+                "reference_rows": [1],
+            }
+        ]
+        return JSONResponse(
+            {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": json.dumps(insights)},
+                    }
+                ],
+            }
+        )
+
+    return Starlette(routes=[Route("/v1/chat/completions", completions, methods=["POST"])])
+
+
+def serve(app) -> str:
+    """Run `app` on a free local port in a background thread."""
+    import uvicorn
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}/v1"
+
+
+# -- runs ------------------------------------------------------------------
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def make_prompt(tokens: int, i: int) -> str:
+    # about four characters a token; the request number keeps prompts unique
+    return f"request {i}\n" + "x" * (tokens * 4)
+
+
+async def run(hedge: bool, models: List[str], args) -> dict:
+    import mcp_client
+    from metrics import LLM_HEDGES
+    from routing import ModelRouter
+
+    router = ModelRouter(models, hedge=hedge)
+    mcp_client.llm_router = router
+    LLM_HEDGES._drain()
+    sizes = [int(size) for size in args.prompt_tokens.split(",")]
+    slots = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    winners: Dict[str, int] = {}
+    errors = 0
+
+    async def one(i: int) -> None:
+        nonlocal errors
+        async with slots:
+            start = time.perf_counter()
+            try:
+                insights = await mcp_client.agenerate_ai_insights(
+                    make_prompt(sizes[i % len(sizes)], i)
+                )
+            except Exception as e:
+                errors += 1
+                print(f"  request {i} failed: {e.__class__.__name__}", file=sys.stderr)
+                return
+            latencies.append(time.perf_counter() - start)
+            winner = insights[0]["title"].removeprefix("answered by ")
+            winners[winner] = winners.get(winner, 0) + 1
+
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    hedges = LLM_HEDGES._drain()
+    summary = {
+        "mode": "hedged" if hedge else "unhedged",
+        "count": len(latencies),
+        "errors": errors,
+        "hedged": int(sum(hedges.values())),
+        "winners": winners,
+        "ewma_ms": {
+            model: round(stats.latency * 1000) if stats.latency is not None else None
+            for model, stats in router.stats.items()
+        },
+    }
+    if latencies:
+        for q in (50, 95, 99):
+            summary[f"p{q}_ms"] = percentile(latencies, q) * 1000
+    return summary
+
+
+async def main(models: List[str], args) -> List[dict]:
+    # both runs share the event loop, which the model client's pool is bound to
+    results = []
+    for hedge in (False, True):
+        result = await run(hedge, models, args)
+        results.append(result)
+        print(
+            f"{result['mode']:<10} n={result['count']:<5} errors={result['errors']:<4}"
+            f" p50={result.get('p50_ms', 0):>8.1f}ms p95={result.get('p95_ms', 0):>8.1f}ms"
+            f" p99={result.get('p99_ms', 0):>8.1f}ms hedged={result['hedged']:<4}"
+            f" winners={result['winners']}"
+        )
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--model",
+        action="append",
+        help="NAME=LATENCY[,tail=P,stall=SECONDS][,errors=P], repeat for each model",
+    )
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--prompt-tokens", default="300,4000", help="comma separated prompt sizes"
+    )
+    parser.add_argument("--hedge-min-delay", type=float, default=0.2, help="seconds")
+    parser.add_argument("--hedge-max-delay", type=float, default=5.0, help="seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    scripts = [
+        parse_model(spec)
+        for spec in args.model or ["big=1.0,tail=0.05,stall=8", "fast=0.3", "flaky=0.5,errors=0.3"]
+    ]
+    base_url = serve(stub_app({m["name"]: m for m in scripts}, random.Random(args.seed)))
+
+    with tempfile.TemporaryDirectory(prefix="insights-bench-") as scratch:
+        # configure the app before any of its modules are imported
+        os.environ["DATABASE_URL"] = f"sqlite:///{Path(scratch) / 'bench.db'}"
+        os.environ["MEDIA_ROOT"] = str(Path(scratch) / "media")
+        os.environ["OPENROUTER_BASE_URL"] = base_url
+        os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+        os.environ["LLM_CACHE_ENABLED"] = "false"
+        # fail over to the next model instead of retrying the same one
+        os.environ.setdefault("LLM_MAX_RETRIES", "0")
+        os.environ["LLM_HEDGE_MIN_DELAY"] = str(args.hedge_min_delay)
+        os.environ["LLM_HEDGE_MAX_DELAY"] = str(args.hedge_max_delay)
+        sys.path.insert(0, str(SRC_DIR))
+
+        results = asyncio.run(main([m["name"] for m in scripts], args))
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({"models": scripts, "results": results}, indent=2))
+        print(f"\nResults written to {args.output}")
@@ -0,0 +1,218 @@
+"""
+Two-tier cache for LLM responses.
+
+Completions are keyed on the model name and a hash of the full prompt, so
+re-processing a file (or another file whose sampled rows come out identical)
+skips the model round-trip entirely.
+
+- The first tier is an in-process LRU with a TTL, answering in microseconds.
+- The second tier is a table in our SQLite database, which survives restarts
+  and is shared by every worker process on the machine.
+
+Only responses we managed to parse are cached, so a garbled completion is
+never served twice.
+"""
+
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.logger import logger
+from sqlmodel import Session, SQLModel, col, delete, func, select
+
+from config.core import (
+    LLM_CACHE_DISK_MAX_ENTRIES,
+    LLM_CACHE_DISK_TTL,
+    LLM_CACHE_ENABLED,
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_TTL,
+    engine,
+)
+from models import LLMCacheEntry
+
+# the disk tier is only counted (and trimmed) every this many writes
+EVICTION_INTERVAL = 100
+
+
+def make_cache_key(model: str, prompt: str) -> str:
+    return hashlib.sha256(f"{model}\0{prompt}".encode()).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache whose entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskCache:
+    """
+    Persistent cache tier backed by the `llm_cache` table.
+
+    Entries expire after `ttl` seconds, and the oldest ones are evicted once
+    the table holds more than `max_entries` rows. That's checked every
+    `EVICTION_INTERVAL` writes rather than on each, so the table may run that
+    many rows (per worker process) over before it's trimmed.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._table_ready = False
+        self._writes = itertools.count(1)
+
+    def _ensure_table(self) -> None:
+        if not self._table_ready:
+            SQLModel.metadata.create_all(engine, tables=[LLMCacheEntry.__table__])
+            self._table_ready = True
+
+    def get(self, key: str) -> Optional[str]:
+        self._ensure_table()
+        with Session(engine) as session:
+            entry = session.get(LLMCacheEntry, key)
+        if entry is None or time.time() - entry.created_at > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.response
+
+    def set(self, key: str, model: str, value: str) -> None:
+        self._ensure_table()
+        with Session(engine) as session:
+            session.merge(
+                LLMCacheEntry(key=key, model=model, response=value, created_at=time.time())
+            )
+            session.commit()
+
+            if next(self._writes) % EVICTION_INTERVAL:
+                return
+            count = session.exec(select(func.count()).select_from(LLMCacheEntry)).one()
+            excess = count - self.max_entries
+            if excess > 0:
+                oldest = (
+                    select(LLMCacheEntry.key)
+                    .order_by(col(LLMCacheEntry.created_at))
+                    .limit(excess)
+                )
+                session.exec(delete(LLMCacheEntry).where(col(LLMCacheEntry.key).in_(oldest)))
+                session.commit()
+                self.evictions += excess
+
+
+class ResponseCache:
+    """
+    Memory tier in front of the disk tier; disk hits are promoted to memory.
+    """
+
+    def __init__(self, memory: LRUCache, disk: DiskCache, enabled: bool = True):
+        self.memory = memory
+        self.disk = disk
+        self.enabled = enabled
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        value = self.memory.get(key)
+        if value is None:
+            value = self._get_disk(key)
+        return value
+
+    def set(self, key: str, model: str, value: str) -> None:
+        if not self.enabled:
+            return
+        self.memory.set(key, value)
+        self._set_disk(key, model, value)
+
+    async def aget(self, key: str) -> Optional[str]:
+        # the memory tier is cheap enough to check inline
+        if not self.enabled:
+            return None
+        value = self.memory.get(key)
+        if value is None:
+            value = await run_in_threadpool(self._get_disk, key)
+        return value
+
+    async def aset(self, key: str, model: str, value: str) -> None:
+        if not self.enabled:
+            return
+        self.memory.set(key, value)
+        await run_in_threadpool(self._set_disk, key, model, value)
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        try:
+            value = self.disk.get(key)
+        except Exception as e:
+            # a broken cache must never take insight generation down with it
+            logger.error(f"[Cache] Disk lookup failed: {e}")
+            return None
+        if value is not None:
+            self.memory.set(key, value)
+        return value
+
+    def _set_disk(self, key: str, model: str, value: str) -> None:
+        try:
+            self.disk.set(key, model, value)
+        except Exception as e:
+            logger.error(f"[Cache] Disk write failed: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "memory_entries": len(self.memory),
+            "memory_hits": self.memory.hits,
+            "memory_misses": self.memory.misses,
+            "memory_evictions": self.memory.evictions,
+            "memory_expirations": self.memory.expirations,
+            "disk_hits": self.disk.hits,
+            "disk_misses": self.disk.misses,
+            "disk_evictions": self.disk.evictions,
+        }
+
+
+llm_cache = ResponseCache(
+    LRUCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL),
+    DiskCache(LLM_CACHE_DISK_MAX_ENTRIES, LLM_CACHE_DISK_TTL),
+    enabled=LLM_CACHE_ENABLED,
+)
@@ -1,13 +1,232 @@
-from fastapi import Depends, FastAPI, HTTPException, Query
-from sqlmodel import Session, create_engine, select
+import os
+from pathlib import Path
 
-sqlite_file_name = "insights_db.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, create_engine
 
-connect_args = {"check_same_thread": False}
+# keep the database next to the app, wherever it's started from, unless told
+# to use another one (e.g. a scratch database for benchmarks)
+sqlite_file_name = Path(__file__).resolve().parent.parent / "insights_db.db"
+sqlite_url = os.getenv("DATABASE_URL", f"sqlite:///{sqlite_file_name}")
+
+connect_args = {"check_same_thread": False} if sqlite_url.startswith("sqlite") else {}
 engine = create_engine(sqlite_url, connect_args=connect_args)
 
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers carry on while a writer commits, which matters once
+    # several workers share this file
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # with several worker processes writing, wait for the lock instead of
+    # failing straight away with "database is locked"
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+
+# Uploads are streamed to disk in chunks of this size (bytes), and rejected
+# once they grow past MAX_UPLOAD_SIZE.
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 500 * 1024 * 1024))
+
+# How much of the start of an upload is kept in memory to build the preview
+PREVIEW_HEAD_SIZE = int(os.getenv("PREVIEW_HEAD_SIZE", 64 * 1024))
+
+# Resumable uploads are sent in parts of UPLOAD_PART_SIZE bytes by default (a
+# client may pick any size up to UPLOAD_MAX_PART_SIZE), in any order and in
+# parallel. Uploads left unfinished for UPLOAD_SESSION_TTL seconds are dropped.
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", 8 * 1024 * 1024))
+UPLOAD_MAX_PART_SIZE = int(os.getenv("UPLOAD_MAX_PART_SIZE", 64 * 1024 * 1024))
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))
+# A part being written holds off completing its upload for as long as it keeps
+# arriving: its writer checks in at least every third of
+# UPLOAD_WRITE_LEASE_SECONDS, and is given up on after that.
+UPLOAD_WRITE_LEASE_SECONDS = float(os.getenv("UPLOAD_WRITE_LEASE_SECONDS", 60))
+
+# Insight jobs: how many run at once, how often a failed one is retried (with
+# exponential backoff starting at JOB_RETRY_BACKOFF seconds), how many may wait
+# in the queue, and how long finished jobs stay around for polling.
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 4))
+JOB_MAX_RETRIES = int(os.getenv("JOB_MAX_RETRIES", 2))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", 2.0))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 100))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", 3600))
+
+# Jobs live in the database, so any worker process can run (and report on) any
+# job. Idle workers look for new jobs every JOB_POLL_INTERVAL seconds, and a
+# running job whose worker hasn't checked in for JOB_LEASE_SECONDS (because it
+# crashed, say) is picked up again by another one.
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1.0))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+
+# Storage (see `storage`): files not looked up for STORAGE_TTL seconds are
+# removed, along with their insights, and when files take more than
+# STORAGE_MAX_BYTES in all, the least recently looked up ones are removed until
+# they fit (0 turns either off). Originals not looked up for
+# STORAGE_COMPRESS_AFTER seconds are compressed with zstd, when the zstandard
+# package is installed (or on Python 3.14+), and decompressed on their next
+# lookup. A sweeper does all this every STORAGE_SWEEP_INTERVAL seconds (0 to
+# never run it). With STORAGE_MIGRATE_FLAT_FILES=true, it also moves at most
+# STORAGE_SWEEP_BATCH files per sweep out of the unsharded layout of older
+# versions; that's off by default, since MEDIA_ROOT defaults to the source tree.
+STORAGE_TTL = int(os.getenv("STORAGE_TTL", 0))
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_BYTES", 0))
+STORAGE_COMPRESS_AFTER = int(os.getenv("STORAGE_COMPRESS_AFTER", 7 * 24 * 3600))
+STORAGE_SWEEP_INTERVAL = float(os.getenv("STORAGE_SWEEP_INTERVAL", 600))
+STORAGE_SWEEP_BATCH = int(os.getenv("STORAGE_SWEEP_BATCH", 1000))
+STORAGE_MIGRATE_FLAT_FILES = (
+    os.getenv("STORAGE_MIGRATE_FLAT_FILES", "false").lower() == "true"
+)
+
+# Blocking work runs on executors of its own (see `executors`), rather than
+# on the threadpool shared with every sync endpoint. Parsing and sampling big
+# files is CPU-bound, so it runs in a pool of PARSE_WORKERS processes, where it
+# doesn't hold the GIL against request handling (with 0 it runs on threads
+# instead); disk I/O runs on IO_WORKERS threads. On top of the tasks they are
+# running, each takes at most *_QUEUE_LIMIT waiting ones before turning
+# requests away with a 429.
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 2))
+PARSE_QUEUE_LIMIT = int(os.getenv("PARSE_QUEUE_LIMIT", 16))
+IO_WORKERS = int(os.getenv("IO_WORKERS", 8))
+IO_QUEUE_LIMIT = int(os.getenv("IO_QUEUE_LIMIT", 64))
+
+# OpenRouter: where to send completions (point it at a local stub for
+# testing), how long to wait on them, how many may be in flight at once, and
+# how rate limits / upstream errors are retried.
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 120.0))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 10.0))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 16))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 1.0))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 30.0))
+# how many times we ask the model to restate an answer nothing could be
+# salvaged from, before giving up on it
+LLM_REASK_ATTEMPTS = int(os.getenv("LLM_REASK_ATTEMPTS", 1))
+
+# Model routing (see `routing`): completions go to a pool of LLM_MODELS
+# (comma-separated, the one trusted most with large prompts first). Prompts of
+# up to LLM_SMALL_PROMPT_TOKENS tokens go to whichever model has been fastest
+# instead, and models failing more than LLM_MAX_ERROR_RATE of their recent
+# requests are tried last. With LLM_HEDGE on, a request the first model hasn't
+# answered within its LLM_HEDGE_QUANTILE latency (kept between
+# LLM_HEDGE_MIN_DELAY and LLM_HEDGE_MAX_DELAY seconds) is sent to the next
+# model as well, and the first valid answer wins.
+LLM_MODELS = [
+    model.strip()
+    for model in os.getenv("LLM_MODELS", "tngtech/deepseek-r1t2-chimera:free").split(",")
+    if model.strip()
+]
+LLM_SMALL_PROMPT_TOKENS = int(os.getenv("LLM_SMALL_PROMPT_TOKENS", 1500))
+LLM_MAX_ERROR_RATE = float(os.getenv("LLM_MAX_ERROR_RATE", 0.5))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "true").lower() == "true"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", 0.95))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", 2.0))
+LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", 30.0))
+
+# LLM response cache: an in-memory LRU in front of a table in our database.
+# TTLs are in seconds.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 512))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 24 * 3600))
+LLM_CACHE_DISK_MAX_ENTRIES = int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES", 10000))
+LLM_CACHE_DISK_TTL = float(os.getenv("LLM_CACHE_DISK_TTL", 7 * 24 * 3600))
+
+# Excel workbooks are read with python-calamine (a much faster, Rust-based
+# reader) when it is installed, and streamed with openpyxl otherwise; set
+# EXCEL_ENGINE to "openpyxl" or "calamine" to choose. Insights for several
+# sheets of a workbook are generated for up to SHEET_CONCURRENCY at once.
+EXCEL_ENGINE = os.getenv("EXCEL_ENGINE", "auto")
+SHEET_CONCURRENCY = int(os.getenv("SHEET_CONCURRENCY", 4))
+
+# Prompt sampling: files are summarized over (at most) SAMPLING_MAX_ROWS rows,
+# and the summary plus sample rows are fit into PROMPT_TOKEN_BUDGET tokens.
+SAMPLING_MAX_ROWS = int(os.getenv("SAMPLING_MAX_ROWS", 1_000_000))
+# text documents are read up to this many lines (or paragraphs)
+TEXT_MAX_LINES = int(os.getenv("TEXT_MAX_LINES", 50_000))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 6000))
+PROMPT_MAX_COLUMNS = int(os.getenv("PROMPT_MAX_COLUMNS", 40))
+PROMPT_CELL_WIDTH = int(os.getenv("PROMPT_CELL_WIDTH", 60))
+
+# Profiling: tabular uploads are scanned once, PROFILE_CHUNK_ROWS rows at a
+# time, for per-column statistics (types, nulls, min/max/mean, approximate
+# distinct counts and quantiles) kept with the file's metadata. Prompts then
+# take their column summary from the profile and their sample rows from the
+# first PROFILE_SAMPLE_ROWS rows only. With PROFILE_ON_UPLOAD=false, files
+# are profiled the first time a profile is needed instead.
+PROFILE_ON_UPLOAD = os.getenv("PROFILE_ON_UPLOAD", "true").lower() == "true"
+PROFILE_CHUNK_ROWS = int(os.getenv("PROFILE_CHUNK_ROWS", 100_000))
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", 50_000))
+
+# Map-reduce generation for large tables: files of at least MAP_REDUCE_MIN_BYTES
+# are streamed in chunks of MAP_REDUCE_CHUNK_ROWS rows, each prompted on its
+# own (up to MAP_REDUCE_CONCURRENCY at once) before a final merge.
+MAP_REDUCE_MIN_BYTES = int(os.getenv("MAP_REDUCE_MIN_BYTES", 50 * 1024 * 1024))
+MAP_REDUCE_CHUNK_ROWS = int(os.getenv("MAP_REDUCE_CHUNK_ROWS", 100_000))
+MAP_REDUCE_CONCURRENCY = int(os.getenv("MAP_REDUCE_CONCURRENCY", 4))
+MAP_REDUCE_CHUNK_TOKEN_BUDGET = int(os.getenv("MAP_REDUCE_CHUNK_TOKEN_BUDGET", 3000))
+
+# Batch processing: how many file IDs one request may carry, and how many of
+# them are worked on at once. Model calls are additionally bounded by
+# LLM_CONCURRENCY across the whole process.
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 100))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+
+# Rendered preview and insights responses are cached in memory and served with
+# ETags, so unchanged ones are answered with a 304. Previews never change;
+# insights are looked up again after INSIGHTS_CACHE_TTL seconds, in case
+# another worker process generated new ones. Responses of at least
+# GZIP_MINIMUM_SIZE bytes are gzipped for clients that accept it.
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+PREVIEW_CACHE_TTL = float(os.getenv("PREVIEW_CACHE_TTL", 24 * 3600))
+INSIGHTS_CACHE_TTL = float(os.getenv("INSIGHTS_CACHE_TTL", 30))
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", 1024))
+
+# Per-stage timings and counters, exposed on /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Import the heavy libraries (pandas, pyarrow, openai, ...) in the background
+# once the app is up, so the first request doesn't pay for them
+WARM_UP_ON_STARTUP = os.getenv("WARM_UP_ON_STARTUP", "true").lower() == "true"
+
+
+def create_db_and_tables():
+    import models  # noqa: F401 - registers the tables on SQLModel.metadata
+
+    SQLModel.metadata.create_all(engine)
+    _add_missing_columns()
+
+
+def _add_missing_columns():
+    # create_all only creates missing tables; columns added to existing ones
+    # since (all nullable) are added here
+    inspector = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        text(
+                            f'ALTER TABLE "{table.name}" '
+                            f'ADD COLUMN "{column.name}" {column_type}'
+                        )
+                    )
+            except OperationalError as e:
+                # another worker process starting up got there first
+                if "duplicate column" not in str(e):
+                    raise
+
+
 def get_session():
     with Session(engine) as session:
         yield session
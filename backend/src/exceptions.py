@@ -20,6 +20,66 @@ class InvalidFileTypeException(HTTPException):
         super().__init__(status_code=400, detail=f"Unsupported file type: {file_type}")
 
 
+class SheetNotFoundException(HTTPException):
+    def __init__(self, file_id: str, sheets: list):
+        super().__init__(
+            status_code=404,
+            detail=f"Sheets not found in file ID {file_id}: {', '.join(sheets)}",
+        )
+
+
+class FileTooLargeException(HTTPException):
+    def __init__(self, max_size: int):
+        super().__init__(
+            status_code=413,
+            detail=f"File exceeds the maximum upload size of {max_size} bytes",
+        )
+
+
+class JobNotFoundException(HTTPException):
+    def __init__(self, job_id: str):
+        super().__init__(status_code=404, detail=f"Job not found for job ID: {job_id}")
+
+
+class JobQueueFullException(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=429,
+            detail="Too many files are waiting to be processed, please retry later",
+        )
+
+
+class ExecutorBusyException(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=429,
+            detail="The server is busy processing other files, please retry later",
+        )
+
+
+class UploadNotFoundException(HTTPException):
+    def __init__(self, upload_id: str):
+        super().__init__(
+            status_code=404, detail=f"Upload not found for upload ID: {upload_id}"
+        )
+
+
+class InvalidUploadPartException(HTTPException):
+    def __init__(self, detail: str):
+        super().__init__(status_code=400, detail=detail)
+
+
+class UploadIncompleteException(HTTPException):
+    def __init__(self, missing: list):
+        shown = ", ".join(str(part) for part in missing[:20])
+        if len(missing) > 20:
+            shown += ", ..."
+        super().__init__(
+            status_code=409,
+            detail=f"Parts missing from the upload ({len(missing)}): {shown}",
+        )
+
+
 class FileProcessingError(Exception):
     """Exception raised for errors in file processing."""
 
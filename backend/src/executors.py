@@ -0,0 +1,175 @@
+"""
+Executors for blocking work.
+
+Blocking work gets executors of its own instead of Starlette's threadpool,
+which every sync endpoint and `run_in_threadpool` call shares, so that a few
+big uploads can't stall the rest of the API:
+
+- `run_io` runs disk I/O (streaming uploads to disk) on `IO_WORKERS` threads;
+- `run_cpu_bound` runs parsing and sampling, which is pure Python and pandas
+  work holding the GIL for seconds, in a pool of `PARSE_WORKERS` processes
+  (or on threads, when that is 0).
+
+Each executor takes at most its `*_QUEUE_LIMIT` tasks waiting on top of the
+ones it is running; past that, callers get `ExecutorBusyException` (429)
+straight away rather than queueing up behind minutes of work. How long tasks
+wait for a worker is recorded in `insights_executor_queue_wait_seconds`.
+
+Pool processes are started with "spawn", so they don't inherit the app's
+threads, locks or open connections, and share nothing with it but the
+database and the files on disk. What they record in their metrics is handed
+back with each result and merged into the app's.
+"""
+
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+from fastapi.logger import logger
+
+from config.core import IO_QUEUE_LIMIT, IO_WORKERS, PARSE_QUEUE_LIMIT, PARSE_WORKERS
+from exceptions import ExecutorBusyException
+from metrics import (
+    EXECUTOR_QUEUE_WAIT_SECONDS,
+    EXECUTOR_REJECTIONS,
+    EXECUTOR_TASKS,
+    drain,
+    merge,
+)
+
+
+class BoundedExecutor:
+    """
+    A lazily started executor that refuses work once `queue_limit` tasks are
+    waiting for one of its `workers`.
+    """
+
+    def __init__(self, name: str, workers: int, queue_limit: int, processes: bool):
+        self.name = name
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.processes = processes
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        # tasks submitted and not finished yet, only touched on the event loop
+        self._pending = 0
+
+    def get(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.processes:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_init_worker,
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix=self.name
+                    )
+                logger.info(
+                    f"[Executors] Started {self.workers} {self.name} "
+                    f"{'processes' if self.processes else 'threads'}"
+                )
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run `fn(*args)` on the executor. With processes, `fn` and its
+        arguments and result must be picklable, so `fn` has to be a
+        module-level function.
+        """
+        if self._pending >= self.workers + self.queue_limit:
+            EXECUTOR_REJECTIONS.inc(executor=self.name)
+            raise ExecutorBusyException()
+
+        self._pending += 1
+        EXECUTOR_TASKS.set(self._pending, executor=self.name)
+        loop = asyncio.get_running_loop()
+        # wall-clock time, so it means the same in a worker process
+        submitted = time.time()
+        try:
+            result, metrics, started = await loop.run_in_executor(
+                self.get(), _call, fn, args, self.processes
+            )
+        finally:
+            self._pending -= 1
+            EXECUTOR_TASKS.set(self._pending, executor=self.name)
+        EXECUTOR_QUEUE_WAIT_SECONDS.observe(
+            max(started - submitted, 0.0), executor=self.name
+        )
+        if metrics:
+            merge(metrics)
+        return result
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+io_executor = BoundedExecutor(
+    "io", workers=IO_WORKERS, queue_limit=IO_QUEUE_LIMIT, processes=False
+)
+cpu_executor = BoundedExecutor(
+    "cpu",
+    workers=PARSE_WORKERS or os.cpu_count() or 1,
+    queue_limit=PARSE_QUEUE_LIMIT,
+    processes=PARSE_WORKERS > 0,
+)
+
+
+async def run_io(fn: Callable[..., Any], *args: Any) -> Any:
+    """Run blocking I/O on the I/O executor."""
+    return await io_executor.run(fn, *args)
+
+
+async def run_cpu_bound(fn: Callable[..., Any], *args: Any) -> Any:
+    """Run CPU-bound work on the CPU executor (the process pool)."""
+    return await cpu_executor.run(fn, *args)
+
+
+def warm_process_pool() -> None:
+    """
+    Start the pool's processes and have them import the parsing code, so the
+    first file to parse doesn't wait on that.
+    """
+    if not cpu_executor.processes:
+        return
+    pool = cpu_executor.get()
+    futures = [pool.submit(_import, "services") for _ in range(cpu_executor.workers)]
+    for future in futures:
+        future.result()
+
+
+def shutdown_executors() -> None:
+    io_executor.shutdown()
+    cpu_executor.shutdown()
+
+
+def _call(
+    fn: Callable[..., Any], args: Tuple[Any, ...], in_process: bool
+) -> Tuple[Any, Optional[dict], float]:
+    # runs on the executor, in a pool process when `in_process`
+    started = time.time()
+    result = fn(*args)
+    return result, drain() if in_process else None, started
+
+
+def _import(name: str) -> None:
+    # runs in the pool process
+    importlib.import_module(name)
+
+
+def _init_worker() -> None:
+    # runs in the pool process, which has none of the app's logging set up
+    logging.basicConfig(
+        level=logging.INFO, format="%(levelname)s:%(name)s:[parse-worker] %(message)s"
+    )
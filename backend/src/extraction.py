@@ -0,0 +1,229 @@
+"""
+Extraction of insights from raw model responses.
+
+Models don't reliably answer with bare JSON: reasoning models think out loud
+before answering, answers come wrapped in one (or several) code blocks, and
+long answers get cut off at the token limit. Rather than trimming the
+response with regexes and hoping the rest parses, we scan it once, matching
+brackets, and pick out every object sitting in a JSON array:
+
+- each object is parsed on its own, so a malformed or truncated one doesn't
+  cost us the others;
+- objects that don't parse get common defects repaired (trailing commas,
+  single quotes, Python literals) before they are given up on;
+- whatever parses is validated against `schemas.Insight`.
+
+The scanner is incremental, so the same code picks insights out of a
+completion while it is still being streamed.
+"""
+
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from schemas import Insight
+
+
+STRUCTURAL_CHARS = re.compile(r'[\[\]{}"\\]')
+
+
+class InsightStreamParser:
+    """
+    Incremental, single-pass extractor of the insight objects in a response.
+
+    Feed it the response text, all at once or in pieces as it streams in;
+    `feed` returns the valid insights completed by that piece of text. Text
+    outside of JSON (prose, code fences) is skipped.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        # top-level JSON values seen so far; insights are tagged with theirs
+        self._values = 0
+        # where the insight being read starts, and how deep it sits
+        self._start: Optional[int] = None
+        self._start_depth = 0
+        # where the top-level object being read starts, if any
+        self._loose_start: Optional[int] = None
+        self.found: List[Tuple[int, dict]] = []
+        self.loose: List[dict] = []
+
+    def feed(self, text: str) -> List[dict]:
+        self._text += text
+        found = []
+        # an escape split over two pieces of text applies to the first new char
+        skip = self._pos + 1 if self._escape else self._pos
+        self._escape = False
+        # only brackets, quotes and backslashes matter, jump from one to the next
+        for match in STRUCTURAL_CHARS.finditer(self._text, self._pos):
+            i = match.start()
+            if i < skip:
+                continue
+            char = match.group()
+            if self._in_string:
+                if char == "\\":
+                    # the escaped char is skipped, whatever it is
+                    skip = i + 2
+                    self._escape = skip > len(self._text)
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"' and self._stack:
+                self._in_string = True
+            elif char in "[{":
+                if not self._stack:
+                    self._values += 1
+                    if char == "{":
+                        self._loose_start = i
+                # an insight is an object sitting directly in an array (which
+                # may itself be wrapped, as in `{"insights": [...]}`)
+                elif char == "{" and self._stack[-1] == "[" and self._start is None:
+                    self._start, self._start_depth = i, len(self._stack)
+                self._stack.append(char)
+            elif char in "]}" and self._stack:
+                self._stack.pop()
+                if char != "}":
+                    continue
+                if self._start is not None and len(self._stack) == self._start_depth:
+                    insight = validate_insight(
+                        loads_lenient(self._text[self._start : i + 1])
+                    )
+                    if insight is not None:
+                        found.append(insight)
+                        self.found.append((self._values, insight))
+                    self._start = None
+                elif self._loose_start is not None and not self._stack:
+                    # a bare object, in case the model didn't answer with a list
+                    insight = validate_insight(
+                        loads_lenient(self._text[self._loose_start : i + 1])
+                    )
+                    if insight is not None:
+                        self.loose.append(insight)
+                    self._loose_start = None
+        self._discard_consumed()
+        return found
+
+    def _discard_consumed(self) -> None:
+        # only the objects being read (if any) have to be kept around
+        starts = [s for s in (self._start, self._loose_start) if s is not None]
+        keep = min(starts) if starts else len(self._text)
+        self._text = self._text[keep:]
+        if self._start is not None:
+            self._start -= keep
+        if self._loose_start is not None:
+            self._loose_start -= keep
+        self._pos = len(self._text)
+
+
+def extract_insights(raw_response: str) -> List[dict]:
+    """
+    Salvage the valid insights from a raw model response.
+
+    When the response holds several lists of insights (a draft in the
+    reasoning and the final answer, say), the one with the most valid insights
+    wins, the last one on a tie. Returns an empty list when nothing can be
+    salvaged.
+    """
+    parser = InsightStreamParser()
+    parser.feed(raw_response)
+    if not parser.found:
+        return parser.loose
+
+    counts: dict = {}
+    for value, _ in parser.found:
+        counts[value] = counts.get(value, 0) + 1
+    best = max(counts, key=lambda value: (counts[value], value))
+    return [insight for value, insight in parser.found if value == best]
+
+
+def loads_lenient(text: str) -> Any:
+    """
+    `json.loads`, retried once on a repaired copy of `text` when it fails.
+    Returns None when the text can't be parsed either way.
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(repair_json(text))
+    except json.JSONDecodeError:
+        return None
+
+
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def repair_json(text: str) -> str:
+    """
+    Fix the JSON defects models commonly produce: trailing commas, single
+    quoted strings and Python's True/False/None. Contents of (double quoted)
+    strings are left alone.
+    """
+    out: List[str] = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            end = _string_end(text, i, '"')
+            out.append(text[i:end])
+            i = end
+        elif char == "'":
+            end = _string_end(text, i, "'")
+            inner = text[i + 1 : end - 1].replace("\\'", "'").replace('"', '\\"')
+            out.append(f'"{inner}"')
+            i = end
+        elif char == ",":
+            j = i + 1
+            while j < len(text) and text[j].isspace():
+                j += 1
+            if j >= len(text) or text[j] not in "]}":
+                out.append(char)
+            i += 1
+        elif char.isalpha():
+            j = i
+            while j < len(text) and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(PYTHON_LITERALS.get(word, word))
+            i = j
+        else:
+            out.append(char)
+            i += 1
+    return "".join(out)
+
+
+def _string_end(text: str, start: int, quote: str) -> int:
+    # index just past the closing quote of the string opened at `start`
+    i = start + 1
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+            continue
+        if text[i] == quote:
+            return i + 1
+        i += 1
+    return len(text)
+
+
+def validate_insight(item: Any) -> Optional[dict]:
+    """
+    Check a parsed object against `schemas.Insight`, returning it as a clean
+    dict, or None if it isn't an insight. Models tend to leave out empty
+    fields, so `description` and `reference_rows` may be missing.
+    """
+    if not isinstance(item, dict):
+        return None
+    try:
+        return Insight.model_validate(
+            {"description": "", "reference_rows": [], **item}
+        ).model_dump()
+    except ValidationError:
+        return None
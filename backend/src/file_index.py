@@ -0,0 +1,148 @@
+"""
+Index of uploaded files, by file ID.
+
+Every upload gets a `FileRecord` holding its path, detected type, size,
+content hash and shape. Records live in the `file` table and are kept in an
+in-memory dict in front of it, so resolving a file ID is a dict lookup rather
+than probing `MEDIA_DIR` for every extension the file might have.
+
+Looking a file up also records when it was last used, which is what
+`storage` removes and compresses files by. When a record's file is no longer
+where it says (because it was compressed, moved or removed, possibly by
+another worker process), the record is read again from the database, and
+the file restored if it was compressed.
+"""
+
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from fastapi.logger import logger
+from sqlalchemy import update
+from sqlmodel import Session
+
+from config.core import engine
+from exceptions import FileNotFoundException
+from models import FileRecord
+from utils import (
+    MEDIA_DIR,
+    detect_file_type,
+    legacy_file_path,
+    resolve_file_path,
+    shard_path,
+)
+
+SUPPORTED_EXTENSIONS = ("xlsx", "csv", "txt", "docx", "xls")
+# when a file was last looked up is only written back this often (seconds)
+ACCESS_RESOLUTION = 300
+
+
+class FileIndex:
+    def __init__(self):
+        self._records: Dict[str, FileRecord] = {}
+        self._lock = threading.Lock()
+
+    def add(self, record: FileRecord) -> FileRecord:
+        with Session(engine, expire_on_commit=False) as session:
+            record = session.merge(record)
+            session.commit()
+        with self._lock:
+            self._records[record.file_id] = record
+        return record
+
+    def get(self, file_id: str, discover: bool = True) -> Optional[FileRecord]:
+        record = self._records.get(file_id)
+        if record is None or not os.path.exists(record.path):
+            record = self._load(file_id, discover)
+            with self._lock:
+                if record is None:
+                    self._records.pop(file_id, None)
+                    return None
+                self._records[file_id] = record
+        self._touch(record)
+        return record
+
+    def require(self, file_id: str) -> FileRecord:
+        record = self.get(file_id)
+        if record is None:
+            raise FileNotFoundException(file_id)
+        return record
+
+    def _load(self, file_id: str, discover: bool) -> Optional[FileRecord]:
+        with Session(engine, expire_on_commit=False) as session:
+            record = session.get(FileRecord, file_id)
+        if record is None:
+            return self._discover(file_id) if discover else None
+        if not os.path.exists(record.path):
+            # moved into its shard (see `storage`), and the record not updated yet
+            moved = str(shard_path(MEDIA_DIR, os.path.basename(record.path)))
+            if record.path != moved and os.path.exists(moved):
+                record.path = moved
+                return record
+        if not os.path.exists(record.path):
+            from storage import restore_file
+
+            return restore_file(record)
+        return record
+
+    def mark_used(self, file_id: str) -> None:
+        """
+        Record that a file was used just now, however recently it was last
+        looked up, so that `storage` leaves it be for a while.
+        """
+        now = datetime.now(timezone.utc)
+        with Session(engine) as session:
+            session.exec(
+                update(FileRecord)
+                .where(FileRecord.file_id == file_id)
+                .values(accessed_at=now)
+            )
+            session.commit()
+        record = self._records.get(file_id)
+        if record is not None:
+            record.accessed_at = now
+
+    def _touch(self, record: FileRecord) -> None:
+        now = datetime.now(timezone.utc)
+        accessed = record.accessed_at or record.created_at
+        if (now - accessed).total_seconds() < ACCESS_RESOLUTION:
+            return
+        record.accessed_at = now
+        with Session(engine) as session:
+            session.exec(
+                update(FileRecord)
+                .where(FileRecord.file_id == record.file_id)
+                .values(accessed_at=now)
+            )
+            session.commit()
+
+    def _discover(self, file_id: str) -> Optional[FileRecord]:
+        # files uploaded before the index existed: find them on disk once, and
+        # index them so we never have to look again
+        for ext in SUPPORTED_EXTENSIONS:
+            path = resolve_file_path(file_id, ext)
+            if not os.path.exists(path):
+                path = legacy_file_path(file_id, ext)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                head = f.read(4096)
+            try:
+                file_type = detect_file_type(path, head, ext)
+            except Exception as e:
+                logger.warning(f"[FileIndex] Unrecognised file {path}: {e}")
+                return None
+            logger.info(f"[FileIndex] Indexed pre-existing file {path}")
+            return self.add(
+                FileRecord(
+                    file_id=file_id,
+                    path=path,
+                    file_type=file_type,
+                    size=os.path.getsize(path),
+                )
+            )
+        return None
+
+
+file_index = FileIndex()
@@ -0,0 +1,109 @@
+"""
+In-memory cache of rendered GET responses, served with ETags.
+
+The frontend re-fetches a file's preview and insights every time it shows
+them, but they rarely change. Responses are cached rendered (as JSON bytes)
+along with an ETag hashed from the body, so a repeat GET is answered from
+memory, and a client sending the ETag back in `If-None-Match` gets a bodiless
+304 Not Modified, without us touching the disk or the database.
+
+- Previews (and profiles) of a file never change, file IDs being
+  content-addressed. The file is still looked up before a cached preview is
+  served, so one removed by the storage sweeper of another worker process
+  isn't served on from here (and a file previewed often counts as used).
+- Insights change when a file is processed again. Persisting them here
+  invalidates the file's cached responses straight away; with several worker
+  processes, the others may serve the old ones (also those of a file the
+  storage sweeper removed) for up to `INSIGHTS_CACHE_TTL` seconds.
+"""
+
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+
+from fastapi import Request, Response
+from pydantic import BaseModel
+
+from cache import LRUCache
+from config.core import (
+    INSIGHTS_CACHE_TTL,
+    PREVIEW_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+)
+
+# clients have to revalidate (cheaply, with the ETag) before reusing a response
+CACHE_CONTROL = "no-cache"
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    body: bytes
+    etag: str
+
+
+class HTTPCache:
+    """
+    LRU of rendered responses, keyed per file so a file's entries can be
+    invalidated together.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self._entries = LRUCache(max_entries, ttl)
+        # bumping a file's generation orphans its entries, which then age out
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def key(self, file_id: str, *params) -> str:
+        generation = self._generations.get(file_id, 0)
+        return ":".join(str(part) for part in (file_id, generation, *params))
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        return self._entries.get(key)
+
+    def set(self, key: str, body: bytes) -> CachedResponse:
+        # weak, since GZipMiddleware may re-encode the body
+        etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+        cached = CachedResponse(body=body, etag=etag)
+        self._entries.set(key, cached)
+        return cached
+
+    def invalidate(self, file_id: str) -> None:
+        with self._lock:
+            self._generations[file_id] = self._generations.get(file_id, 0) + 1
+
+    async def respond(
+        self,
+        request: Request,
+        key: str,
+        build: Callable[[], Awaitable[BaseModel]],
+    ) -> Response:
+        """
+        The cached response under `key`, or the response `build` makes (which
+        is then cached), as a 304 when the client already has it.
+        """
+        cached = self.get(key)
+        if cached is None:
+            cached = self.set(key, (await build()).model_dump_json().encode())
+
+        headers = {"ETag": cached.etag, "Cache-Control": CACHE_CONTROL}
+        if etag_matches(request.headers.get("if-none-match"), cached.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(cached.body, media_type="application/json", headers=headers)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match compares weakly: W/"x" matches "x"
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == opaque
+        for candidate in if_none_match.split(",")
+    )
+
+
+preview_cache = HTTPCache(RESPONSE_CACHE_MAX_ENTRIES, PREVIEW_CACHE_TTL)
+insights_cache = HTTPCache(RESPONSE_CACHE_MAX_ENTRIES, INSIGHTS_CACHE_TTL)
@@ -0,0 +1,520 @@
+"""
+Database-backed job queue for insight generation.
+
+Generating insights means a round-trip to OpenRouter that routinely takes
+20-60 seconds, which is far too long to hold a request (and a threadpool
+worker) open for. Instead `/api/process` submits a job here and returns its
+ID straight away, and clients poll `/api/jobs/{job_id}` for the result.
+
+Jobs are rows of the `job` table rather than objects in memory, so the app can
+run as several worker processes (`uvicorn --workers N`, gunicorn, ...): a job
+queued through one of them may be run by any, and polled through any.
+
+- Each process runs `JOB_CONCURRENCY` worker tasks, which claim the oldest
+  queued job with a conditional update, so a job is only ever claimed once.
+- While a job runs its process checks in (`heartbeat_at`) every
+  `JOB_POLL_INTERVAL` seconds. A job whose process stopped checking in for
+  `JOB_LEASE_SECONDS` is claimed again by another worker.
+- Cancelling a job marks it cancelled; the process running it notices on its
+  next check-in and aborts it.
+
+Failed attempts are retried with exponential backoff, and the job only
+succeeds once its insights have been persisted.
+"""
+
+import asyncio
+import os
+import socket
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from typing import Dict, List, Optional, Set
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.logger import logger
+from sqlalchemy import and_, or_, update
+from sqlmodel import Session, col, delete, func, select
+
+from config.core import (
+    JOB_CONCURRENCY,
+    JOB_LEASE_SECONDS,
+    JOB_MAX_RETRIES,
+    JOB_POLL_INTERVAL,
+    JOB_QUEUE_SIZE,
+    JOB_RETENTION_SECONDS,
+    JOB_RETRY_BACKOFF,
+    engine,
+)
+from exceptions import FileNotFoundException, JobNotFoundException, JobQueueFullException
+from metrics import request_id_var
+from models import JobRecord
+from schemas import Insight
+from services import agenerate_insights, persist_insights
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+FINISHED_STATUSES = {JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED}
+ACTIVE_STATUSES = {JobStatus.QUEUED, JobStatus.RUNNING}
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+@dataclass
+class Job:
+    """
+    A single insight generation request for a file, as stored in the `job` table.
+
+    Attributes:
+        id (str): Unique identifier for the job.
+        file_id (str): The file insights are generated for.
+        mode (str): Generation mode, see `services.agenerate_insights`.
+        sheets (list[str]): Workbook sheets to generate insights for, if any.
+        status (JobStatus): Where the job is in its lifecycle.
+        attempts (int): How many times generation has been attempted.
+        insights (list[Insight]): The generated insights, once succeeded.
+        error (str): Why the job failed, if it did.
+        request_id (str): ID of the request that queued the job, for logging.
+    """
+
+    id: str
+    file_id: str
+    mode: Optional[str] = None
+    sheets: Optional[List[str]] = None
+    status: JobStatus = JobStatus.QUEUED
+    attempts: int = 0
+    insights: List[Insight] = field(default_factory=list)
+    error: Optional[str] = None
+    request_id: Optional[str] = None
+    created_at: datetime = field(default_factory=_now)
+    updated_at: datetime = field(default_factory=_now)
+
+    @classmethod
+    def from_record(cls, record: JobRecord) -> "Job":
+        return cls(
+            id=record.id,
+            file_id=record.file_id,
+            mode=record.mode,
+            sheets=record.sheets,
+            status=JobStatus(record.status),
+            attempts=record.attempts,
+            insights=[Insight(**item) for item in record.insights],
+            error=record.error,
+            request_id=record.request_id,
+            created_at=record.created_at,
+            updated_at=record.updated_at,
+        )
+
+
+class JobQueue:
+    """
+    Queue of insight jobs in the database, drained by a fixed pool of worker
+    tasks in every app process.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = JOB_CONCURRENCY,
+        max_retries: int = JOB_MAX_RETRIES,
+        retry_backoff: float = JOB_RETRY_BACKOFF,
+        max_size: int = JOB_QUEUE_SIZE,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        lease_seconds: float = JOB_LEASE_SECONDS,
+    ):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        # identifies this process as the owner of the jobs it claims
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # the pending step of each job running in this process, so it can be
+        # aborted when the job is cancelled, and the jobs that were aborted
+        self._running: Dict[str, asyncio.Future] = {}
+        self._aborted: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._workers: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._worker(i)) for i in range(self.concurrency)
+        ]
+        self._workers.append(asyncio.create_task(self._watch()))
+        logger.info(
+            f"[Jobs] Started {self.concurrency} insight workers ({self.worker_id})"
+        )
+
+    async def stop(self) -> None:
+        running = list(self._running)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # hand the jobs we were running back to the queue, rather than making
+        # another worker wait out their lease
+        if running:
+            await run_in_threadpool(self._release, running)
+
+    def submit(
+        self,
+        file_id: str,
+        mode: Optional[str] = None,
+        sheets: Optional[List[str]] = None,
+    ) -> Job:
+        """Queue insight generation for a file, returning the new job."""
+        self._prune()
+        record = JobRecord(
+            id=uuid.uuid4().hex,
+            file_id=file_id,
+            mode=mode,
+            sheets=sheets,
+            status=JobStatus.QUEUED.value,
+            request_id=request_id_var.get(),
+            created_at=_now(),
+            updated_at=_now(),
+        )
+        with Session(engine, expire_on_commit=False) as session:
+            queued = session.exec(
+                select(func.count())
+                .select_from(JobRecord)
+                .where(JobRecord.status == JobStatus.QUEUED.value)
+            ).one()
+            if queued >= self.max_size:
+                raise JobQueueFullException()
+            session.add(record)
+            session.commit()
+        self._notify()
+        return Job.from_record(record)
+
+    def complete(self, file_id: str, insights: List[Insight]) -> Job:
+        """Record an already finished job, e.g. when insights were stored."""
+        self._prune()
+        record = JobRecord(
+            id=uuid.uuid4().hex,
+            file_id=file_id,
+            status=JobStatus.SUCCEEDED.value,
+            insights=[insight.model_dump() for insight in insights],
+            request_id=request_id_var.get(),
+            created_at=_now(),
+            updated_at=_now(),
+        )
+        with Session(engine, expire_on_commit=False) as session:
+            session.add(record)
+            session.commit()
+        return Job.from_record(record)
+
+    def get(self, job_id: str) -> Job:
+        with Session(engine) as session:
+            record = session.get(JobRecord, job_id)
+        if record is None:
+            raise JobNotFoundException(job_id)
+        return Job.from_record(record)
+
+    def active(self, file_id: str) -> Optional[Job]:
+        """
+        The oldest queued or running job generating insights for the whole
+        file (rather than for some of its sheets), if there is one.
+        """
+        with Session(engine) as session:
+            records = session.exec(
+                select(JobRecord)
+                .where(
+                    JobRecord.file_id == file_id,
+                    col(JobRecord.status).in_(_values(ACTIVE_STATUSES)),
+                )
+                .order_by(JobRecord.created_at)
+            ).all()
+        for record in records:
+            if not record.sheets:
+                return Job.from_record(record)
+        return None
+
+    async def wait(self, job_id: str) -> Job:
+        """
+        Wait for a job to finish, whichever worker process is running it.
+        """
+        while True:
+            job = await run_in_threadpool(self.get, job_id)
+            if job.status in FINISHED_STATUSES:
+                return job
+            await asyncio.sleep(self.poll_interval)
+
+    def cancel(self, job_id: str) -> Job:
+        """
+        Cancel a queued or running job.
+
+        A queued job is never picked up. A running job has its in-flight model
+        request aborted by the process running it, and nothing is persisted.
+        """
+        with Session(engine) as session:
+            session.execute(
+                update(JobRecord)
+                .where(
+                    JobRecord.id == job_id,
+                    col(JobRecord.status).notin_(_values(FINISHED_STATUSES)),
+                )
+                .values(status=JobStatus.CANCELLED.value, updated_at=_now())
+            )
+            session.commit()
+        job = self.get(job_id)
+        if job_id in self._running and job.status is JobStatus.CANCELLED:
+            # running here: no need to wait for the next check-in
+            self._loop.call_soon_threadsafe(self._abort, job_id)
+        return job
+
+    def _abort(self, job_id: str) -> None:
+        task = self._running.get(job_id)
+        if task is not None:
+            self._aborted.add(job_id)
+            task.cancel()
+
+    def _notify(self) -> None:
+        # wake up an idle worker of this process; workers of other processes
+        # see the job on their next poll
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await run_in_threadpool(self._claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            # log the job's lines under the request that queued it
+            request_id_var.set(job.request_id)
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                # the job itself was aborted, the worker carries on
+                if job.id not in self._aborted:
+                    raise
+            except Exception as e:
+                logger.error(f"[Jobs] Worker {index} crashed on job {job.id}: {e}")
+                await run_in_threadpool(
+                    self._update, job.id, status=JobStatus.FAILED.value, error=str(e)
+                )
+            finally:
+                self._running.pop(job.id, None)
+                self._aborted.discard(job.id)
+
+    async def _run(self, job: Job) -> None:
+        while True:
+            job.attempts += 1
+            if not await run_in_threadpool(self._update, job.id, attempts=job.attempts):
+                # cancelled, or taken over by another worker
+                return
+            try:
+                insights = await self._await(
+                    job, agenerate_insights(job.file_id, mode=job.mode, sheets=job.sheets)
+                )
+                break
+            except (FileNotFoundError, FileNotFoundException):
+                # retrying won't make the file appear
+                await run_in_threadpool(
+                    self._update,
+                    job.id,
+                    status=JobStatus.FAILED.value,
+                    error=f"File not found: {job.file_id}",
+                )
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(
+                    f"[Jobs] Attempt {job.attempts} failed for job {job.id}: {e}"
+                )
+                if job.attempts > self.max_retries:
+                    await run_in_threadpool(
+                        self._update, job.id, status=JobStatus.FAILED.value, error=str(e)
+                    )
+                    return
+                await asyncio.sleep(self.retry_backoff * 2 ** (job.attempts - 1))
+
+        if not insights:
+            await run_in_threadpool(
+                self._update,
+                job.id,
+                status=JobStatus.FAILED.value,
+                error="No insights generated",
+            )
+            return
+
+        def succeed(session: Session) -> bool:
+            # in the transaction saving the insights: a job cancelled (or taken
+            # over) by now has them dropped rather than saved
+            return self._update_in(
+                session,
+                job.id,
+                status=JobStatus.SUCCEEDED.value,
+                insights=[insight.model_dump() for insight in insights],
+            )
+
+        persisted = await self._await(
+            job, run_in_threadpool(persist_insights, job.file_id, insights, succeed)
+        )
+        if not persisted:
+            logger.info(f"[Jobs] Job {job.id} was cancelled, dropping its insights")
+            return
+        logger.info(f"[Jobs] Generated {len(insights)} insights for file ID: {job.file_id}")
+
+    async def _await(self, job: Job, awaitable):
+        # keep a handle on the pending step so `cancel` can abort it
+        self._running[job.id] = asyncio.ensure_future(awaitable)
+        return await self._running[job.id]
+
+    def _claim(self) -> Optional[Job]:
+        """
+        Claim the oldest queued (or abandoned) job for this process.
+
+        The claim is a conditional update on the state the job was seen in, so
+        of several workers going for the same job only one gets it.
+        """
+        now = _now()
+        stale = now - timedelta(seconds=self.lease_seconds)
+        claimable = or_(
+            JobRecord.status == JobStatus.QUEUED.value,
+            and_(
+                JobRecord.status == JobStatus.RUNNING.value,
+                JobRecord.heartbeat_at < stale,
+            ),
+        )
+        with Session(engine, expire_on_commit=False) as session:
+            while True:
+                job_id = session.exec(
+                    select(JobRecord.id)
+                    .where(claimable)
+                    .order_by(JobRecord.created_at)
+                    .limit(1)
+                ).first()
+                if job_id is None:
+                    return None
+                claimed = session.execute(
+                    update(JobRecord)
+                    .where(JobRecord.id == job_id, claimable)
+                    .values(
+                        status=JobStatus.RUNNING.value,
+                        worker=self.worker_id,
+                        heartbeat_at=now,
+                        updated_at=now,
+                    )
+                )
+                session.commit()
+                if claimed.rowcount:
+                    record = session.get(JobRecord, job_id)
+                    if record.attempts:
+                        logger.warning(f"[Jobs] Resuming abandoned job {job_id}")
+                    return Job.from_record(record)
+                # another worker got there first, try the next one
+
+    def _update(self, job_id: str, **values) -> bool:
+        """
+        Update a job this process is running. Returns False when the job was
+        cancelled or claimed by another worker in the meantime.
+        """
+        with Session(engine) as session:
+            updated = self._update_in(session, job_id, **values)
+            session.commit()
+        return updated
+
+    def _update_in(self, session: Session, job_id: str, **values) -> bool:
+        # `_update`, in a transaction of the caller's
+        result = session.execute(
+            update(JobRecord)
+            .where(
+                JobRecord.id == job_id,
+                JobRecord.worker == self.worker_id,
+                JobRecord.status == JobStatus.RUNNING.value,
+            )
+            .values(updated_at=_now(), **values)
+        )
+        return bool(result.rowcount)
+
+    def _release(self, job_ids: List[str]) -> None:
+        with Session(engine) as session:
+            session.execute(
+                update(JobRecord)
+                .where(
+                    col(JobRecord.id).in_(job_ids),
+                    JobRecord.worker == self.worker_id,
+                    JobRecord.status == JobStatus.RUNNING.value,
+                )
+                .values(status=JobStatus.QUEUED.value, worker=None, updated_at=_now())
+            )
+            session.commit()
+
+    async def _watch(self) -> None:
+        # check in for the jobs running here, and abort the ones cancelled
+        # (possibly through another process) since the last check
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self._running:
+                continue
+            try:
+                lost = await run_in_threadpool(self._heartbeat, list(self._running))
+            except Exception as e:
+                logger.error(f"[Jobs] Heartbeat failed: {e}")
+                continue
+            for job_id in lost:
+                logger.info(f"[Jobs] Aborting job {job_id}, no longer ours to run")
+                self._abort(job_id)
+
+    def _heartbeat(self, job_ids: List[str]) -> List[str]:
+        """Check in for `job_ids`, returning those no longer running here."""
+        with Session(engine) as session:
+            session.execute(
+                update(JobRecord)
+                .where(
+                    col(JobRecord.id).in_(job_ids),
+                    JobRecord.worker == self.worker_id,
+                    JobRecord.status == JobStatus.RUNNING.value,
+                )
+                .values(heartbeat_at=_now())
+            )
+            session.commit()
+            ours = set(
+                session.exec(
+                    select(JobRecord.id).where(
+                        col(JobRecord.id).in_(job_ids),
+                        JobRecord.worker == self.worker_id,
+                        JobRecord.status == JobStatus.RUNNING.value,
+                    )
+                ).all()
+            )
+        return [job_id for job_id in job_ids if job_id not in ours]
+
+    def _prune(self) -> None:
+        # forget finished jobs once nobody is likely to poll for them anymore
+        cutoff = _now() - timedelta(seconds=JOB_RETENTION_SECONDS)
+        with Session(engine) as session:
+            session.exec(
+                delete(JobRecord).where(
+                    col(JobRecord.status).in_(_values(FINISHED_STATUSES)),
+                    JobRecord.updated_at < cutoff,
+                )
+            )
+            session.commit()
+
+
+def _values(statuses) -> List[str]:
+    return [status.value for status in statuses]
+
+
+job_queue = JobQueue()
@@ -1,30 +1,112 @@
-import os
-from pathlib import Path
+import time
 
-from dotenv import load_dotenv
-from fastapi import FastAPI, Request
-import logging
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+# time our own imports, reported once the app starts
+_import_started = time.perf_counter()
 
-from exceptions import (
+from contextlib import asynccontextmanager  # noqa: E402
+from pathlib import Path  # noqa: E402
+
+from dotenv import load_dotenv  # noqa: E402
+from fastapi import FastAPI, Request  # noqa: E402
+import logging  # noqa: E402
+from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
+from fastapi.middleware.gzip import GZipMiddleware  # noqa: E402
+from fastapi.responses import JSONResponse, PlainTextResponse  # noqa: E402
+
+# env path is located in this directory, and has to be loaded before our own
+# modules are imported, since they read their settings at import time
+BASE_DIR = Path(__file__).resolve().parent
+env_path = BASE_DIR / ".env"
+load_dotenv(dotenv_path=env_path)
+
+from exceptions import (  # noqa: E402
+    ExecutorBusyException,
     FileNotFoundException,
     FileProcessingError,
+    FileTooLargeException,
     InsightsNotFoundException,
     InvalidFileTypeException,
+    InvalidUploadPartException,
+    JobNotFoundException,
+    JobQueueFullException,
+    SheetNotFoundException,
+    UploadIncompleteException,
+    UploadNotFoundException,
+)
+from config.core import (  # noqa: E402
+    GZIP_MINIMUM_SIZE,
+    WARM_UP_ON_STARTUP,
+    create_db_and_tables,
 )
-from routes import router as api_router
+from executors import shutdown_executors, warm_process_pool  # noqa: E402
+from jobs import job_queue  # noqa: E402
+from mcp_client import aclose_client, init_clients  # noqa: E402
+from metrics import RequestContextMiddleware, RequestIdFilter, render  # noqa: E402
+from routes import router as api_router  # noqa: E402
+from startup import warm_up  # noqa: E402
+from storage import storage_sweeper  # noqa: E402
+from utils import UploadSizeLimitMiddleware, ensure_media_dirs  # noqa: E402
 
-# env path is located in this directory
-BASE_DIR = Path(__file__).resolve().parent
-env_path = BASE_DIR / ".env"
-load_dotenv(dotenv_path=env_path)
+IMPORT_SECONDS = time.perf_counter() - _import_started
 
-print("OPENROUTER_API_KEY:", os.getenv("OPENROUTER_API_KEY"))
+logger = logging.getLogger(__name__)
 
 
-app = FastAPI(title="AI-powered Insights Cloud", version="1.0.0")
-logging.basicConfig(level=logging.INFO)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    ensure_media_dirs()
+    create_db_and_tables()
+    # the insight workers live as long as the app does
+    await job_queue.start()
+    await storage_sweeper.start()
+    if WARM_UP_ON_STARTUP:
+        # import pandas, openai & co., create the model clients and start the
+        # parsing processes in the background, instead of holding up startup
+        warm_up(after=_warm_up_workers)
+    else:
+        init_clients()
+    logger.info(
+        "Started in %.2fs (imports %.2fs)",
+        IMPORT_SECONDS + time.perf_counter() - started,
+        IMPORT_SECONDS,
+    )
+    yield
+    await storage_sweeper.stop()
+    await job_queue.stop()
+    await aclose_client()
+    shutdown_executors()
+
+
+def _warm_up_workers():
+    init_clients()
+    warm_process_pool()
+
+
+try:
+    # orjson renders JSON several times faster than the standard library,
+    # use it for responses when it's installed
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:
+    DefaultResponse = JSONResponse
+
+app = FastAPI(
+    title="AI-powered Insights Cloud",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=DefaultResponse,
+)
+logging.basicConfig(
+    level=logging.INFO, format="%(levelname)s:%(name)s:[%(request_id)s] %(message)s"
+)
+# tie the log lines written for a request together with its ID
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
+
+# turn away oversized uploads before Starlette spools them, inside CORS so
+# that browsers can read the 413
+app.add_middleware(UploadSizeLimitMiddleware, path="/api/upload")
 
 # cors
 app.add_middleware(
@@ -35,6 +117,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Server-Sent Events are left alone, NDJSON streams are flushed line by line
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
+app.add_middleware(RequestContextMiddleware)
+
 app.include_router(api_router, prefix="/api")
 
 
@@ -45,6 +132,14 @@ def root():
     }
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Stage timings and counters, in the Prometheus text format.
+    """
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
 # Our Helper Error Hndlers
 
 
@@ -78,6 +173,84 @@ async def invalid_file_type_exception_handler(
     )
 
 
+@app.exception_handler(SheetNotFoundException)
+async def sheet_not_found_exception_handler(
+    request: Request, exc: SheetNotFoundException
+):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+    )
+
+
+@app.exception_handler(FileTooLargeException)
+async def file_too_large_exception_handler(
+    request: Request, exc: FileTooLargeException
+):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+    )
+
+
+@app.exception_handler(JobNotFoundException)
+async def job_not_found_exception_handler(request: Request, exc: JobNotFoundException):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+    )
+
+
+@app.exception_handler(JobQueueFullException)
+async def job_queue_full_exception_handler(
+    request: Request, exc: JobQueueFullException
+):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+    )
+
+
+@app.exception_handler(ExecutorBusyException)
+async def executor_busy_exception_handler(
+    request: Request, exc: ExecutorBusyException
+):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+    )
+
+
+@app.exception_handler(UploadNotFoundException)
+async def upload_not_found_exception_handler(
+    request: Request, exc: UploadNotFoundException
+):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+    )
+
+
+@app.exception_handler(InvalidUploadPartException)
+async def invalid_upload_part_exception_handler(
+    request: Request, exc: InvalidUploadPartException
+):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+    )
+
+
+@app.exception_handler(UploadIncompleteException)
+async def upload_incomplete_exception_handler(
+    request: Request, exc: UploadIncompleteException
+):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+    )
+
+
 @app.exception_handler(FileProcessingError)
 async def file_processing_error_handler(request: Request, exc: FileProcessingError):
     return JSONResponse(
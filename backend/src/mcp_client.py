@@ -1,23 +1,374 @@
+import asyncio
 import json
 import os
-import re
-from typing import Any
+import random
+import threading
+from typing import TYPE_CHECKING, Any, AsyncIterator, List, Optional, Tuple
 
 from fastapi.logger import logger
-from openai import OpenAI
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1", api_key=os.getenv("OPENROUTER_API_KEY")
+from cache import llm_cache, make_cache_key
+from config.core import (
+    LLM_BACKOFF_BASE,
+    LLM_BACKOFF_MAX,
+    LLM_CONCURRENCY,
+    LLM_CONNECT_TIMEOUT,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_RETRIES,
+    LLM_REASK_ATTEMPTS,
+    LLM_TIMEOUT,
+    OPENROUTER_BASE_URL,
 )
+from extraction import InsightStreamParser, extract_insights
+from metrics import LLM_ERRORS, LLM_REQUESTS, PROMPT_TOKENS, timed
+from routing import llm_router
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+EXTRA_HEADERS = {
+    "HTTP-Referer": "http://localhost:8000",
+    "X-Title": "AI Insights Generator",
+}
+
+# The clients are created when the app starts (see `init_clients`), or by
+# whichever request needs one first, not when this module is imported: the
+# openai package alone takes the better part of a second to import.
+_client: Optional["OpenAI"] = None
+_client_lock = threading.Lock()
+
+# The async client shares one pooled HTTP connection set across all requests,
+# and the semaphore caps how many completions we have in flight at once, so a
+# burst of jobs queues up here instead of piling onto the upstream. Both are
+# created on first use, inside the app's event loop.
+_async_client: Optional["AsyncOpenAI"] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def init_clients() -> None:
+    """Create the model clients up front, so the first request doesn't have to."""
+    get_client()
+    get_async_client()
+
+
+def get_client() -> "OpenAI":
+    global _client
+    with _client_lock:
+        if _client is None:
+            import httpx
+            from openai import OpenAI
+
+            _client = OpenAI(
+                base_url=OPENROUTER_BASE_URL,
+                api_key=os.getenv("OPENROUTER_API_KEY"),
+                timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                max_retries=LLM_MAX_RETRIES,
+            )
+    return _client
+
+
+def get_async_client() -> "AsyncOpenAI":
+    global _async_client
+    with _client_lock:
+        if _async_client is None:
+            import httpx
+            from openai import AsyncOpenAI
+
+            _async_client = AsyncOpenAI(
+                base_url=OPENROUTER_BASE_URL,
+                api_key=os.getenv("OPENROUTER_API_KEY"),
+                # retries are handled by `_complete_with_retries` so the backoff
+                # happens outside the concurrency limit
+                max_retries=0,
+                http_client=httpx.AsyncClient(
+                    timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                    ),
+                ),
+            )
+    return _async_client
+
+
+def get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    with _client_lock:
+        if _semaphore is None:
+            _semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    return _semaphore
+
+
+async def aclose_client() -> None:
+    global _client, _async_client, _semaphore
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+    # bound to the loop that is closing, like the async client
+    _semaphore = None
+    if _client is not None:
+        _client.close()
+        _client = None
 
 
 def generate_ai_insights(prompt: Any):
     """
-    Generate AI insights using the DeepSeek Chimera model via OpenRouter API.
+    Generate AI insights using the models of `LLM_MODELS` via OpenRouter API.
 
     This function sends a prompt to the model and returns the generated insights,
     which can be used to analyze data or provide recommendations but its stored locally
     at the moment as JSON.
+
+    Responses are cached on the model pool and prompt, so an identical prompt
+    is answered from the cache instead of the model. The prompt goes to the
+    model `routing` ranks first, without hedging.
+    """
+    full_prompt = build_prompt(prompt)
+    key = make_cache_key(llm_router.cache_namespace, full_prompt)
+
+    cached = llm_cache.get(key)
+    if cached is not None:
+        logger.info("[LLM] Answered from the response cache")
+        return parse_ai_response(cached)
+
+    model = llm_router.rank(_count_prompt_tokens(full_prompt))[0]
+    messages = [{"role": "user", "content": full_prompt}]
+    for attempt in range(LLM_REASK_ATTEMPTS + 1):
+        LLM_REQUESTS.inc(model=model)
+        try:
+            with timed("llm"), llm_router.track(model):
+                response = get_client().chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    extra_headers=EXTRA_HEADERS,
+                )
+        except Exception as e:
+            LLM_ERRORS.inc(reason=e.__class__.__name__)
+            raise
+        logger.debug(f"AI Response: \n{response}")
+        raw_response = response.choices[0].message.content
+        try:
+            insights = parse_ai_response(raw_response)
+            break
+        except ValueError:
+            if attempt == LLM_REASK_ATTEMPTS:
+                raise
+            logger.warning("[LLM] Nothing to salvage from the response, asking again")
+            messages = build_reask_messages(full_prompt, raw_response)
+    llm_cache.set(key, model, raw_response)
+    return insights
+
+
+async def agenerate_ai_insights(prompt: Any, count: int = 3):
+    """
+    Async variant of `generate_ai_insights`, using the pooled async client.
+
+    Requests time out after `LLM_TIMEOUT` seconds, and rate limits (429),
+    upstream errors (5xx), timeouts and dropped connections are retried with
+    exponential backoff. Slow or failing models are hedged on, or replaced
+    by, another model of the pool, see `routing`.
+    """
+    return await _acomplete_cached(build_prompt(prompt, count))
+
+
+async def areduce_ai_insights(candidates: List[dict], count: int = 3):
+    """
+    Merge insights generated for separate chunks of a file into the `count`
+    most important ones (the reduce step of map-reduce generation).
+    """
+    return await _acomplete_cached(build_reduce_prompt(candidates, count))
+
+
+async def _acomplete_cached(full_prompt: str):
+    key = make_cache_key(llm_router.cache_namespace, full_prompt)
+
+    cached = await llm_cache.aget(key)
+    if cached is not None:
+        logger.info("[LLM] Answered from the response cache")
+        return parse_ai_response(cached)
+
+    async def complete(model: str):
+        response = await _complete_with_retries(
+            model, [{"role": "user", "content": full_prompt}]
+        )
+        logger.debug(f"AI Response ({model}): \n{response}")
+        raw_response, insights = await _aparse_or_reask(
+            model, full_prompt, response.choices[0].message.content
+        )
+        return model, raw_response, insights
+
+    # an answer only wins the race once it parses
+    model, raw_response, insights = await llm_router.race(
+        complete, _count_prompt_tokens(full_prompt)
+    )
+    await llm_cache.aset(key, model, raw_response)
+    return insights
+
+
+async def _aparse_or_reask(model: str, full_prompt: str, raw_response: str):
+    # re-asking costs another round-trip, so only do it when not a single
+    # insight could be salvaged from the answer we already paid for
+    for attempt in range(LLM_REASK_ATTEMPTS + 1):
+        try:
+            return raw_response, parse_ai_response(raw_response)
+        except ValueError:
+            if attempt == LLM_REASK_ATTEMPTS:
+                raise
+            logger.warning("[LLM] Nothing to salvage from the response, asking again")
+            response = await _complete_with_retries(
+                model, build_reask_messages(full_prompt, raw_response)
+            )
+            raw_response = response.choices[0].message.content
+
+
+async def astream_ai_insights(
+    prompt: Any, count: int = 3
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Streaming variant of `agenerate_ai_insights`.
+
+    Yields `("token", {"text": ..., "reasoning": ...})` for every piece of the
+    completion (and of the model's reasoning, when it streams one) and
+    `("insight", dict)` as soon as an insight object has been written in full.
+
+    Opening the stream is retried like any other request, moving on to the
+    next model of the pool (see `routing`) on every retry, but once tokens
+    have been forwarded a failure is raised as is, since replaying the
+    completion would send them twice. Streams aren't hedged, for the same
+    reason.
+    """
+    full_prompt = build_prompt(prompt, count)
+    key = make_cache_key(llm_router.cache_namespace, full_prompt)
+
+    cached = await llm_cache.aget(key)
+    if cached is not None:
+        logger.info("[LLM] Answered from the response cache")
+        for item in parse_ai_response(cached):
+            yield "insight", item
+        return
+
+    models = llm_router.rank(_count_prompt_tokens(full_prompt))
+    parser = InsightStreamParser()
+    content: List[str] = []
+    emitted = 0
+    attempt = 0
+    while True:
+        model = models[attempt % len(models)]
+        LLM_REQUESTS.inc(model=model)
+        stream = None
+        try:
+            # the slot is held until the stream is drained
+            async with get_semaphore():
+                with timed("llm"):
+                    # the model is only timed on opening the stream: how long
+                    # the rest takes depends on how fast our client reads it
+                    with llm_router.track(model):
+                        stream = await get_async_client().chat.completions.create(
+                            model=model,
+                            messages=[{"role": "user", "content": full_prompt}],
+                            extra_headers=EXTRA_HEADERS,
+                            stream=True,
+                        )
+                    async with stream:
+                        async for chunk in stream:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta
+                            reasoning = getattr(delta, "reasoning", None)
+                            if reasoning:
+                                yield "token", {"text": reasoning, "reasoning": True}
+                            if delta.content:
+                                content.append(delta.content)
+                                yield "token", {"text": delta.content, "reasoning": False}
+                                for item in parser.feed(delta.content):
+                                    emitted += 1
+                                    yield "insight", item
+            break
+        except Exception as e:
+            if stream is not None:
+                # the stream broke off after opening
+                llm_router.record(model, None)
+            LLM_ERRORS.inc(reason=e.__class__.__name__)
+            if content or not _is_retryable(e) or attempt >= LLM_MAX_RETRIES:
+                raise
+            delay = _backoff_delay(e, attempt)
+            logger.warning(
+                f"[LLM] Stream from {model} failed ({e.__class__.__name__}), "
+                f"retrying in {delay:.1f}s"
+            )
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    if emitted:
+        await llm_cache.aset(key, model, "".join(content))
+        return
+    # nothing was streamed: the answer may be a bare object, or need asking again
+    raw_response, insights = await _aparse_or_reask(model, full_prompt, "".join(content))
+    for item in insights:
+        yield "insight", item
+    await llm_cache.aset(key, model, raw_response)
+
+
+def _count_prompt_tokens(full_prompt: str) -> int:
+    from sampling import estimate_tokens
+
+    tokens = estimate_tokens(full_prompt)
+    PROMPT_TOKENS.inc(tokens)
+    return tokens
+
+
+def _is_retryable(exc: Exception) -> bool:
+    import openai
+
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return False
+
+
+def _backoff_delay(exc: Exception, attempt: int) -> float:
+    # honour the upstream's Retry-After when it gives us one
+    response = getattr(exc, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_BACKOFF_MAX)
+        except ValueError:
+            pass
+    delay = min(LLM_BACKOFF_BASE * 2**attempt, LLM_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+
+async def _complete_with_retries(model: str, messages: List[dict]):
+    attempt = 0
+    while True:
+        LLM_REQUESTS.inc(model=model)
+        try:
+            async with get_semaphore():
+                with timed("llm"), llm_router.track(model):
+                    return await get_async_client().chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        extra_headers=EXTRA_HEADERS,
+                    )
+        except Exception as e:
+            LLM_ERRORS.inc(reason=e.__class__.__name__)
+            if not _is_retryable(e) or attempt >= LLM_MAX_RETRIES:
+                raise
+            delay = _backoff_delay(e, attempt)
+            logger.warning(
+                f"[LLM] Request to {model} failed ({e.__class__.__name__}), "
+                f"retrying in {delay:.1f}s"
+            )
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+def build_prompt(prompt: Any, count: int = 3) -> str:
+    """
+    Wrap the file content (a string, or DataFrame-like object) in our
+    instructions to the model.
     """
     # it would look at the rows of the file and generate insights based on the information
     # of the file, which is passed as a prompt.
@@ -34,62 +385,81 @@ def generate_ai_insights(prompt: Any):
         raise ValueError("Prompt must be a string or a DataFrame-like object.")
 
     full_prompt = f"""
-    Analyze the following data and return 3 insights in strict JSON format.
+    Analyze the following data and return {count} insights in strict JSON format.
 
     Each insight must contain:
     - title (str)
     - description (str)
     - confidence_score (float)
-    - reference_rows (list[int])
+    - reference_rows (list[int]): the `row` numbers of the sample rows it is based on
 
     Respond ONLY with raw JSON.
 
     Data:
     {prompt}
     """
-    response = client.chat.completions.create(
-        model="tngtech/deepseek-r1t2-chimera:free",
-        messages=[
-            {
-                "role": "user",
-                "content": full_prompt,
-            }
-        ],
-        extra_headers={
-            "HTTP-Referer": "http://localhost:8000",
-            "X-Title": "AI Insights Generator",
-        },
-    )
-    raw_response = response.choices[0].message.content
-    logger.debug(f"AI Response: \n{response}")
-
-    # now that we got back something like:
-    #
-    # blablabla
-    #
-    # ###
-    #
-    # [
-    #   {
-    #   i      jadjgakt...
-    #   }
-    #
-    # ]
-
-    # if we encounter code blockers, stript those out first
-    try:
-        # Handle code block markdown: ```json ... ```
-        match = re.search(r"```(?:json)?\s*(\[.*?\])\s*```", raw_response, re.DOTALL)
-        json_str = match.group(1) if match else raw_response.strip()
-
-        # then clean-up: strip stray characters before `[` or after `]`
-        json_str = json_str.strip()
-        json_str = re.sub(r"^[^\[]*", "", json_str)  # left trim garbage before first [
-        json_str = re.sub(r"[^\]]*$", "", json_str)  # right trim garbage after last ]
-
-        insights = json.loads(json_str)
-        return insights
-
-    except json.JSONDecodeError as e:
-        logger.error(f"[ERROR] Failed to decode JSON from LLM: {e}")
+    return full_prompt
+
+
+def build_reduce_prompt(candidates: List[dict], count: int = 3) -> str:
+    """
+    Ask the model to merge per-chunk insights into a final ranked set.
+    """
+    full_prompt = f"""
+    The following insights were generated independently for different chunks
+    of the same dataset. Row numbers in reference_rows are global to the dataset.
+
+    Merge duplicate or overlapping insights, rank them by importance and
+    confidence, and return the top {count} insights in strict JSON format.
+
+    Each insight must contain:
+    - title (str)
+    - description (str)
+    - confidence_score (float)
+    - reference_rows (list[int]): taken from the candidate insights it merges
+
+    Respond ONLY with raw JSON.
+
+    Candidate insights:
+    {json.dumps(candidates)}
+    """
+    return full_prompt
+
+
+REASK_CONTEXT_CHARS = 8000
+REASK_PROMPT = """
+    Your previous answer could not be parsed. Reply again with ONLY a raw JSON
+    array of insights, each an object with title (str), description (str),
+    confidence_score (float) and reference_rows (list[int]). No reasoning, no
+    code fences and no text before or after the array.
+    """
+
+
+def build_reask_messages(full_prompt: str, raw_response: str) -> List[dict]:
+    """
+    Follow-up conversation asking the model to restate an unusable answer.
+    """
+    # the tail of the answer is where the (broken) JSON is, the reasoning
+    # before it would only eat into the context
+    previous = (raw_response or "")[-REASK_CONTEXT_CHARS:]
+    return [
+        {"role": "user", "content": full_prompt},
+        {"role": "assistant", "content": previous},
+        {"role": "user", "content": REASK_PROMPT},
+    ]
+
+
+def parse_ai_response(raw_response: str):
+    """
+    Pull the insights out of the raw model response, see `extraction`.
+
+    Malformed or truncated insights are skipped, and the rest kept; a
+    ValueError is raised only when not a single valid insight is found.
+    """
+    with timed("json_parse"):
+        insights = extract_insights(raw_response or "")
+    if not insights:
+        LLM_ERRORS.inc(reason="unparseable")
+        logger.error("[ERROR] No valid insights found in the LLM response")
         raise ValueError("Failed to parse AI response as JSON.")
+    return insights
@@ -0,0 +1,359 @@
+"""
+Metrics and request tracing.
+
+A small, dependency-free take on Prometheus metrics: counters and histograms
+kept in memory and rendered in the Prometheus text format on `/metrics`.
+
+- `timed(stage)` times one stage of the pipeline (save, parse, prompt, llm,
+  json_parse, persist, ...) into the `insights_stage_duration_seconds`
+  histogram.
+- `RequestContextMiddleware` gives every request an ID (the caller's
+  `X-Request-ID`, or a fresh one), which is echoed back in the response and
+  added to every log line written while handling the request, and times the
+  request per route.
+
+With `METRICS_ENABLED=false` nothing is recorded: timers and counters return
+straight away, so the instrumentation costs next to nothing.
+"""
+
+import bisect
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from config.core import METRICS_ENABLED
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0
+)
+
+_DISABLED = nullcontext()
+
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+_registry: List["_Metric"] = []
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], **extra: str) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples(),
+        ]
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def _drain(self) -> dict:
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in values.items()]
+
+    def _merge(self, values: dict) -> None:
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in values.items()]
+
+    def _drain(self) -> dict:
+        # a gauge is the state of one process, there is nothing to hand over
+        return {}
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: a count per bucket (plus +Inf), the sum and the count
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        if not METRICS_ENABLED:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = {key: (list(c), t[0]) for key, (c, t) in self._values.items()}
+        lines = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{self._labels(key, le=le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+    def _merge(self, values: dict) -> None:
+        with self._lock:
+            for key, (counts, total) in values.items():
+                mine, my_total = self._values.setdefault(
+                    key, ([0] * (len(self.buckets) + 1), [0.0])
+                )
+                for i, count in enumerate(counts):
+                    mine[i] += count
+                my_total[0] += total[0]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+STAGE_SECONDS = Histogram(
+    "insights_stage_duration_seconds",
+    "Time spent in each stage of uploading and processing files.",
+    ["stage"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "insights_http_request_duration_seconds",
+    "Time spent handling HTTP requests.",
+    ["method", "route", "status"],
+)
+UPLOADED_BYTES = Counter(
+    "insights_uploaded_bytes_total", "Bytes of files uploaded.", ["file_type"]
+)
+ROWS_PARSED = Counter(
+    "insights_rows_parsed_total", "Rows (or lines) parsed out of uploaded files."
+)
+PROMPT_TOKENS = Counter(
+    "insights_prompt_tokens_total", "Estimated tokens of the prompts sent to the model."
+)
+LLM_REQUESTS = Counter(
+    "insights_llm_requests_total", "Completions requested, per model.", ["model"]
+)
+LLM_HEDGES = Counter(
+    "insights_llm_hedged_requests_total",
+    "Requests sent to a second model as well, by which of them answered first.",
+    ["winner"],
+)
+LLM_MODEL_LATENCY = Gauge(
+    "insights_llm_model_latency_seconds",
+    "Moving average of each model's latency, as used for routing.",
+    ["model"],
+)
+LLM_MODEL_ERROR_RATE = Gauge(
+    "insights_llm_model_error_rate",
+    "Moving average of the share of each model's requests that failed.",
+    ["model"],
+)
+LLM_ERRORS = Counter(
+    "insights_llm_errors_total",
+    "Failed completions (including ones retried) and unparseable responses.",
+    ["reason"],
+)
+EXECUTOR_TASKS = Gauge(
+    "insights_executor_tasks",
+    "Tasks running or waiting on each executor.",
+    ["executor"],
+)
+EXECUTOR_QUEUE_WAIT_SECONDS = Histogram(
+    "insights_executor_queue_wait_seconds",
+    "Time tasks waited for a worker of each executor.",
+    ["executor"],
+)
+EXECUTOR_REJECTIONS = Counter(
+    "insights_executor_rejections_total",
+    "Tasks turned away because an executor's queue was full.",
+    ["executor"],
+)
+
+
+def timed(stage: str):
+    """Time a stage of the pipeline: `with timed("parse"): ...`."""
+    if not METRICS_ENABLED:
+        return _DISABLED
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def render() -> str:
+    """All metrics, in the Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    lines.extend(_cache_samples())
+    return "\n".join(lines) + "\n"
+
+
+def drain() -> Dict[str, dict]:
+    """
+    Take (and reset) everything recorded in this process so far, to be
+    `merge`d into the metrics of another one: pool workers hand theirs back
+    to the app process this way, see `executors.run_cpu_bound`.
+    """
+    return {metric.name: metric._drain() for metric in _registry}
+
+
+def merge(values: Dict[str, dict]) -> None:
+    """Add up metrics `drain`ed in another process."""
+    for metric in _registry:
+        if values.get(metric.name):
+            metric._merge(values[metric.name])
+
+
+def _cache_samples() -> List[str]:
+    # the response cache keeps its own counters, reported as they are
+    from cache import llm_cache
+
+    name = "insights_llm_cache_events_total"
+    lines = [
+        f"# HELP {name} Lookups and evictions of the LLM response cache.",
+        f"# TYPE {name} counter",
+    ]
+    for stat, value in llm_cache.stats().items():
+        tier, _, event = stat.partition("_")
+        if tier in ("memory", "disk") and event != "entries":
+            lines.append(f'{name}{{tier="{tier}",event="{event}"}} {value}')
+    return lines
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the ID of the request being handled (or "-") to log records."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get() or "-"
+        return True
+
+
+class RequestContextMiddleware:
+    """
+    ASGI middleware assigning request IDs and timing requests per route.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = _header(scope, b"x-request-id") or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            if METRICS_ENABLED:
+                # label with the route template, not the path, to keep the
+                # number of label sets bounded
+                HTTP_REQUEST_SECONDS.observe(
+                    time.perf_counter() - start,
+                    method=scope["method"],
+                    route=_route_template(scope),
+                    status=str(status),
+                )
+            request_id_var.reset(token)
+
+
+def _route_template(scope) -> str:
+    # FastAPI matches the routes of included routers against their own
+    # template, which leaves out the prefix they were included with; the
+    # full template is kept alongside
+    context = scope.get("fastapi", {}).get("effective_route_context")
+    if getattr(context, "path_format", None):
+        return context.path_format
+    return getattr(scope.get("route"), "path", "unmatched")
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", []):
+        if key == name:
+            # only trust something that looks like an ID
+            value = value.decode("latin-1")[:64]
+            return value if value.replace("-", "").isalnum() else None
+    return None
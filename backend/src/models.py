@@ -1,3 +1,7 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import JSON, Column, Index
 from sqlmodel import Field, SQLModel
 
 
@@ -6,17 +10,218 @@ class Insight(SQLModel, table=True):
     Represents an AI-generated insight for a file.
 
     Attributes:
-        id (int): Unique identifier for the insight.
-        file_id (int): Identifier of the file associated with the insight.
+        id (int): Unique identifier for the insight, also its rank within the file.
+        file_id (str): Identifier of the file associated with the insight.
         title (str): Title of the insight.
         description (str): Description of the insight.
         confidence_score (float): Confidence score of the insight.
-        reference_rows (list[int]): List of row indices that the insight references.
+        reference_rows (list[int]): List of row indices that the insight references,
+            stored as a JSON array.
+        sheet (str): The workbook sheet the insight is about, if generated per sheet.
+        created_at (datetime): When the insight was stored.
     """
 
+    # most reads filter a file's insights and sort/filter them on confidence
+    __table_args__ = (
+        Index("ix_insight_file_id_confidence", "file_id", "confidence_score"),
+    )
+
     id: int = Field(default=None, primary_key=True)
-    file_id: int = Field(index=True, nullable=False)
+    file_id: str = Field(index=True, max_length=64, nullable=False)
     title: str = Field(max_length=255, nullable=False)
     description: str = Field(max_length=1000, nullable=False)
-    confidence_score: float = Field(ge=0.0, le=1.0, nullable=False)
-    reference_rows: list[int] = Field(default_factory=list, nullable=False)
+    confidence_score: float = Field(ge=0.0, le=1.0, index=True, nullable=False)
+    reference_rows: list[int] = Field(
+        default_factory=list, sa_column=Column(JSON, nullable=False)
+    )
+    sheet: Optional[str] = Field(default=None, max_length=64)
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), nullable=False
+    )
+
+
+class LLMCacheEntry(SQLModel, table=True):
+    """
+    A cached LLM completion, see `cache.DiskCache`.
+
+    Attributes:
+        key (str): Hash of the model name and the full prompt.
+        model (str): Model that produced the response.
+        response (str): Raw completion text.
+        created_at (float): Unix timestamp the entry was stored at.
+    """
+
+    __tablename__ = "llm_cache"
+
+    key: str = Field(primary_key=True, max_length=64)
+    model: str = Field(max_length=255, nullable=False)
+    response: str = Field(nullable=False)
+    created_at: float = Field(index=True, nullable=False)
+
+
+class FileRecord(SQLModel, table=True):
+    """
+    Metadata of an uploaded file, see `file_index.FileIndex`.
+
+    Attributes:
+        file_id (str): Identifier of the file.
+        path (str): Where the file is stored.
+        file_type (str): Type detected from the file content (csv, xlsx, ...).
+        size (int): Size of the file in bytes.
+        sha256 (str): Hex digest of the file content.
+        row_count (int): Number of data rows (or lines), when known.
+        column_count (int): Number of columns, for tabular files.
+        profile (list[dict]): Per-column statistics of tabular files, see
+            `profiling.profile_chunks`.
+        stored_size (int): Bytes the file takes on disk, with its columnar
+            cache and once compressed, see `storage`.
+        compressed (bool): Whether the original is stored compressed.
+        created_at (datetime): When the file was uploaded.
+        accessed_at (datetime): When the file was last looked up, to within
+            `file_index.ACCESS_RESOLUTION` seconds.
+    """
+
+    __tablename__ = "file"
+
+    file_id: str = Field(primary_key=True, max_length=64)
+    path: str = Field(nullable=False)
+    file_type: str = Field(max_length=16, nullable=False)
+    size: int = Field(nullable=False)
+    sha256: Optional[str] = Field(default=None, max_length=64, index=True)
+    row_count: Optional[int] = None
+    column_count: Optional[int] = None
+    profile: Optional[list[dict]] = Field(default=None, sa_column=Column(JSON))
+    stored_size: Optional[int] = None
+    compressed: Optional[bool] = None
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), nullable=False
+    )
+    accessed_at: Optional[datetime] = None
+
+
+class UploadSession(SQLModel, table=True):
+    """
+    A resumable upload in progress, see `uploads`.
+
+    Attributes:
+        id (str): Identifier of the upload.
+        filename (str): Name of the file being uploaded.
+        size (int): Size of the whole file in bytes.
+        part_size (int): Size of every part but the last.
+        status (str): One of uploading, completing.
+        created_at (datetime): When the upload was started.
+        updated_at (datetime): When a part was last received.
+    """
+
+    __tablename__ = "upload"
+
+    id: str = Field(primary_key=True, max_length=32)
+    filename: str = Field(max_length=255, nullable=False)
+    size: int = Field(nullable=False)
+    part_size: int = Field(nullable=False)
+    status: str = Field(max_length=16, nullable=False)
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), nullable=False
+    )
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), index=True, nullable=False
+    )
+
+
+class UploadWrite(SQLModel, table=True):
+    """
+    A part of a resumable upload being written right now: a lease, renewed as
+    the part streams in, that keeps the upload from being completed under it.
+
+    A lease not renewed for `UPLOAD_WRITE_LEASE_SECONDS` (its writer crashed,
+    say) no longer counts.
+
+    Attributes:
+        id (str): Identifier of the lease.
+        upload_id (str): The upload the part belongs to.
+        part_number (int): Position of the part, from 1.
+        writing_since (datetime): When the lease was last renewed.
+    """
+
+    __tablename__ = "upload_write"
+
+    id: str = Field(primary_key=True, max_length=32)
+    upload_id: str = Field(max_length=32, index=True, nullable=False)
+    part_number: int = Field(nullable=False)
+    writing_since: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), nullable=False
+    )
+
+
+class UploadPart(SQLModel, table=True):
+    """
+    A part of a resumable upload that was received (and verified).
+
+    Parts get rows of their own, rather than a list on the upload, so parts
+    arriving in parallel never overwrite each other's bookkeeping.
+
+    Attributes:
+        upload_id (str): The upload the part belongs to.
+        part_number (int): Position of the part, from 1.
+        size (int): Size of the part in bytes.
+        sha256 (str): Hex digest of the part.
+        created_at (datetime): When the part was received.
+    """
+
+    __tablename__ = "upload_part"
+
+    upload_id: str = Field(primary_key=True, max_length=32)
+    part_number: int = Field(primary_key=True)
+    size: int = Field(nullable=False)
+    sha256: str = Field(max_length=64, nullable=False)
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), nullable=False
+    )
+
+
+class JobRecord(SQLModel, table=True):
+    """
+    An insight generation job, see `jobs.JobQueue`.
+
+    Jobs live in the database rather than in memory, so whichever worker
+    process a client polls can report on a job, and any worker can run it.
+
+    Attributes:
+        id (str): Identifier of the job.
+        file_id (str): The file insights are generated for.
+        mode (str): Generation mode, see `services.agenerate_insights`.
+        sheets (list[str]): Workbook sheets to generate insights for, one by one.
+        status (str): One of queued, running, succeeded, failed, cancelled.
+        attempts (int): How many times generation has been attempted.
+        insights (list[dict]): The generated insights, once succeeded.
+        error (str): Why the job failed, if it did.
+        request_id (str): ID of the request that queued the job, for logging.
+        worker (str): The worker process running the job, if any.
+        heartbeat_at (datetime): When that worker last checked in.
+        created_at (datetime): When the job was queued.
+        updated_at (datetime): When the job last changed.
+    """
+
+    __tablename__ = "job"
+    # workers look for the oldest queued (or abandoned) job
+    __table_args__ = (Index("ix_job_status_created_at", "status", "created_at"),)
+
+    id: str = Field(primary_key=True, max_length=32)
+    file_id: str = Field(index=True, max_length=64, nullable=False)
+    mode: Optional[str] = Field(default=None, max_length=16)
+    sheets: Optional[list[str]] = Field(default=None, sa_column=Column(JSON))
+    status: str = Field(max_length=16, nullable=False)
+    attempts: int = Field(default=0, nullable=False)
+    insights: list[dict] = Field(
+        default_factory=list, sa_column=Column(JSON, nullable=False)
+    )
+    error: Optional[str] = None
+    request_id: Optional[str] = Field(default=None, max_length=64)
+    worker: Optional[str] = Field(default=None, max_length=128)
+    heartbeat_at: Optional[datetime] = None
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), nullable=False
+    )
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), nullable=False
+    )
@@ -0,0 +1,308 @@
+"""
+One-pass column profiles of tabular files.
+
+A file is read chunk by chunk, and each column's statistics are folded into
+a fixed-size accumulator, so profiling takes the same memory for a thousand
+rows as for a hundred million:
+
+- type, null and value counts, min, max, mean and standard deviation are
+  exact (the mean and variance are combined across chunks with Chan's
+  parallel algorithm);
+- whether a column holds numbers, dates or anything else is decided by its
+  first chunk with values: later chunks are converted to that, and values
+  that don't convert (say, "n/a" in a column of numbers) are counted but left
+  out of the statistics;
+- distinct counts are estimated with a HyperLogLog sketch (about 1.6% error);
+- quantiles of numeric columns are estimated with a KLL sketch (about 1%
+  rank error);
+- the most frequent values of other columns are kept with Misra-Gries
+  counters, so their counts are exact only up to `TOP_CAPACITY` distinct
+  values, and lower bounds past that.
+"""
+
+import math
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from schemas import ColumnProfile
+
+HLL_PRECISION = 12
+KLL_CAPACITY = 200
+TOP_CAPACITY = 64
+TOP_VALUES = 5
+QUANTILES = {"p5": 0.05, "p25": 0.25, "p50": 0.5, "p75": 0.75, "p95": 0.95}
+RANDOM_SEED = 42
+
+# what `pd.api.types.infer_dtype` calls columns of numbers
+NUMERIC_KINDS = {"integer", "floating", "mixed-integer-float", "decimal"}
+
+
+class HyperLogLog:
+    """Approximate distinct counting over 64-bit hashes of the values."""
+
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, hashes: np.ndarray) -> None:
+        # the first `precision` bits pick a register, which keeps the longest
+        # run of leading zeros (plus one) seen in the remaining bits
+        width = 64 - self.precision
+        index = (hashes >> np.uint64(width)).astype(np.intp)
+        rest = hashes & np.uint64((1 << width) - 1)
+        # below 2**53, so exactly representable as floats
+        bit_length = np.zeros(len(rest))
+        nonzero = rest > 0
+        bit_length[nonzero] = np.floor(np.log2(rest[nonzero].astype(np.float64))) + 1
+        rank = (width - bit_length + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class KLLSketch:
+    """
+    Approximate quantiles: a stack of compactors, where level `h` holds
+    samples of weight 2**h and lower levels get geometrically smaller
+    capacities.
+    """
+
+    def __init__(self, capacity: int = KLL_CAPACITY):
+        self.capacity = capacity
+        self.levels: List[np.ndarray] = [np.empty(0)]
+        self._rng = np.random.default_rng(RANDOM_SEED)
+
+    def add(self, values: np.ndarray) -> None:
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                self._compact(level)
+            level += 1
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.capacity * (2 / 3) ** depth)), 2)
+
+    def _compact(self, level: int) -> None:
+        if level + 1 == len(self.levels):
+            self.levels.append(np.empty(0))
+        items = np.sort(self.levels[level])
+        # with an odd number of items, one stays behind at this level
+        kept = items[len(items) - len(items) % 2 :]
+        promoted = items[self._rng.integers(2) : len(items) - len(kept) : 2]
+        self.levels[level] = kept
+        self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+
+    def quantiles(self, fractions: Iterable[float]) -> List[Optional[float]]:
+        values = np.concatenate(self.levels)
+        if not len(values):
+            return [None for _ in fractions]
+        weights = np.concatenate(
+            [np.full(len(items), 2**level) for level, items in enumerate(self.levels)]
+        )
+        order = np.argsort(values, kind="stable")
+        values, cumulative = values[order], np.cumsum(weights[order])
+        return [
+            float(values[min(np.searchsorted(cumulative, q * cumulative[-1]), len(values) - 1)])
+            for q in fractions
+        ]
+
+
+class ColumnProfiler:
+    """Accumulates the statistics of one column over chunks of it."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.kinds: Dict[str, None] = {}
+        # "numeric", "datetime" or "other", from the first chunk with values
+        self.family: Optional[str] = None
+        # the time zone of a datetime column, None for naive ones
+        self.tz = None
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        # running count, mean and sum of squared deviations of the (finite)
+        # numeric values
+        self.numbers = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.distinct = HyperLogLog()
+        self.quantiles = KLLSketch()
+        self.top: Dict[str, int] = {}
+
+    def add(self, series: pd.Series) -> None:
+        values = series.dropna()
+        self.nulls += len(series) - len(values)
+        if values.empty:
+            return
+        self.count += len(values)
+        kind = _kind(values)
+        if self.family is None:
+            self.family = _family(kind)
+            if self.family == "datetime":
+                self.tz = _tz(values)
+        if self.family == "datetime":
+            values = self._datetimes(values, kind)
+            kind = "datetime"
+        elif self.family == "numeric" and kind not in NUMERIC_KINDS:
+            values = pd.to_numeric(values, errors="coerce").dropna()
+            kind = _kind(values)
+        if values.empty:
+            return
+        self.kinds.setdefault(kind, None)
+
+        if self.family == "numeric":
+            numbers = values.to_numpy(dtype=np.float64)
+            numbers = numbers[np.isfinite(numbers)]
+            self._add_numbers(numbers)
+            # hash numbers as floats, so 1 and 1.0 from different chunks agree
+            self.distinct.add(pd.util.hash_array(numbers))
+            return
+        if self.family == "datetime":
+            self._add_bounds(values.min(), values.max())
+            instants = values.dt.tz_convert(None) if self.tz is not None else values
+            self.distinct.add(
+                pd.util.hash_array(instants.to_numpy(dtype="datetime64[ns]").view(np.int64))
+            )
+            return
+        counts = values.astype(str).value_counts()
+        self._add_top(counts)
+        # only the distinct values need hashing
+        self.distinct.add(pd.util.hash_array(counts.index.to_numpy(dtype=object)))
+
+    def _datetimes(self, values: pd.Series, kind: str) -> pd.Series:
+        # in the column's time zone, so every chunk's bounds compare
+        if kind in NUMERIC_KINDS or kind == "boolean":
+            return values.iloc[:0].astype("datetime64[ns]")
+        if kind == "datetime":
+            stamps = pd.to_datetime(values, utc=True)
+        else:
+            stamps = pd.to_datetime(
+                values.astype(str), errors="coerce", utc=True, format="mixed"
+            ).dropna()
+        return stamps.dt.tz_convert(self.tz)
+
+    def _add_numbers(self, numbers: np.ndarray) -> None:
+        if not len(numbers):
+            return
+        self._add_bounds(float(numbers.min()), float(numbers.max()))
+        # Chan et al.'s update, combining this chunk's mean and M2 with ours
+        seen, added = self.numbers, len(numbers)
+        chunk_mean = float(numbers.mean())
+        chunk_m2 = float(((numbers - chunk_mean) ** 2).sum())
+        self.numbers = seen + added
+        delta = chunk_mean - self.mean
+        self.mean += delta * added / self.numbers
+        self.m2 += chunk_m2 + delta**2 * seen * added / self.numbers
+        self.quantiles.add(numbers)
+
+    def _add_bounds(self, low, high) -> None:
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def _add_top(self, counts: pd.Series) -> None:
+        if self.top:
+            counts = counts.add(pd.Series(self.top, dtype="int64"), fill_value=0)
+        if len(counts) > TOP_CAPACITY:
+            # Misra-Gries: take the (capacity + 1)th largest count off every
+            # counter and drop the ones left at zero
+            floor = counts.nlargest(TOP_CAPACITY + 1).iloc[-1]
+            counts = counts[counts > floor] - floor
+        self.top = {str(value): int(count) for value, count in counts.items()}
+
+    def profile(self) -> ColumnProfile:
+        dtype = _dtype(self.kinds)
+        numeric = dtype in ("int64", "float64") and self.numbers > 0
+        std = math.sqrt(self.m2 / (self.numbers - 1)) if numeric and self.numbers > 1 else None
+        bounds = (self.min, self.max)
+        if dtype == "datetime64":
+            bounds = tuple(value.isoformat() for value in bounds)
+        top = sorted(self.top.items(), key=lambda item: item[1], reverse=True)
+        return ColumnProfile(
+            name=self.name,
+            dtype=dtype,
+            count=self.count,
+            nulls=self.nulls,
+            distinct=min(self.distinct.estimate(), self.count),
+            min=bounds[0],
+            max=bounds[1],
+            mean=self.mean if numeric else None,
+            std=std,
+            quantiles=(
+                dict(zip(QUANTILES, self.quantiles.quantiles(QUANTILES.values())))
+                if numeric
+                else {}
+            ),
+            top=[] if numeric else top[:TOP_VALUES],
+        )
+
+
+def profile_chunks(chunks: Iterable[pd.DataFrame]) -> List[ColumnProfile]:
+    """Profile every column of a table handed over in chunks."""
+    profilers: Dict[str, ColumnProfiler] = {}
+    for chunk in chunks:
+        for name in chunk.columns:
+            column = str(name)
+            if column not in profilers:
+                profilers[column] = ColumnProfiler(column)
+            profilers[column].add(chunk[name])
+    return [profiler.profile() for profiler in profilers.values()]
+
+
+def _kind(values: pd.Series) -> str:
+    dtype = values.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "integer"
+    if pd.api.types.is_float_dtype(dtype):
+        return "floating"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    # object columns: look at the values themselves
+    return pd.api.types.infer_dtype(values, skipna=True)
+
+
+def _family(kind: str) -> str:
+    if kind in NUMERIC_KINDS:
+        return "numeric"
+    if kind == "datetime":
+        return "datetime"
+    return "other"
+
+
+def _tz(values: pd.Series):
+    tz = getattr(values.dtype, "tz", None)
+    if tz is None and values.dtype == object:
+        # a column of datetime objects
+        tz = getattr(values.iloc[0], "tzinfo", None)
+    return tz
+
+
+def _dtype(kinds: Dict[str, None]) -> str:
+    found = set(kinds)
+    if not found:
+        return "empty"
+    if found == {"integer"}:
+        return "int64"
+    if found <= NUMERIC_KINDS:
+        return "float64"
+    if found == {"datetime"}:
+        return "datetime64"
+    if found == {"boolean"}:
+        return "bool"
+    if found == {"string"}:
+        return "string"
+    return found.pop() if len(found) == 1 else "mixed"
@@ -0,0 +1,514 @@
+"""
+Readers that stream uploaded files instead of loading them whole.
+
+Tabular uploads are converted once, at upload time, into a Parquet file next
+to the original (`<file_id>.parquet`). Every later read (previews, sampling,
+map-reduce chunks) goes through that columnar cache: it is memory-mapped and
+only the requested columns and rows are decoded, instead of re-parsing the
+CSV or workbook each time. Without pyarrow installed, or when a file can't be
+converted, we quietly fall back to parsing the original.
+
+Workbooks can hold dozens of sheets, hundreds of columns wide. `list_sheets`
+reads their names and dimensions off the workbook's XML without loading any
+cells, and `read_sheet` streams just the sheet (and columns) asked for, with
+python-calamine when it is installed.
+"""
+
+import importlib.util
+import os
+import posixpath
+import random
+import re
+import zipfile
+from contextlib import contextmanager
+from itertools import islice
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence, Tuple, Union
+from xml.etree import ElementTree
+
+from fastapi.logger import logger
+
+from config.core import EXCEL_ENGINE
+from schemas import SheetInfo
+
+# pandas is imported where it's used, to keep it off the app's startup path
+if TYPE_CHECKING:
+    import pandas as pd
+
+TABULAR_TYPES = {"csv", "xlsx", "xls"}
+WORKBOOK_TYPES = {"xlsx", "xls"}
+CACHE_EXTENSION = ".parquet"
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+WORD_BODY = f"{WORD_NAMESPACE}body"
+WORD_PARAGRAPH = f"{WORD_NAMESPACE}p"
+WORD_TEXT = f"{WORD_NAMESPACE}t"
+
+SHEET_NAMESPACE = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIP_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+PACKAGE_RELATIONSHIP = (
+    "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+)
+CELL_REFERENCE = re.compile(r"([A-Z]+)(\d+)")
+
+
+def parquet_cache_path(path: str) -> str:
+    return os.path.splitext(path)[0] + CACHE_EXTENSION
+
+
+def build_parquet_cache(path: str) -> Optional[str]:
+    """
+    Convert a tabular file into its Parquet cache, returning the cache path.
+
+    CSV files are converted block by block, so memory stays bounded no matter
+    how large the file is. Returns None when the file can't be cached.
+    """
+    cache_path = parquet_cache_path(path)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return None
+
+    tmp_path = cache_path + ".tmp"
+    try:
+        if path.lower().endswith(".csv"):
+            _csv_to_parquet(path, tmp_path)
+        else:
+            _frame_to_parquet(read_sheet(path), tmp_path)
+        os.replace(tmp_path, cache_path)
+        return cache_path
+    except Exception as e:
+        logger.warning(f"[Cache] Could not build columnar cache for {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+
+def _csv_to_parquet(path: str, target: str) -> None:
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    reader = pa_csv.open_csv(path)
+    with pq.ParquetWriter(target, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+
+def _frame_to_parquet(df: "pd.DataFrame", target: str) -> None:
+    try:
+        df.to_parquet(target, index=False)
+    except Exception:
+        # columns mixing e.g. numbers and text can't be typed by Arrow,
+        # store those as strings instead
+        mixed = df.select_dtypes(include="object").columns
+        df[mixed] = df[mixed].astype("string")
+        df.to_parquet(target, index=False)
+
+
+def table_shape(path: str) -> Optional[Tuple[int, int]]:
+    """
+    (rows, columns) of a tabular file, read off its columnar cache's metadata.
+    """
+    cache_path = parquet_cache_path(path)
+    if not os.path.exists(cache_path):
+        return None
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_metadata(cache_path)
+    return metadata.num_rows, metadata.num_columns
+
+
+def read_table(
+    path: str, columns: Optional[List[str]] = None, nrows: Optional[int] = None
+) -> "pd.DataFrame":
+    """
+    Read (the first `nrows` rows of, and only `columns` of) a tabular file,
+    from its columnar cache when there is one.
+    """
+    cache_path = parquet_cache_path(path)
+    if os.path.exists(cache_path):
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(cache_path, memory_map=True)
+        if nrows is None or nrows >= parquet.metadata.num_rows:
+            return parquet.read(columns=columns).to_pandas()
+        return _read_parquet_head(parquet, columns, nrows)
+
+    import pandas as pd
+
+    if path.lower().endswith((".xlsx", ".xls")):
+        return pd.read_excel(path, nrows=nrows, usecols=columns)
+    return pd.read_csv(path, nrows=nrows, usecols=columns)
+
+
+def _read_parquet_head(parquet, columns: Optional[List[str]], nrows: int) -> "pd.DataFrame":
+    import pyarrow as pa
+
+    # batches can come back shorter than asked for at row group boundaries,
+    # so keep decoding until we have enough rows
+    batches = []
+    total = 0
+    for batch in parquet.iter_batches(batch_size=nrows, columns=columns):
+        batches.append(batch)
+        total += batch.num_rows
+        if total >= nrows:
+            break
+    return pa.Table.from_batches(batches).slice(0, nrows).to_pandas()
+
+
+def iter_frame_chunks(path: str, chunksize: int) -> Iterator["pd.DataFrame"]:
+    """
+    Yield a tabular file as DataFrames of at most `chunksize` rows.
+
+    Chunks are indexed by their global (0-based) row number in the file, so
+    row references made against a chunk stay valid for the whole file. Only
+    one chunk is held in memory at a time.
+    """
+    cache_path = parquet_cache_path(path)
+    if os.path.exists(cache_path):
+        yield from _iter_parquet_chunks(cache_path, chunksize)
+        return
+
+    import pandas as pd
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        # pandas keeps counting the index across chunks for us
+        with pd.read_csv(path, chunksize=chunksize) as reader:
+            yield from reader
+    elif ext == ".xlsx":
+        yield from _iter_xlsx_chunks(path, chunksize)
+    elif ext == ".xls":
+        # the legacy format has no streaming reader, so chunk it in memory
+        df = pd.read_excel(path)
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start : start + chunksize]
+    else:
+        raise ValueError(f"Unsupported file type for chunked reading: {ext}")
+
+
+def _iter_parquet_chunks(cache_path: str, chunksize: int) -> Iterator["pd.DataFrame"]:
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    offset = 0
+    parquet = pq.ParquetFile(cache_path, memory_map=True)
+    for batch in parquet.iter_batches(batch_size=chunksize):
+        df = batch.to_pandas()
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        offset += len(df)
+        yield df
+
+
+def _iter_xlsx_chunks(path: str, chunksize: int) -> Iterator["pd.DataFrame"]:
+    from openpyxl import load_workbook
+
+    # read-only mode streams rows off the sheet XML instead of building the
+    # whole workbook in memory
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = _column_names(header)
+
+        offset = 0
+        batch = []
+        for row in rows:
+            batch.append(row[: len(columns)])
+            if len(batch) == chunksize:
+                yield _frame(batch, columns, offset)
+                offset += len(batch)
+                batch = []
+        if batch:
+            yield _frame(batch, columns, offset)
+    finally:
+        workbook.close()
+
+
+def _frame(rows: list, columns: list, offset: int) -> "pd.DataFrame":
+    import pandas as pd
+
+    return pd.DataFrame(
+        rows, columns=columns, index=pd.RangeIndex(offset, offset + len(rows))
+    )
+
+
+def excel_engine(path: str) -> Optional[str]:
+    """
+    The engine to read a workbook with: "calamine" or "openpyxl", or None
+    for legacy .xls files without calamine (left to pandas and xlrd).
+    """
+    if EXCEL_ENGINE == "calamine" or (
+        EXCEL_ENGINE == "auto" and importlib.util.find_spec("python_calamine")
+    ):
+        return "calamine"
+    return None if path.lower().endswith(".xls") else "openpyxl"
+
+
+def list_sheets(path: str) -> List[SheetInfo]:
+    """
+    The sheets of a workbook, with their dimensions when the workbook records
+    them. Only the workbook's index and the first bytes of each sheet are
+    read, no cells.
+    """
+    if path.lower().endswith(".xls"):
+        import pandas as pd
+
+        # the legacy format has no cheap way to the dimensions
+        with pd.ExcelFile(path, engine=excel_engine(path)) as workbook:
+            return [
+                SheetInfo(index=i, name=name)
+                for i, name in enumerate(workbook.sheet_names)
+            ]
+
+    with zipfile.ZipFile(path) as archive:
+        targets = _workbook_relationships(archive)
+        sheets = []
+        with archive.open("xl/workbook.xml") as xml:
+            for _, element in ElementTree.iterparse(xml):
+                if element.tag != f"{SHEET_NAMESPACE}sheet":
+                    continue
+                target = targets.get(element.get(RELATIONSHIP_ID, ""), "")
+                # chart sheets hold no cells
+                if "/worksheets/" not in target:
+                    continue
+                rows, columns = _sheet_dimensions(archive, target)
+                sheets.append(
+                    SheetInfo(
+                        index=len(sheets),
+                        name=element.get("name"),
+                        row_count=rows,
+                        column_count=columns,
+                        hidden=element.get("state", "visible") != "visible",
+                    )
+                )
+    return sheets
+
+
+def _workbook_relationships(archive: zipfile.ZipFile) -> dict:
+    # relationship ID -> path of the part in the archive
+    targets = {}
+    with archive.open("xl/_rels/workbook.xml.rels") as xml:
+        for _, element in ElementTree.iterparse(xml):
+            if element.tag == PACKAGE_RELATIONSHIP:
+                target = element.get("Target", "")
+                targets[element.get("Id")] = (
+                    target.lstrip("/")
+                    if target.startswith("/")
+                    else posixpath.normpath(posixpath.join("xl", target))
+                )
+    return targets
+
+
+def _sheet_dimensions(
+    archive: zipfile.ZipFile, target: str
+) -> Tuple[Optional[int], Optional[int]]:
+    # the <dimension ref="A1:H2001"> element sits before the cells, so stop
+    # parsing as soon as we reach them
+    with archive.open(target) as xml:
+        for _, element in ElementTree.iterparse(xml, events=("start",)):
+            if element.tag == f"{SHEET_NAMESPACE}sheetData":
+                break
+            if element.tag == f"{SHEET_NAMESPACE}dimension":
+                cells = CELL_REFERENCE.findall(element.get("ref", ""))
+                if not cells:
+                    break
+                (first_column, first_row), (last_column, last_row) = cells[0], cells[-1]
+                rows = int(last_row) - int(first_row)  # without the header
+                columns = _column_number(last_column) - _column_number(first_column) + 1
+                return rows, columns
+    return None, None
+
+
+def _column_number(letters: str) -> int:
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord("A") + 1
+    return number
+
+
+def read_sheet(
+    path: str,
+    sheet: Union[str, int] = 0,
+    columns: Optional[Sequence[str]] = None,
+    max_columns: Optional[int] = None,
+    nrows: Optional[int] = None,
+) -> "pd.DataFrame":
+    """
+    Read one sheet of a workbook (by name or position), streaming its rows.
+
+    Only `columns` (names from the header row), or else the first
+    `max_columns` columns, are kept, and reading stops after `nrows` rows.
+    The number of columns the sheet has in all is left in
+    `df.attrs["total_columns"]`.
+    """
+    engine = excel_engine(path)
+    if engine is None:
+        import pandas as pd
+
+        df = pd.read_excel(path, sheet_name=sheet, nrows=nrows)
+        total = len(df.columns)
+        df = df[list(columns)] if columns else df.iloc[:, :max_columns]
+        df.attrs["total_columns"] = total
+        return df
+
+    with _sheet_rows(path, sheet, engine) as rows:
+        header = next(rows, None)
+        names = _column_names(header or ())
+        if columns:
+            missing = [name for name in columns if name not in names]
+            if missing:
+                raise ValueError(f"No such columns in sheet {sheet!r}: {missing}")
+            keep = [names.index(name) for name in columns]
+        else:
+            keep = list(range(len(names)))[:max_columns]
+
+        width = len(names)
+        data = []
+        for row in islice(rows, nrows):
+            # rows can come back shorter than the header when they end in blanks
+            if len(row) < width:
+                row = tuple(row) + (None,) * (width - len(row))
+            data.append([row[i] for i in keep])
+
+    # sheets often carry formatted but empty rows at the end
+    while data and all(value is None or value == "" for value in data[-1]):
+        data.pop()
+    df = _frame(data, [names[i] for i in keep], 0)
+    df.attrs["total_columns"] = len(names)
+    return df
+
+
+@contextmanager
+def _sheet_rows(path: str, sheet: Union[str, int], engine: str) -> Iterator[Iterator[tuple]]:
+    if engine == "calamine":
+        from python_calamine import CalamineWorkbook
+
+        workbook = CalamineWorkbook.from_path(path)
+        try:
+            if isinstance(sheet, int):
+                yield iter(workbook.get_sheet_by_index(sheet).iter_rows())
+            else:
+                yield iter(workbook.get_sheet_by_name(sheet).iter_rows())
+        finally:
+            workbook.close()
+        return
+
+    from openpyxl import load_workbook
+
+    # read-only mode streams rows off the sheet XML instead of building the
+    # whole workbook in memory
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = (
+            workbook.worksheets[sheet] if isinstance(sheet, int) else workbook[sheet]
+        )
+        yield worksheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _column_names(header: Sequence) -> List[str]:
+    return [
+        str(name) if name is not None else f"Unnamed: {i}"
+        for i, name in enumerate(header)
+    ]
+
+
+def iter_text_lines(path: str) -> Iterator[str]:
+    """
+    Lazily yield the lines of a plain text file, line endings included.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        yield from f
+
+
+def iter_docx_paragraphs(path: str) -> Iterator[str]:
+    """
+    Lazily yield the non-empty paragraphs of a Word document.
+
+    `word/document.xml` is parsed incrementally straight out of the zip, and
+    each paragraph is discarded once yielded, so stopping early means the rest
+    of the document is never decompressed or parsed.
+    """
+    with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+        # the elements still open, so finished ones can be detached from
+        # their parent: merely clearing them would leave an empty element
+        # per paragraph hanging off the tree
+        open_elements = []
+        for event, element in ElementTree.iterparse(xml, events=("start", "end")):
+            if event == "start":
+                open_elements.append(element)
+                continue
+            open_elements.pop()
+            parent = open_elements[-1] if open_elements else None
+            text = None
+            if element.tag == WORD_PARAGRAPH:
+                text = "".join(node.text or "" for node in element.iter(WORD_TEXT))
+            elif parent is None or parent.tag != WORD_BODY:
+                # tables and the like go once done, with whatever is left in them
+                continue
+            if parent is not None:
+                parent.remove(element)
+            if text and text.strip():
+                yield text
+
+
+def read_text_lines(path: str, count: int, sample: bool = False) -> List[str]:
+    """
+    Read `count` lines (paragraphs, for DOCX) of a text document.
+
+    By default these are the first lines, and reading stops as soon as we have
+    them. With `sample`, the lines are spread evenly over the document instead.
+    """
+    if sample:
+        if path.lower().endswith(".docx"):
+            return _reservoir_sample(iter_docx_paragraphs(path), count)
+        return _sample_text_lines(path, count)
+
+    if path.lower().endswith(".docx"):
+        return list(islice(iter_docx_paragraphs(path), count))
+    return list(islice(iter_text_lines(path), count))
+
+
+def _sample_text_lines(path: str, count: int) -> List[str]:
+    # seek to `count` evenly spaced offsets and read the first full line after
+    # each, so we only ever read about `count` lines worth of bytes
+    size = os.path.getsize(path)
+    lines = []
+    last_start = -1
+    with open(path, "rb") as f:
+        for i in range(count):
+            offset = size * i // count
+            f.seek(offset)
+            if offset:
+                f.readline()  # skip the line we landed in the middle of
+            start = f.tell()
+            # in small files several offsets land in the same line
+            if start <= last_start:
+                continue
+            line = f.readline()
+            if not line:
+                break
+            last_start = start
+            lines.append(line.decode("utf-8", errors="replace"))
+    return lines
+
+
+def _reservoir_sample(items: Iterator[str], count: int) -> List[str]:
+    # paragraphs of a compressed document can't be seeked to, so keep a
+    # uniform sample of `count` of them while streaming through, in order
+    rng = random.Random(42)
+    reservoir: List[Tuple[int, str]] = []
+    for i, item in enumerate(items):
+        if i < count:
+            reservoir.append((i, item))
+        else:
+            j = rng.randint(0, i)
+            if j < count:
+                reservoir[j] = (i, item)
+    return [item for _, item in sorted(reservoir)]
@@ -5,24 +5,74 @@ Approach:
 
 - We need the major endpoints: Upload, Process, and Insights
 - Each endpoint will handle specific tasks related to file uploads, processing, and insights retrieval.
+- Processing is slow (it waits on the LLM), so it runs as a job which clients poll through the Jobs endpoint.
 - Insights endpoint, will return insights based on the processed data (file in this context).
 """
 
-from fastapi import APIRouter, Depends, File, HTTPException, Request, UploadFile, status
-from fastapi.background import BackgroundTasks
+from typing import Literal, Optional
+
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    Header,
+    Path,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
 from fastapi.concurrency import run_in_threadpool
 from fastapi.logger import logger
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 
+from cache import llm_cache
+from config.core import BATCH_MAX_FILES
 from exceptions import FileNotFoundException, InsightsNotFoundException
-from schemas import InsightResponse, ProcessRequest, ProcessResponse, UploadResponse
+from executors import run_cpu_bound, run_io
+from file_index import file_index
+from http_cache import insights_cache, preview_cache
+from jobs import Job, job_queue
+from schemas import (
+    BatchProcessRequest,
+    CacheStatsResponse,
+    ColumnarDataPreview,
+    CreateUploadRequest,
+    DataPreview,
+    FileInfoResponse,
+    FileProfileResponse,
+    InsightResponse,
+    JobResponse,
+    ProcessRequest,
+    SheetsResponse,
+    StorageStatsResponse,
+    UploadPartResponse,
+    UploadResponse,
+    UploadSessionResponse,
+)
 from services import (
+    agenerate_batch_insights,
+    astream_insights,
+    complete_resumable_upload,
+    count_saved_insights,
+    covers_sheets,
     extract_data_preview,
-    generate_insights,
-    persist_insights,
+    list_file_sheets,
+    load_file_profile,
     process_upload,
+    resolve_sheets,
     retrieve_saved_insights,
 )
+from storage import storage_stats
+from streaming import format_sse
+from uploads import (
+    abort_upload,
+    create_upload,
+    expires_at,
+    get_upload,
+    part_count,
+    write_part,
+)
 
 router = APIRouter()
 
@@ -39,80 +89,379 @@ async def upload_file(file: UploadFile, request: Request):
     logger.info(f"Received file: {file.filename}")
 
     try:
-        from fastapi.concurrency import run_in_threadpool
-
-        response = await run_in_threadpool(process_upload, file)
-        return response
+        return await process_upload(file)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail="File upload failed")
 
 
 @router.post(
-    "/process",
+    "/uploads",
     status_code=status.HTTP_201_CREATED,
-    response_model=ProcessResponse,
+    response_model=UploadSessionResponse,
+)
+async def start_upload(payload: CreateUploadRequest):
+    """
+    Start a resumable upload, for large files or flaky connections.
+
+    Send the file's parts with `PUT /uploads/{upload_id}/parts/{n}` (in any
+    order, several at once if you like), then complete the upload with
+    `POST /uploads/{upload_id}/complete`.
+    """
+    upload = await run_io(
+        create_upload, payload.filename, payload.size, payload.part_size
+    )
+    return _upload_response(upload, [])
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload_status(upload_id: str):
+    """
+    A resumable upload, with the parts received so far: after a failure,
+    send the others and complete it.
+    """
+    upload, received = await run_io(get_upload, upload_id)
+    return _upload_response(upload, received)
+
+
+@router.put(
+    "/uploads/{upload_id}/parts/{part_number}", response_model=UploadPartResponse
+)
+async def upload_part(
+    request: Request,
+    upload_id: str,
+    part_number: int = Path(ge=1),
+    x_part_sha256: str = Header(description="Hex SHA-256 of the part"),
+):
+    """
+    Send part `part_number` (from 1) of a resumable upload as the raw request
+    body. Every part but the last is `part_size` bytes. A part whose checksum
+    doesn't match is rejected, and can be sent again.
+    """
+    part = await write_part(upload_id, part_number, request.stream(), x_part_sha256)
+    return UploadPartResponse(**part.model_dump(exclude={"created_at"}))
+
+
+@router.post("/uploads/{upload_id}/complete", response_model=UploadResponse)
+async def complete_upload(upload_id: str):
+    """
+    Complete a resumable upload once all its parts are in. The file is then
+    handled like one sent to `/upload`.
+    """
+    return await complete_resumable_upload(upload_id)
+
+
+@router.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def cancel_upload(upload_id: str):
+    """
+    Abort a resumable upload, dropping the parts received.
+    """
+    await run_io(abort_upload, upload_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+def _upload_response(upload, received) -> UploadSessionResponse:
+    return UploadSessionResponse(
+        upload_id=upload.id,
+        filename=upload.filename,
+        size=upload.size,
+        part_size=upload.part_size,
+        part_count=part_count(upload),
+        received_parts=received,
+        expires_at=expires_at(upload),
+    )
+
+
+@router.get("/files/{file_id}", response_model=FileInfoResponse)
+async def get_file_info(file_id: str):
+    """
+    Metadata of an uploaded file: detected type, size, hash and shape.
+    """
+    record = await run_in_threadpool(file_index.require, file_id)
+    return FileInfoResponse(**record.model_dump(exclude={"path"}))
+
+
+@router.get(
+    "/files/{file_id}/preview", response_model=DataPreview | ColumnarDataPreview
+)
+async def get_file_preview(
+    request: Request,
+    file_id: str,
+    limit: int = Query(5, ge=1, le=100),
+    sample: bool = Query(
+        False, description="Spread the preview lines over the whole text document"
+    ),
+    orient: Literal["records", "columnar"] = Query(
+        "records",
+        description="`columnar` returns the column names once and the rows as "
+        "lists of values, instead of one object per row",
+    ),
+):
+    """
+    Preview the first rows of an uploaded file (or, with `sample`, lines from
+    all over a text document).
+
+    Previews are cached, and carry an ETag: send it back in `If-None-Match`
+    to get a 304 when the preview hasn't changed.
+    """
+
+    # looked up even when the preview is cached, in case it has been removed
+    record = await run_in_threadpool(file_index.require, file_id)
+
+    async def build():
+        return await run_cpu_bound(
+            extract_data_preview, record.path, limit, None, sample, orient == "columnar"
+        )
+
+    key = preview_cache.key(file_id, limit, sample, orient)
+    return await preview_cache.respond(request, key, build)
+
+
+@router.get("/files/{file_id}/profile", response_model=FileProfileResponse)
+async def get_file_profile(request: Request, file_id: str):
+    """
+    Per-column statistics of a tabular file: inferred type, null count,
+    min/max/mean/std, approximate distinct count and quantiles, and the most
+    frequent values of non-numeric columns.
+
+    Profiles are computed once, when the file is uploaded, and cached with an
+    ETag like previews.
+    """
+
+    record = await run_in_threadpool(file_index.require, file_id)
+
+    async def build():
+        columns = await run_cpu_bound(load_file_profile, file_id)
+        return FileProfileResponse(
+            file_id=file_id,
+            row_count=record.row_count,
+            column_count=record.column_count,
+            columns=columns,
+        )
+
+    key = preview_cache.key(file_id, "profile")
+    return await preview_cache.respond(request, key, build)
+
+
+@router.get("/files/{file_id}/sheets", response_model=SheetsResponse)
+async def get_file_sheets(file_id: str):
+    """
+    The sheets of an uploaded workbook, with their number of rows and columns.
+
+    Only the workbook's index is read, not its cells, so this is cheap even
+    for very large workbooks.
+    """
+    sheets = await run_io(list_file_sheets, file_id)
+    return SheetsResponse(file_id=file_id, sheets=sheets)
+
+
+@router.post(
+    "/process",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=JobResponse,
 )
-def process_file(payload: ProcessRequest, background_tasks: BackgroundTasks):
+async def process_file(payload: ProcessRequest):
     """
-    Runs a simulation of AI insights generation based on the file ID.
+    Queue AI insights generation for the file ID.
 
-    Accept a file ID and simulate generating AI insights (return 3 insights).
+    Accept a file ID and queue a job generating its insights (3 insights,
+    or 3 per sheet when `sheets` of a workbook are asked for). Returns the
+    job straight away; poll `/jobs/{job_id}` for the insights.
     """
 
     # approach:
-    # - check if the file ID exists
-    # - if it exists, generate insights for the uploaded file (return 3 insights)
+    # - if we already have insights for this file, hand back a finished job
+    # - otherwise queue a job, which generates the insights (return 3 insights)
     # -- each insight should have a title, description, confidence score, and reference rows
-    # - if it does not exist, return an error response
+    # - and persists them once generated, before the job is marked succeeded
 
     file_id = payload.file_id
-    print(f"FIlE ID: {file_id}")
 
     if not file_id:
         raise HTTPException(status_code=400, detail="File ID is required")
 
-    try:
-        insights = generate_insights(file_id)
+    # fail fast on unknown files (and sheets), rather than in the job
+    await run_in_threadpool(file_index.require, file_id)
+    sheets = await run_io(resolve_sheets, file_id, payload.sheets)
 
-        if not insights:
-            raise HTTPException(status_code=404, detail="No insights generated")
+    # file IDs are content-addressed, so stored insights for this ID are
+    # insights for this exact content: hand them back instead of asking the
+    # model again, if they are for the same sheets
+    if not payload.force:
+        try:
+            insights = await run_in_threadpool(retrieve_saved_insights, file_id)
+            if covers_sheets(insights, sheets):
+                logger.info(f"Reusing stored insights for file ID: {file_id}")
+                job = await run_in_threadpool(job_queue.complete, file_id, insights)
+                return _job_response(job)
+        except InsightsNotFoundException:
+            pass
 
-        background_tasks.add_task(persist_insights, file_id, insights)
-        # persist_insights(file_id, insights)
-        logger.info(f"Generated {len(insights)} insights for file ID: {file_id}")
-        logger.info(f"Queued persistence for file ID: {file_id}")
+    job = await run_in_threadpool(job_queue.submit, file_id, payload.mode, sheets)
+    logger.info(f"Queued insights job {job.id} for file ID: {file_id}")
+    return _job_response(job)
 
-        return ProcessResponse(
-            message="Insights generated successfully",
-            file_id=file_id,
-            insights=insights,
+
+@router.post("/process/batch")
+async def process_batch(payload: BatchProcessRequest):
+    """
+    Generate AI insights for many files in one request.
+
+    Files are processed concurrently, and the response streams one JSON line
+    (NDJSON) per file as soon as that file is done, with its insights or the
+    reason it failed. A failing file doesn't abort the rest of the batch.
+    """
+    if len(payload.file_ids) > BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch can hold at most {BATCH_MAX_FILES} file IDs",
         )
-    except FileNotFoundError:
-        raise FileNotFoundException(file_id)
-    except Exception as e:
-        logger.error(f"Processing error for file {file_id}: {e}")
-        raise HTTPException(status_code=500, detail="Insight processing failed")
+
+    async def stream_results():
+        async for result in agenerate_batch_insights(
+            payload.file_ids, mode=payload.mode, force=payload.force
+        ):
+            yield result.model_dump_json() + "\n"
+
+    logger.info(f"Processing a batch of {len(payload.file_ids)} files")
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@router.post("/process/stream")
+async def process_file_stream(payload: ProcessRequest):
+    """
+    Generate AI insights for the file ID, streaming progress as Server-Sent Events.
+
+    Clients get `status` and `token` events while the model works, an
+    `insight` event as soon as each insight is complete, and finally a `done`
+    event once the insights are saved (or an `error` event).
+    """
+    file_id = payload.file_id
+    # fail fast on unknown files and sheets, before the stream is opened
+    await run_in_threadpool(file_index.require, file_id)
+    sheets = await run_io(resolve_sheets, file_id, payload.sheets)
+
+    async def stream_events():
+        try:
+            async for event, data in astream_insights(
+                file_id, mode=payload.mode, force=payload.force, sheets=sheets
+            ):
+                yield format_sse(event, data)
+        except HTTPException as e:
+            yield format_sse("error", {"detail": e.detail})
+        except Exception as e:
+            logger.error(f"Streaming insights failed for {file_id}: {e}")
+            yield format_sse("error", {"detail": "Could not generate insights"})
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        # keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    """
+    Poll the status of an insights job, including its insights once succeeded.
+    """
+    return _job_response(await run_in_threadpool(job_queue.get, job_id))
+
+
+@router.delete("/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    """
+    Cancel a queued or running insights job.
+    """
+    return _job_response(await run_in_threadpool(job_queue.cancel, job_id))
+
+
+def _job_response(job: Job) -> JobResponse:
+    return JobResponse(
+        job_id=job.id,
+        file_id=job.file_id,
+        status=job.status.value,
+        attempts=job.attempts,
+        insights=job.insights,
+        error=job.error,
+        created_at=job.created_at,
+        updated_at=job.updated_at,
+    )
 
 
 @router.get("/insights", status_code=status.HTTP_200_OK, response_model=InsightResponse)
-async def get_insights(file_id: str):
+async def get_insights(
+    request: Request,
+    file_id: str,
+    min_confidence: Optional[float] = Query(None, ge=0.0, le=1.0),
+    max_confidence: Optional[float] = Query(None, ge=0.0, le=1.0),
+    q: Optional[str] = Query(None, description="Search in title and description"),
+    sheet: Optional[str] = Query(None, description="Only insights about this sheet"),
+    sort_by: Literal["rank", "confidence_score", "title"] = "rank",
+    order: Literal["asc", "desc"] = "asc",
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+):
     """
     Retrieve AI-powered insights for the provided file ID if available.
 
-    This endpoint will generate insights based on the uploaded file.
-
-    - We want to allow sorting and filtering here
+    Insights can be filtered on confidence score and a search term, sorted,
+    and paginated; filtering and sorting happen in the database. Responses are
+    cached and carry an ETag, like previews.
     """
     if not file_id:
         logger.error("")
         raise FileNotFoundException(file_id)
 
+    filters = dict(
+        min_confidence=min_confidence,
+        max_confidence=max_confidence,
+        search=q,
+        sheet=sheet,
+    )
+
+    async def build():
+        insights = await run_in_threadpool(
+            retrieve_saved_insights,
+            file_id,
+            sort_by=sort_by,
+            order=order,
+            limit=limit,
+            offset=offset,
+            **filters,
+        )
+        total = await run_in_threadpool(count_saved_insights, file_id, **filters)
+        return InsightResponse(
+            file_id=file_id, insights=insights, total=total, limit=limit, offset=offset
+        )
+
+    key = insights_cache.key(
+        file_id, min_confidence, max_confidence, q, sheet, sort_by, order, limit, offset
+    )
     try:
-        insights = retrieve_saved_insights(file_id)
-        return InsightResponse(file_id=file_id, insights=insights)
+        return await insights_cache.respond(request, key, build)
     except InsightsNotFoundException:
         raise
     except Exception as e:
         logger.error(f"Failed to load insights for {file_id}: {e}")
         raise HTTPException(status_code=500, detail="Could not retrieve insights")
+
+
+@router.get("/cache/stats", response_model=CacheStatsResponse)
+async def get_cache_stats():
+    """
+    Hit, miss and eviction counters of the LLM response cache.
+    """
+    return CacheStatsResponse(**llm_cache.stats())
+
+
+@router.get("/storage/stats", response_model=StorageStatsResponse)
+async def get_storage_stats():
+    """
+    How much disk the stored files take, the retention settings, and how the
+    last sweep of this worker process went.
+    """
+    return await run_io(storage_stats)
@@ -0,0 +1,253 @@
+"""
+Routing completions across a pool of models.
+
+Free-tier models answer in anything from a few seconds to minutes, and now
+and then not at all, so completions go to a pool of models (`LLM_MODELS`)
+rather than a single one:
+
+- each model's latency and error rate are tracked as exponentially weighted
+  moving averages (EWMAs), along with its last `LATENCY_WINDOW` latencies;
+- prompts of up to `LLM_SMALL_PROMPT_TOKENS` tokens go to whichever model has
+  been answering fastest (models not heard from yet count as fastest, so each
+  gets tried); larger prompts go to the models in the configured order;
+- either way, models failing more than `LLM_MAX_ERROR_RATE` of their
+  requests are tried last;
+- when the chosen model hasn't answered within its p95 latency (with
+  `LLM_HEDGE_QUANTILE` = 0.95) of the request being sent, the same request is
+  sent to the next model as well ("hedged"), and whichever gives a valid
+  answer first wins, the other being cancelled. A model failing outright is replaced by the next one
+  straight away.
+
+Latencies are those of the upstream requests alone (see `ModelRouter.track`),
+not counting the time spent waiting for one of our own request slots.
+
+The statistics are kept per process and start over when it restarts.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, TypeVar
+
+from fastapi.logger import logger
+
+from config.core import (
+    LLM_HEDGE,
+    LLM_HEDGE_MAX_DELAY,
+    LLM_HEDGE_MIN_DELAY,
+    LLM_HEDGE_QUANTILE,
+    LLM_MAX_ERROR_RATE,
+    LLM_MODELS,
+    LLM_SMALL_PROMPT_TOKENS,
+)
+from metrics import LLM_HEDGES, LLM_MODEL_ERROR_RATE, LLM_MODEL_LATENCY
+
+EWMA_ALPHA = 0.2
+LATENCY_WINDOW = 100
+# until a model has answered this many times, hedge after the longest delay
+MIN_LATENCY_SAMPLES = 5
+
+T = TypeVar("T")
+
+# the event of the `race` attempt running in this context, which
+# `ModelRouter.track` sets once the attempt's request has been sent upstream
+_attempt_sent: ContextVar[Optional[asyncio.Event]] = ContextVar(
+    "attempt_sent", default=None
+)
+
+
+class ModelStats:
+    """Moving averages of one model's latency and error rate."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.latencies: deque = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, latency: Optional[float]) -> None:
+        """Record an answer that took `latency` seconds, or a failure (None)."""
+        failed = latency is None
+        self.error_rate += EWMA_ALPHA * (float(failed) - self.error_rate)
+        if not failed:
+            self.latencies.append(latency)
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += EWMA_ALPHA * (latency - self.latency)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class ModelRouter:
+    """
+    Picks the models to send a prompt to, and races them, see the module
+    docstring.
+    """
+
+    def __init__(
+        self,
+        models: Sequence[str],
+        small_prompt_tokens: int = LLM_SMALL_PROMPT_TOKENS,
+        max_error_rate: float = LLM_MAX_ERROR_RATE,
+        hedge: bool = LLM_HEDGE,
+        hedge_quantile: float = LLM_HEDGE_QUANTILE,
+        hedge_min_delay: float = LLM_HEDGE_MIN_DELAY,
+        hedge_max_delay: float = LLM_HEDGE_MAX_DELAY,
+    ):
+        if not models:
+            raise ValueError("The model pool is empty, set LLM_MODELS")
+        self.models = list(dict.fromkeys(models))
+        self.small_prompt_tokens = small_prompt_tokens
+        self.max_error_rate = max_error_rate
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.stats: Dict[str, ModelStats] = {model: ModelStats(model) for model in self.models}
+        # the sync client records from request threads
+        self._lock = threading.Lock()
+
+    @property
+    def cache_namespace(self) -> str:
+        # any model of the pool may have answered a cached prompt, so
+        # responses are cached for the pool rather than per model
+        return ",".join(sorted(self.models))
+
+    def rank(self, prompt_tokens: int) -> List[str]:
+        """The models to try for a prompt of `prompt_tokens` tokens, in order."""
+        with self._lock:
+            if prompt_tokens <= self.small_prompt_tokens:
+                # sorted is stable, so ties keep the configured order
+                order = sorted(self.models, key=lambda m: self.stats[m].latency or 0.0)
+            else:
+                order = list(self.models)
+            healthy = [m for m in order if self.stats[m].error_rate <= self.max_error_rate]
+        return healthy + [m for m in order if m not in healthy]
+
+    def hedge_delay(self, model: str) -> float:
+        """How long to wait on `model` before sending the request to another."""
+        with self._lock:
+            latency = self.stats[model].quantile(self.hedge_quantile)
+        if latency is None:
+            return self.hedge_max_delay
+        return min(max(latency, self.hedge_min_delay), self.hedge_max_delay)
+
+    def record(self, model: str, latency: Optional[float]) -> None:
+        with self._lock:
+            stats = self.stats[model]
+            stats.record(latency)
+            LLM_MODEL_ERROR_RATE.set(stats.error_rate, model=model)
+            if stats.latency is not None:
+                LLM_MODEL_LATENCY.set(stats.latency, model=model)
+
+    @contextmanager
+    def track(self, model: str) -> Iterator[None]:
+        """
+        Record how long the block takes as a latency of `model`, or a failure
+        of it if it raises. Cancellation (of a losing hedge) records nothing.
+
+        Wrap the upstream request only, once it has its slot: queueing
+        for one says nothing about the model. Entering the block also starts
+        the hedge timer of the `race` attempt it runs in.
+        """
+        sent = _attempt_sent.get()
+        if sent is not None:
+            sent.set()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.record(model, None)
+            raise
+        self.record(model, time.perf_counter() - start)
+
+    async def race(self, call: Callable[[str], Awaitable[T]], prompt_tokens: int) -> T:
+        """
+        Run `call(model)` on the best model for the prompt, hedged on the next
+        one, and return the first result. `call` should raise on an answer
+        that isn't usable, so that the other model gets its chance, and
+        `track` its upstream requests: the hedge delay only starts counting
+        once the first of them is sent.
+
+        At most two calls are in flight at once, and every model of the pool
+        is tried at most once; when all of them fail, the last error is raised.
+        """
+        queue = self.rank(prompt_tokens)
+        # the model that was too slow, once the request has been hedged
+        hedged_from: Optional[str] = None
+        running: Dict["asyncio.Task[T]", str] = {}
+        sent: Dict["asyncio.Task[T]", asyncio.Event] = {}
+        error: Optional[BaseException] = None
+
+        async def attempt(model: str, request_sent: asyncio.Event) -> T:
+            _attempt_sent.set(request_sent)
+            return await call(model)
+
+        def launch() -> str:
+            model = queue.pop(0)
+            request_sent = asyncio.Event()
+            task = asyncio.ensure_future(attempt(model, request_sent))
+            running[task] = model
+            sent[task] = request_sent
+            return model
+
+        launch()
+        try:
+            while running:
+                timeout = None
+                if self.hedge and queue and len(running) == 1:
+                    ((task, model),) = running.items()
+                    if not sent[task].is_set() and not task.done():
+                        # still waiting for a request slot
+                        await _until_set(sent[task], task)
+                        continue
+                    timeout = self.hedge_delay(model)
+                done, _ = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged_from, hedge = model, launch()
+                    logger.info(
+                        f"[LLM] No answer from {model} after {timeout:.1f}s, "
+                        f"hedging on {hedge}"
+                    )
+                    continue
+                for task in done:
+                    model = running.pop(task)
+                    if task.exception() is None:
+                        if hedged_from is not None:
+                            LLM_HEDGES.inc(winner="first" if model == hedged_from else "hedge")
+                        return task.result()
+                    error = task.exception()
+                    logger.warning(
+                        f"[LLM] {model} failed ({error.__class__.__name__})"
+                        + (f", trying {queue[0]}" if queue and not running else "")
+                    )
+                if queue and not running:
+                    launch()
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+        assert error is not None
+        raise error
+
+
+async def _until_set(event: asyncio.Event, task: "asyncio.Task") -> None:
+    # wait for the event, or for the task to finish without setting it
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait({waiter, task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+
+
+llm_router = ModelRouter(LLM_MODELS)
@@ -0,0 +1,224 @@
+"""
+Token-budgeted sampling of tables before they are sent to the model.
+
+Instead of dumping the first few rows of a file into the prompt, we give the
+model two things, sized to fit a token budget:
+
+- a per-column summary computed over the *whole* table (dtype, nulls, numeric
+  distribution or most common values), so it can reason about the full data;
+- a handful of sample rows, picked to be representative: the first rows, the
+  most extreme rows (outliers) and one row per group of a low-cardinality
+  column, topped up with a random sample.
+
+Every sample row keeps its original position in the file in the `row` column,
+so the `reference_rows` the model returns map back to the source data.
+"""
+
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from config.core import PROMPT_CELL_WIDTH, PROMPT_MAX_COLUMNS, PROMPT_TOKEN_BUDGET
+from schemas import ColumnProfile
+
+# how many rows we take from the top of the table, and the most each kind of
+# interesting row may contribute to the sample
+HEAD_ROWS = 3
+MAX_OUTLIER_ROWS = 10
+MAX_STRATA = 20
+RANDOM_SEED = 42
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: ~4 characters per token for English and numbers."""
+    return len(text) // 4 + 1
+
+
+def build_table_prompt(
+    df: pd.DataFrame,
+    token_budget: int = PROMPT_TOKEN_BUDGET,
+    max_columns: int = PROMPT_MAX_COLUMNS,
+    profile: Optional[List[ColumnProfile]] = None,
+    row_count: Optional[int] = None,
+) -> str:
+    """
+    Render the column summary and as many sample rows as fit `token_budget`.
+
+    With the `profile` of the whole table (of `row_count` rows), `df` only
+    needs to hold the rows to sample from: the summary comes from the profile.
+    """
+    columns = list(df.columns[:max_columns])
+    header = f"The table has {row_count or len(df)} rows and {len(df.columns)} columns."
+    if len(df.columns) > max_columns:
+        header += f" Only the first {max_columns} columns are shown."
+
+    if profile is not None:
+        shown = {str(column) for column in columns}
+        lines = summarize_profile([p for p in profile if p.name in shown])
+    else:
+        lines = summarize_columns(df[columns])
+    # the summary gets at most half the budget, the rows take the rest
+    summary = _fit_lines(lines, token_budget // 2)
+    prefix = (
+        f"{header}\n\n"
+        f"Column summary (computed over all rows):\n{summary}\n\n"
+        "Sample rows (the `row` column is the row number in the file):\n"
+    )
+    remaining = token_budget - estimate_tokens(prefix)
+
+    order = rank_sample_rows(df[columns])
+    return prefix + _fit_rows(df[columns], order, remaining)
+
+
+def summarize_columns(df: pd.DataFrame) -> List[str]:
+    """
+    One line of statistics per column, computed over every row of `df`.
+    """
+    lines = []
+    nulls = df.isna().sum()
+
+    numeric = df.select_dtypes(include="number")
+    if not numeric.empty:
+        stats = numeric.describe(percentiles=[0.25, 0.5, 0.75]).T
+        for column, row in stats.iterrows():
+            if row["count"] == 0:
+                lines.append(f"- {column} ({numeric[column].dtype}): all null")
+                continue
+            lines.append(
+                f"- {column} ({numeric[column].dtype}): nulls={nulls[column]}, "
+                f"mean={row['mean']:.4g}, std={row['std']:.4g}, min={row['min']:.4g}, "
+                f"p25={row['25%']:.4g}, median={row['50%']:.4g}, "
+                f"p75={row['75%']:.4g}, max={row['max']:.4g}"
+            )
+
+    for column in df.columns.difference(numeric.columns, sort=False):
+        series = df[column]
+        top = series.value_counts(dropna=True).head(3)
+        top_values = ", ".join(
+            f"{_truncate(value)} ({count})" for value, count in top.items()
+        )
+        lines.append(
+            f"- {column} ({series.dtype}): nulls={nulls[column]}, "
+            f"distinct={series.nunique(dropna=True)}, top=[{top_values}]"
+        )
+    return lines
+
+
+def summarize_profile(profile: List[ColumnProfile]) -> List[str]:
+    """
+    The lines of `summarize_columns`, from precomputed column profiles.
+    """
+    lines = []
+    for column in profile:
+        if column.count == 0:
+            lines.append(f"- {column.name} ({column.dtype}): all null")
+        elif column.quantiles:
+            quantiles = column.quantiles
+            lines.append(
+                f"- {column.name} ({column.dtype}): nulls={column.nulls}, "
+                f"mean={_number(column.mean)}, std={_number(column.std)}, "
+                f"min={_number(column.min)}, p25={_number(quantiles.get('p25'))}, "
+                f"median={_number(quantiles.get('p50'))}, "
+                f"p75={_number(quantiles.get('p75'))}, max={_number(column.max)}"
+            )
+        else:
+            line = (
+                f"- {column.name} ({column.dtype}): nulls={column.nulls}, "
+                f"distinct~{column.distinct}"
+            )
+            if column.min is not None:
+                line += f", min={column.min}, max={column.max}"
+            if column.top:
+                top_values = ", ".join(
+                    f"{_truncate(value)} ({count})" for value, count in column.top[:3]
+                )
+                line += f", top=[{top_values}]"
+            lines.append(line)
+    return lines
+
+
+def _number(value) -> str:
+    return "n/a" if value is None else f"{value:.4g}"
+
+
+def rank_sample_rows(df: pd.DataFrame) -> pd.Index:
+    """
+    Order row labels by how much we want them in the sample: first rows,
+    outliers, one row per stratum, then a random sample of the rest.
+    """
+    picks = [df.index[:HEAD_ROWS]]
+
+    outliers = _outlier_rows(df)
+    if outliers is not None:
+        picks.append(outliers)
+
+    strata = _stratified_rows(df)
+    if strata is not None:
+        picks.append(strata)
+
+    rng = np.random.default_rng(RANDOM_SEED)
+    picks.append(df.index[rng.permutation(len(df))])
+
+    ranked = pd.Index(np.concatenate([np.asarray(p) for p in picks]))
+    return ranked.drop_duplicates()
+
+
+def _outlier_rows(df: pd.DataFrame) -> Optional[pd.Index]:
+    numeric = df.select_dtypes(include="number")
+    if numeric.empty or len(df) <= HEAD_ROWS:
+        return None
+    # rows holding the largest absolute z-score in any numeric column
+    std = numeric.std(ddof=0).replace(0, np.nan)
+    zscores = ((numeric - numeric.mean()) / std).abs().max(axis=1)
+    return zscores.nlargest(MAX_OUTLIER_ROWS).index
+
+
+def _stratified_rows(df: pd.DataFrame) -> Optional[pd.Index]:
+    # stratify on the first column with a handful of distinct values
+    for column in df.select_dtypes(exclude="number").columns:
+        distinct = df[column].nunique(dropna=True)
+        if 1 < distinct <= MAX_STRATA:
+            return df.drop_duplicates(subset=[column]).index
+    return None
+
+
+def _fit_rows(df: pd.DataFrame, order: pd.Index, budget: int) -> str:
+    # binary search the largest number of ranked rows that fits the budget,
+    # bounded by an estimate from a small probe so we never render huge slices
+    probe = order[:20]
+    per_row = max(1.0, estimate_tokens(_render_rows(df, probe)) / max(1, len(probe)))
+    low, high = 1, min(len(order), int(budget / per_row * 2) + 1)
+    best = _render_rows(df, order[:1])
+    while low <= high:
+        mid = (low + high) // 2
+        rendered = _render_rows(df, order[:mid])
+        if estimate_tokens(rendered) <= budget:
+            best, low = rendered, mid + 1
+        else:
+            high = mid - 1
+    return best
+
+
+def _render_rows(df: pd.DataFrame, labels: pd.Index) -> str:
+    sample = df.loc[labels.sort_values()]
+    for column in sample.select_dtypes(exclude="number").columns:
+        sample[column] = sample[column].map(_truncate, na_action="ignore")
+    return sample.to_csv(index_label="row", float_format="%.6g")
+
+
+def _fit_lines(lines: List[str], budget: int) -> str:
+    kept = []
+    used = 0
+    for line in lines:
+        used += estimate_tokens(line)
+        if used > budget:
+            kept.append(f"- ... {len(lines) - len(kept)} more columns")
+            break
+        kept.append(line)
+    return "\n".join(kept)
+
+
+def _truncate(value, width: int = PROMPT_CELL_WIDTH) -> str:
+    text = str(value).replace("\n", " ")
+    return text if len(text) <= width else text[: width - 3] + "..."
@@ -1,4 +1,5 @@
-from typing import Any, Dict, List
+from datetime import datetime
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
 from pydantic import BaseModel, Field
 
@@ -16,16 +17,139 @@ class DataPreview(BaseModel):
     rows: List[Dict]
 
 
+class ColumnarDataPreview(BaseModel):
+    """
+    A preview laid out as a matrix: `data` holds one list of values per row,
+    in the order of `columns`, so column names aren't repeated on every row.
+    """
+
+    columns: List[str]
+    data: List[List[Any]]
+
+
 class UploadResponse(BaseModel):
     preview: DataPreview
     file_id: str = Field(description="Unique identifier for the uploaded file")
 
 
+class CreateUploadRequest(BaseModel):
+    filename: str = Field(min_length=1, max_length=255)
+    size: int = Field(gt=0, description="Size of the whole file in bytes")
+    part_size: Optional[int] = Field(
+        default=None,
+        gt=0,
+        description="Size of every part but the last; the server default if left out",
+    )
+
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str = Field(description="Unique identifier for the resumable upload")
+    filename: str
+    size: int
+    part_size: int
+    part_count: int
+    received_parts: List[int] = Field(
+        description="Numbers of the parts received so far, from 1"
+    )
+    expires_at: datetime = Field(
+        description="When the upload is dropped, if no part arrives until then"
+    )
+
+
+class UploadPartResponse(BaseModel):
+    upload_id: str
+    part_number: int
+    size: int
+    sha256: str
+
+
+class FileInfoResponse(BaseModel):
+    file_id: str
+    file_type: str = Field(description="Type detected from the file content")
+    size: int = Field(description="Size of the file in bytes")
+    sha256: Optional[str] = None
+    row_count: Optional[int] = None
+    column_count: Optional[int] = None
+    created_at: datetime
+
+
+class SheetInfo(BaseModel):
+    index: int = Field(description="Position of the sheet in the workbook")
+    name: str
+    row_count: Optional[int] = Field(
+        default=None, description="Data rows (below the header), when the workbook records it"
+    )
+    column_count: Optional[int] = None
+    hidden: bool = False
+
+
+class SheetsResponse(BaseModel):
+    file_id: str
+    sheets: List[SheetInfo]
+
+
+class ColumnProfile(BaseModel):
+    name: str
+    dtype: str = Field(description="Type inferred over all values of the column")
+    count: int = Field(description="Non-null values")
+    nulls: int
+    distinct: int = Field(description="Approximate number of distinct values")
+    min: Optional[Union[float, str]] = None
+    max: Optional[Union[float, str]] = None
+    mean: Optional[float] = None
+    std: Optional[float] = None
+    quantiles: Dict[str, float] = Field(
+        default_factory=dict,
+        description="Approximate quantiles of numeric columns, e.g. p50 for the median",
+    )
+    top: List[Tuple[str, int]] = Field(
+        default_factory=list,
+        description="Most frequent values of non-numeric columns, with approximate counts",
+    )
+
+
+class FileProfileResponse(BaseModel):
+    file_id: str
+    row_count: Optional[int] = None
+    column_count: Optional[int] = None
+    columns: List[ColumnProfile]
+
+
 class ProcessRequest(BaseModel):
     file_id: str = Field(description="Unique identifier for the file to be processed")
+    force: bool = Field(
+        default=False,
+        description="Regenerate insights even if some are already stored for this file",
+    )
+    mode: Optional[Literal["sample", "map_reduce"]] = Field(
+        default=None,
+        description=(
+            "How the file is fed to the model: one prompt from a sample of the file, "
+            "or per-chunk prompts merged at the end. Picked by file size if left out."
+        ),
+    )
+    sheets: Optional[List[str]] = Field(
+        default=None,
+        description=(
+            "Workbooks only: generate insights for each of these sheets (\"*\" for "
+            "all the sheets holding data), instead of for the first sheet"
+        ),
+    )
 
 
 
+class BatchProcessRequest(BaseModel):
+    file_ids: List[str] = Field(
+        min_length=1, description="Unique identifiers of the files to be processed"
+    )
+    force: bool = Field(
+        default=False,
+        description="Regenerate insights even if some are already stored for a file",
+    )
+    mode: Optional[Literal["sample", "map_reduce"]] = Field(
+        default=None, description="See `ProcessRequest.mode`"
+    )
+
 
 class Insight(BaseModel):
     title: str = Field(description="Title of the insight")
@@ -36,14 +160,89 @@ class Insight(BaseModel):
     reference_rows: list[int] = Field(
         description="Row numbers in the file that this insight refers to"
     )
+    sheet: Optional[str] = Field(
+        default=None, description="The workbook sheet the insight is about, if any"
+    )
 
 class ProcessResponse(BaseModel):
     message: str
     file_id: str
     insights: List[Insight]
 
+class JobResponse(BaseModel):
+    job_id: str = Field(description="Unique identifier for the processing job")
+    file_id: str
+    status: str = Field(
+        description="One of: queued, running, succeeded, failed, cancelled"
+    )
+    attempts: int = 0
+    insights: List[Insight] = Field(
+        default_factory=list, description="Generated insights, once succeeded"
+    )
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+
+class BatchResult(BaseModel):
+    file_id: str
+    status: Literal["succeeded", "failed"]
+    insights: List[Insight] = Field(default_factory=list)
+    cached: bool = Field(
+        default=False, description="Whether stored insights were reused"
+    )
+    error: Optional[str] = None
+
+
 class InsightResponse(BaseModel):
     file_id: str
     insights: list[Insight] = Field(
         description="List of insights extracted from the processed file"
     )
+    total: Optional[int] = Field(
+        default=None, description="Number of insights matching the filters"
+    )
+    limit: Optional[int] = None
+    offset: int = 0
+
+
+class CacheStatsResponse(BaseModel):
+    memory_entries: int
+    memory_hits: int
+    memory_misses: int
+    memory_evictions: int
+    memory_expirations: int
+    disk_hits: int
+    disk_misses: int
+    disk_evictions: int
+
+
+class StorageSweepStats(BaseModel):
+    started_at: datetime
+    duration_ms: float
+    expired: int = Field(description="Files removed for not being used in time")
+    evicted: int = Field(description="Files removed to stay under the size limit")
+    compressed: int
+    migrated: int = Field(
+        description="Files and legacy insight files moved into the current layout"
+    )
+    freed_bytes: int
+
+
+class StorageStatsResponse(BaseModel):
+    files: int
+    stored_bytes: int = Field(
+        description="Bytes stored files take on disk, with their columnar caches"
+    )
+    original_bytes: int = Field(description="Bytes of the files as uploaded")
+    compressed_files: int
+    staging_bytes: int = Field(description="Bytes of uploads still being received")
+    disk_total_bytes: int
+    disk_free_bytes: int
+    ttl: int
+    max_bytes: int
+    compress_after: int
+    compression_available: bool
+    last_sweep: Optional[StorageSweepStats] = Field(
+        default=None, description="How the last sweep in this worker process went"
+    )
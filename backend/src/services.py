@@ -1,34 +1,99 @@
+import asyncio
+import io
 import json
 import os
-import random
-import uuid
-from pathlib import Path
-from typing import List, Optional
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, List, Optional, Tuple
 
-import pandas as pd
-from fastapi import UploadFile
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.logger import logger
-
+from sqlalchemy import insert, or_
+from sqlmodel import Session, col, delete, func, select
+
+from config.core import (
+    BATCH_CONCURRENCY,
+    MAP_REDUCE_CHUNK_ROWS,
+    MAP_REDUCE_CHUNK_TOKEN_BUDGET,
+    MAP_REDUCE_CONCURRENCY,
+    MAP_REDUCE_MIN_BYTES,
+    PROFILE_CHUNK_ROWS,
+    PROFILE_ON_UPLOAD,
+    PROFILE_SAMPLE_ROWS,
+    PROMPT_MAX_COLUMNS,
+    SAMPLING_MAX_ROWS,
+    SHEET_CONCURRENCY,
+    TEXT_MAX_LINES,
+    engine,
+)
 from exceptions import (
-    FileNotFoundException,
     FileProcessingError,
     InsightsNotFoundException,
+    InvalidFileTypeException,
+    SheetNotFoundException,
+)
+from executors import run_cpu_bound, run_io
+from metrics import ROWS_PARSED, UPLOADED_BYTES, timed
+from mcp_client import (
+    agenerate_ai_insights,
+    areduce_ai_insights,
+    astream_ai_insights,
+    generate_ai_insights,
+)
+from file_index import file_index
+from http_cache import insights_cache
+from models import FileRecord
+from models import Insight as InsightRecord
+from readers import (
+    TABULAR_TYPES,
+    WORKBOOK_TYPES,
+    build_parquet_cache,
+    iter_frame_chunks,
+    list_sheets,
+    read_sheet,
+    read_table,
+    read_text_lines,
+    table_shape,
+)
+from schemas import (
+    BatchResult,
+    ColumnProfile,
+    ColumnarDataPreview,
+    DataPreview,
+    Insight,
+    SheetInfo,
+    UploadResponse,
+)
+from storage import disk_usage
+from uploads import complete_upload
+from utils import (
+    StoredFile,
+    get_insights_path,
+    save_file,
 )
-from mcp_client import generate_ai_insights
-from schemas import DataPreview, Insight, UploadResponse
-from utils import generate_file_id, get_insights_path, resolve_file_path, save_file
 
+# pandas (and the sampler built on it) are imported where they are used, so
+# the app starts without paying for them; see `startup.warm_up`
+if TYPE_CHECKING:
+    import pandas as pd
 
-def process_upload(file: UploadFile) -> UploadResponse:
+
+async def process_upload(file: UploadFile) -> UploadResponse:
     """
     Helper function to save the uploaded file to the server and return a file preview
 
     Returns the file_id and the preview_data accroding to the UploadResposne Schema
+
+    The file is written to disk on the I/O executor, then parsed (indexed and
+    previewed) on the CPU one, see `executors`.
     """
     try:
-        file_path, file_id = save_uploaded_file(file)
-        preview_data = extract_data_preview(file_path)
+        stored, file_id = await run_io(_timed_save, file)
+        UPLOADED_BYTES.inc(stored.size, file_type=stored.file_type)
+        preview_data = await run_cpu_bound(index_and_preview, stored)
         return UploadResponse(file_id=file_id, preview=preview_data)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"[UploadError] Failed to process upload: {e}")
         raise FileProcessingError(
@@ -37,162 +102,839 @@ def process_upload(file: UploadFile) -> UploadResponse:
         ) from e
 
 
-def save_uploaded_file(file: UploadFile) -> tuple[str, str]:
+async def complete_resumable_upload(upload_id: str) -> UploadResponse:
     """
-    Save the uploaded file to the filesystem, and returns the first 5 rows
+    `process_upload` for a resumable upload whose parts have all arrived: the
+    assembled file is stored (see `uploads.complete_upload`), then indexed
+    and previewed.
+    """
+    with timed("save"):
+        stored = await run_io(complete_upload, upload_id)
+    UPLOADED_BYTES.inc(stored.size, file_type=stored.file_type)
+    preview_data = await run_cpu_bound(index_and_preview, stored)
+    return UploadResponse(file_id=stored.file_id, preview=preview_data)
+
+
+def _timed_save(file: UploadFile) -> tuple[StoredFile, str]:
+    with timed("save"):
+        return save_uploaded_file(file)
+
+
+def index_and_preview(stored: StoredFile) -> DataPreview:
+    """
+    Index a freshly stored upload (unless it's a file we already have) and
+    build its preview.
+    """
+    if file_index.get(stored.file_id, discover=False) is None:
+        with timed("index"):
+            index_uploaded_file(stored)
+    # build the preview from the bytes we already have in hand, rather than
+    # reading the file back from disk
+    with timed("preview"):
+        return extract_data_preview(stored.path, head=stored.head_lines)
+
+
+def index_uploaded_file(stored: StoredFile) -> FileRecord:
+    """
+    Build the columnar cache (and profile) of a new upload and record it in
+    the file index.
+    """
+    row_count, column_count, profile = stored.line_count, None, None
+    # parse tabular files once, into a columnar cache every later read uses
+    if stored.file_type in TABULAR_TYPES and build_parquet_cache(stored.path):
+        row_count, column_count = table_shape(stored.path)
+    if stored.file_type in TABULAR_TYPES and PROFILE_ON_UPLOAD:
+        profile = profile_file(stored.path)
+
+    return file_index.add(
+        FileRecord(
+            file_id=stored.file_id,
+            path=stored.path,
+            file_type=stored.file_type,
+            size=stored.size,
+            sha256=stored.sha256,
+            row_count=row_count,
+            column_count=column_count,
+            profile=profile,
+            stored_size=disk_usage(stored.path),
+        )
+    )
+
+
+def profile_file(path: str) -> Optional[List[dict]]:
+    """
+    Profile every column of a tabular file in one streaming pass, see
+    `profiling`. Returns None if the file can't be read.
+    """
+    from profiling import profile_chunks
+
+    try:
+        with timed("profile"):
+            chunks = iter_frame_chunks(path, PROFILE_CHUNK_ROWS)
+            return [column.model_dump() for column in profile_chunks(chunks)]
+    except Exception as e:
+        logger.warning(f"[Profile] Could not profile {path}: {e}")
+        return None
+
+
+def load_file_profile(file_id: str) -> List[ColumnProfile]:
+    """
+    The column profiles of a tabular file, profiling it first if it hasn't
+    been yet (files uploaded with `PROFILE_ON_UPLOAD` off, or before profiles
+    existed).
+    """
+    record = file_index.require(file_id)
+    if record.file_type not in TABULAR_TYPES:
+        raise InvalidFileTypeException(record.file_type)
+    profile = _load_profile(record)
+    if profile is None:
+        raise FileProcessingError(
+            "The file could not be profiled", details={"file_id": file_id}
+        )
+    return profile
+
+
+def _load_profile(record: FileRecord) -> Optional[List[ColumnProfile]]:
+    if record.profile is None:
+        record.profile = profile_file(record.path)
+        if record.profile is None:
+            return None
+        file_index.add(record)
+    return [ColumnProfile(**column) for column in record.profile]
+
+
+def save_uploaded_file(file: UploadFile) -> tuple[StoredFile, str]:
+    """
+    Save the uploaded file to the filesystem, and returns where it was stored
+
+    File IDs are derived from the file content, so re-uploading the same file
+    hands back the ID (and insights) of the earlier upload.
     """
-    file_id = generate_file_id()
     try:
         # save the uploaded file
-        file_path = save_file(file, file_id)
-        return file_path, file_id
+        stored = save_file(file)
+        if stored.duplicate:
+            logger.info(f"[LOG] Upload matches existing file ID: {stored.file_id}")
+        return stored, stored.file_id
     except Exception as err:
         raise
 
 
-def extract_data_preview(path: str, limit: int = 5) -> DataPreview:
+def extract_data_preview(
+    path: str,
+    limit: int = 5,
+    head: Optional[bytes] = None,
+    sample: bool = False,
+    columnar: bool = False,
+) -> DataPreview | ColumnarDataPreview:
     """
     Extract the first few rows of the file for preview.
-    Returns a DataPreview schema object.
+    Returns a DataPreview schema object, or a ColumnarDataPreview with
+    `columnar`.
+
+    `head` may hold the first (complete) lines of the file; plain-text formats
+    are then previewed from it without touching the disk. With `sample`, text
+    documents are previewed with lines spread over the whole document.
     """
+    import pandas as pd
+
     ext = os.path.splitext(path)[1].lower()
 
-    if ext in {".csv", ".xlsx", ".xls"}:
-        df = _read_dataframe(path)
+    if ext == ".csv":
+        df = pd.read_csv(io.BytesIO(head), nrows=limit) if head else None
+        if df is None or len(df) < limit:
+            df = _read_dataframe(path, limit)
+    elif ext in {".xlsx", ".xls"}:
+        # workbooks are zip/OLE containers, they can't be parsed from a prefix,
+        # but the columnar cache built at upload gives us the rows cheaply
+        df = _read_dataframe(path, limit)
+    elif ext == ".txt" and head and not sample:
+        lines = head.decode("utf-8", errors="replace").splitlines(keepends=True)
+        df = pd.DataFrame(lines[:limit], columns=["text"])
     elif ext in {".txt", ".docx"}:
-        lines = read_word_text_file(path, limit)
+        lines = read_word_text_file(path, limit, sample=sample)
         df = pd.DataFrame(lines, columns=["text"])
     else:
         raise ValueError(
             f"Unsupported file type for preview: {ext}. Only CSV, Excel, TXT, and DOCX are supported."
         )
 
-    preview_data = df.head(limit).fillna("").to_dict(orient="records")
-    columns = df.columns.tolist()
+    df = df.head(limit).fillna("")
+    columns = [str(column) for column in df.columns]
+    if columnar:
+        return ColumnarDataPreview(columns=columns, data=df.values.tolist())
+    preview_data = df.to_dict(orient="records")
     return DataPreview(columns=columns, rows=preview_data)
 
 
 def generate_insights(file_id: str, count: int = 3) -> List[Insight]:
     """
-    Simulate insights based on random sampling from the uploaded file.
+    Generate insights from a token-budgeted sample of the uploaded file.
     Returns a list of Insight schema objects.
     """
-    file_path = resolve_file_path(file_id)
+    prompt = build_file_prompt(file_id)
+
+    # when the processing is done, we will call the OpenRouter.ai API to generate insights
+    logger.info("[LOG] Attempting to generate AI insights")
+    ai_response = generate_ai_insights(prompt)  # make a call to OpenAI via OpenRouter.ai
+    logger.info("[LOG] Information generated successfully")
+
+    return build_insights(ai_response, count)
+
+
+async def agenerate_insights(
+    file_id: str,
+    count: int = 3,
+    mode: Optional[str] = None,
+    sheets: Optional[List[str]] = None,
+) -> List[Insight]:
+    """
+    Async variant of `generate_insights`: the file is parsed and sampled in the
+    parsing process pool (see `executors`), and the model is called through
+    the pooled async client.
+
+    `mode` is either "sample" (one prompt from a sample of the file) or
+    "map_reduce" (see `agenerate_insights_map_reduce`). When left out, large
+    tabular files are processed with map-reduce and everything else sampled.
+    With `sheets`, a workbook gets insights per sheet instead, see
+    `agenerate_sheet_insights`.
+    """
+    if sheets:
+        return await agenerate_sheet_insights(file_id, sheets, count)
+    if mode is None:
+        large = await run_in_threadpool(_is_large_table, file_id)
+        mode = "map_reduce" if large else "sample"
+    if mode == "map_reduce":
+        return await agenerate_insights_map_reduce(file_id, count)
+
+    prompt = await run_cpu_bound(build_file_prompt, file_id)
 
-    if not file_path:
-        raise FileNotFoundException(file_id)
+    logger.info("[LOG] Attempting to generate AI insights")
+    ai_response = await agenerate_ai_insights(prompt, count)
+    logger.info("[LOG] Information generated successfully")
+
+    return build_insights(ai_response, count)
+
+
+async def agenerate_insights_map_reduce(file_id: str, count: int = 3) -> List[Insight]:
+    """
+    Generate insights over every row of a large tabular file.
+
+    The file is streamed in chunks of `MAP_REDUCE_CHUNK_ROWS` rows, and each
+    chunk gets its own (sampled) prompt and insights, with up to
+    `MAP_REDUCE_CONCURRENCY` chunks in flight at once. A final call merges and
+    ranks the per-chunk insights. Chunks are only read as slots free up, so
+    memory is bounded by the chunk size rather than the file size.
+    """
+    record = await run_in_threadpool(file_index.require, file_id)
+    chunks = iter_frame_chunks(record.path, MAP_REDUCE_CHUNK_ROWS)
+    slots = asyncio.Semaphore(MAP_REDUCE_CONCURRENCY)
+
+    async def map_chunk(prompt: str) -> list:
+        try:
+            return await agenerate_ai_insights(prompt, count)
+        finally:
+            slots.release()
+
+    tasks = []
+    reading = None
+    try:
+        while True:
+            await slots.acquire()
+            # the chunks are streamed out of one reader, which can't be handed
+            # to another process: read and sample them on the I/O threads. The
+            # read is shielded, so that when we're cancelled we can still wait
+            # for it, and not close the reader under the thread using it
+            reading = asyncio.ensure_future(run_io(_next_chunk_prompt, chunks))
+            prompt = await asyncio.shield(reading)
+            if prompt is None:
+                slots.release()
+                break
+            tasks.append(asyncio.create_task(map_chunk(prompt)))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if reading is not None and not reading.done():
+            await asyncio.wait([reading])
+        chunks.close()
+
+    candidates = []
+    for i, result in enumerate(results):
+        if isinstance(result, BaseException):
+            logger.error(f"[MapReduce] Chunk {i} failed for file {file_id}: {result}")
+            continue
+        candidates.extend(item for item in result if isinstance(item, dict))
+    if not candidates:
+        raise FileProcessingError(
+            "No chunk of the file produced any insights",
+            details={"file_id": file_id, "chunks": len(results)},
+        )
+    logger.info(
+        f"[MapReduce] Reducing {len(candidates)} insights from {len(results)} chunks"
+    )
+
+    ai_response = await areduce_ai_insights(candidates, count)
+    return build_insights(ai_response, count)
+
+
+async def agenerate_sheet_insights(
+    file_id: str, sheets: List[str], count: int = 3
+) -> List[Insight]:
+    """
+    Generate `count` insights for each of the named sheets of a workbook.
+
+    Each sheet is read on its own, only its first `PROMPT_MAX_COLUMNS`
+    columns, and sampled into its own prompt; up to `SHEET_CONCURRENCY`
+    sheets are worked on at once. Insights are tagged with their sheet, and
+    sheets that fail are left out, unless they all do.
+    """
+    slots = asyncio.Semaphore(SHEET_CONCURRENCY)
+
+    async def generate(sheet: str) -> List[Insight]:
+        async with slots:
+            prompt = await run_cpu_bound(build_sheet_prompt, file_id, sheet)
+            ai_response = await agenerate_ai_insights(prompt, count)
+        return [
+            insight.model_copy(update={"sheet": sheet})
+            for insight in build_insights(ai_response, count)
+        ]
+
+    results = await asyncio.gather(
+        *(generate(sheet) for sheet in sheets), return_exceptions=True
+    )
+    insights = []
+    for sheet, result in zip(sheets, results):
+        if isinstance(result, BaseException):
+            logger.error(f"[Sheets] Sheet {sheet!r} failed for file {file_id}: {result}")
+            continue
+        insights.extend(result)
+    if not insights:
+        raise FileProcessingError(
+            "No sheet of the workbook produced any insights",
+            details={"file_id": file_id, "sheets": sheets},
+        )
+    return insights
+
+
+def list_file_sheets(file_id: str) -> List[SheetInfo]:
+    """
+    The sheets of an uploaded workbook, see `readers.list_sheets`.
+    """
+    record = file_index.require(file_id)
+    if record.file_type not in WORKBOOK_TYPES:
+        raise InvalidFileTypeException(record.file_type)
+    return list_sheets(record.path)
 
-    ext = os.path.splitext(file_path)[1].lower()
+
+def resolve_sheets(file_id: str, sheets: Optional[List[str]]) -> Optional[List[str]]:
+    """
+    Check the sheets asked for exist in the file (a workbook), expanding "*"
+    to all of its sheets that hold data.
+    """
+    if not sheets:
+        return None
+    found = list_file_sheets(file_id)
+    if "*" in sheets:
+        # the dimensions are unknown for .xls workbooks, keep those sheets
+        return [sheet.name for sheet in found if sheet.row_count != 0]
+    names = [sheet.name for sheet in found]
+    missing = [sheet for sheet in sheets if sheet not in names]
+    if missing:
+        raise SheetNotFoundException(file_id, missing)
+    return list(dict.fromkeys(sheets))
+
+
+def covers_sheets(insights: List[Insight], sheets: Optional[List[str]]) -> bool:
+    """
+    Whether stored insights were generated for exactly these sheets (or, for
+    None, for the file as a whole).
+    """
+    return {insight.sheet for insight in insights} == set(sheets or [None])
+
+
+async def agenerate_batch_insights(
+    file_ids: List[str],
+    count: int = 3,
+    mode: Optional[str] = None,
+    force: bool = False,
+) -> AsyncIterator[BatchResult]:
+    """
+    Generate and persist insights for many files, yielding each file's result
+    as soon as it is ready (so in completion order, not request order).
+
+    Up to `BATCH_CONCURRENCY` files are worked on at once, and their model
+    calls share the process-wide LLM concurrency limit with everything else. A
+    file that fails is reported as such and doesn't stop the rest of the batch.
+    Files that already have a job generating their insights (see `jobs`) wait
+    for that job, instead of asking the model a second time.
+    """
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def process(file_id: str) -> BatchResult:
+        async with slots:
+            return await _aprocess_batch_file(file_id, count, mode, force)
+
+    # the same file twice in a batch would only race itself
+    tasks = [
+        asyncio.create_task(process(file_id)) for file_id in dict.fromkeys(file_ids)
+    ]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        # the client went away (or the stream broke): stop the remaining files
+        for task in tasks:
+            task.cancel()
+
+
+async def _aprocess_batch_file(
+    file_id: str, count: int, mode: Optional[str], force: bool
+) -> BatchResult:
+    try:
+        await run_in_threadpool(file_index.require, file_id)
+        if not force:
+            try:
+                insights = await run_in_threadpool(retrieve_saved_insights, file_id)
+                # insights for some sheets of a workbook aren't the file's
+                if covers_sheets(insights, None):
+                    return BatchResult(
+                        file_id=file_id,
+                        status="succeeded",
+                        insights=insights,
+                        cached=True,
+                    )
+            except InsightsNotFoundException:
+                pass
+
+        insights = await _await_active_job(file_id)
+        if insights:
+            return BatchResult(file_id=file_id, status="succeeded", insights=insights)
+
+        insights = await agenerate_insights(file_id, count, mode)
+        if not insights:
+            return BatchResult(
+                file_id=file_id, status="failed", error="No insights generated"
+            )
+        await run_in_threadpool(persist_insights, file_id, insights)
+        return BatchResult(file_id=file_id, status="succeeded", insights=insights)
+    except HTTPException as e:
+        return BatchResult(file_id=file_id, status="failed", error=e.detail)
+    except Exception as e:
+        logger.error(f"[Batch] Failed to generate insights for {file_id}: {e}")
+        return BatchResult(file_id=file_id, status="failed", error=str(e))
+
+
+async def _await_active_job(file_id: str) -> Optional[List[Insight]]:
+    # jobs run `agenerate_insights`, so they're imported here
+    from jobs import JobStatus, job_queue
+
+    job = await run_in_threadpool(job_queue.active, file_id)
+    if job is None:
+        return None
+    logger.info(f"[Batch] Waiting on job {job.id} for file ID: {file_id}")
+    job = await job_queue.wait(job.id)
+    # a job that failed or was cancelled is no reason to give up on the file
+    return job.insights if job.status is JobStatus.SUCCEEDED else None
+
+
+async def astream_insights(
+    file_id: str,
+    count: int = 3,
+    mode: Optional[str] = None,
+    force: bool = False,
+    sheets: Optional[List[str]] = None,
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Generate and persist insights for a file, yielding `(event, data)` pairs
+    describing the progress as it happens:
+
+    - `status`: which stage we are in (`sampling`, then `generating`);
+    - `token`: a piece of the model's output, see `astream_ai_insights`;
+    - `insight`: an insight, as soon as the model has finished writing it;
+    - `done`: all insights, once they have been persisted.
+
+    Map-reduce and per-sheet generation only have insights once all chunks
+    or sheets are done, so they are all sent at the end, without tokens.
+    """
+    insights: List[Insight] = []
+    if not force:
+        try:
+            insights = await run_in_threadpool(retrieve_saved_insights, file_id)
+        except InsightsNotFoundException:
+            pass
+    if insights and not covers_sheets(insights, sheets):
+        insights = []
+    if insights:
+        for i, insight in enumerate(insights):
+            yield "insight", {"index": i, "insight": insight.model_dump()}
+        yield "done", _done_event(file_id, insights, cached=True)
+        return
+
+    if mode is None:
+        large = await run_in_threadpool(_is_large_table, file_id)
+        mode = "map_reduce" if large else "sample"
+    yield "status", {"stage": "sampling", "mode": mode}
+
+    if sheets or mode == "map_reduce":
+        yield "status", {"stage": "generating"}
+        insights = await agenerate_insights(file_id, count, mode, sheets)
+        for i, insight in enumerate(insights):
+            yield "insight", {"index": i, "insight": insight.model_dump()}
+    else:
+        prompt = await run_cpu_bound(build_file_prompt, file_id)
+        yield "status", {"stage": "generating"}
+        async for kind, payload in astream_ai_insights(prompt, count):
+            if kind == "token":
+                yield kind, payload
+                continue
+            if len(insights) >= count:
+                continue
+            insight = build_insight(payload, len(insights))
+            if insight is not None:
+                insights.append(insight)
+                yield "insight", {
+                    "index": len(insights) - 1,
+                    "insight": insight.model_dump(),
+                }
+
+    if not insights:
+        raise FileProcessingError("No insights generated", details={"file_id": file_id})
+    await run_in_threadpool(persist_insights, file_id, insights)
+    yield "done", _done_event(file_id, insights, cached=False)
+
+
+def _done_event(file_id: str, insights: List[Insight], cached: bool) -> dict:
+    return {
+        "file_id": file_id,
+        "insights": [insight.model_dump() for insight in insights],
+        "cached": cached,
+    }
+
+
+def _next_chunk_prompt(chunks) -> Optional[str]:
+    from sampling import build_table_prompt
+
+    with timed("parse"):
+        chunk = next(chunks, None)
+    if chunk is None:
+        return None
+    ROWS_PARSED.inc(len(chunk))
+    with timed("prompt"):
+        return build_table_prompt(chunk, token_budget=MAP_REDUCE_CHUNK_TOKEN_BUDGET)
+
+
+def _is_large_table(file_id: str) -> bool:
+    record = file_index.require(file_id)
+    return record.file_type in TABULAR_TYPES and record.size >= MAP_REDUCE_MIN_BYTES
+
+
+def build_file_prompt(file_id: str) -> str:
+    """
+    Summarize the whole file and sample its rows, within the prompt token budget.
+
+    Tables take their summary from their profile, so only the first
+    `PROFILE_SAMPLE_ROWS` rows are parsed, to sample from.
+    """
+    from sampling import build_table_prompt
+
+    record = file_index.require(file_id)
+    profile = _load_profile(record) if record.file_type in TABULAR_TYPES else None
+    if profile:
+        with timed("parse"):
+            df = load_file_frame(file_id, PROFILE_SAMPLE_ROWS)
+        ROWS_PARSED.inc(len(df))
+        logger.info(f"[LOG] Sampling {len(df)} rows, summarizing from the profile")
+        # every column profile counts all the rows, null or not
+        row_count = profile[0].count + profile[0].nulls
+        with timed("prompt"):
+            return build_table_prompt(df, profile=profile, row_count=row_count)
+
+    with timed("parse"):
+        df = load_file_frame(file_id)
+    ROWS_PARSED.inc(len(df))
+    logger.info(f"[LOG] Sampling {len(df)} rows to fit the prompt budget")
+    with timed("prompt"):
+        return build_table_prompt(df)
+
+
+def build_sheet_prompt(file_id: str, sheet: str) -> str:
+    """
+    Sample one sheet of a workbook into a prompt, within the token budget.
+    """
+    from sampling import build_table_prompt
+
+    record = file_index.require(file_id)
+    with timed("parse"):
+        df = read_sheet(
+            record.path, sheet, max_columns=PROMPT_MAX_COLUMNS, nrows=SAMPLING_MAX_ROWS
+        )
+    ROWS_PARSED.inc(len(df))
+    header = f"Sheet {sheet!r} of the workbook."
+    total_columns = df.attrs.get("total_columns", len(df.columns))
+    if total_columns > len(df.columns):
+        header += (
+            f" It has {total_columns} columns, only the first "
+            f"{len(df.columns)} were read."
+        )
+    with timed("prompt"):
+        return f"{header}\n{build_table_prompt(df)}"
+
+
+def load_file_frame(
+    file_id: str, nrows: Optional[int] = SAMPLING_MAX_ROWS
+) -> "pd.DataFrame":
+    """
+    Parse (up to `nrows` rows of) the uploaded file into a DataFrame.
+    """
+    import pandas as pd
+
+    # the index knows where the file is and what it is, no need to go looking
+    record = file_index.require(file_id)
+    file_path = record.path
 
     logger.info("[LOG] Attempting to parse file")
-    if ext in {".csv", ".xlsx", ".xls"}:
-        df = _read_dataframe(file_path, count)
+    if record.file_type in TABULAR_TYPES:
+        df = _read_dataframe(file_path, nrows)
         logger.info("[LOG] Parsed an Excel or CSV file successfully.")
-    elif ext in {".txt", "docx"}:
-        # read the file to file buffer in-memory, and for the specified count
-        # parse the count as "line count",
-        # and process the insights on information on `count` lines (count - n) as insights else:
-        lines = read_word_text_file(file_path, count)
+    elif record.file_type in {"txt", "docx"}:
+        # each line (or paragraph) becomes a row of the frame, the sampler then
+        # decides how many of them fit in the prompt
+        limit = min(nrows or TEXT_MAX_LINES, TEXT_MAX_LINES)
+        lines = read_word_text_file(file_path, limit)
         df = pd.DataFrame(lines, columns=["text"])
         logger.info("[LOG] Converted Word Document to DataFrame")
     else:
         # we don't recognize the file type and does not provide support for image type
         raise ValueError(
-            f"Unsupported file type: {ext}. Only CSV and Excel files are supported."
+            f"Unsupported file type: {record.file_type}. Only CSV, Excel, TXT and DOCX files are supported."
         )
+    return df
 
-    # when the processing is done, we will call the OpenRouter.ai API to generate insights
-    logger.info("[LOG] Attempting to generate AI insights")
-    ai_response = generate_ai_insights(df)  # make a call to OpenAI via OpenRouter.ai
-    logger.info("[LOG] Information generated successfully")
 
-    # finally convert the AI response into an Insight Schema object
-    # which would later be saved to the filesystem as a JSON file
+def build_insights(ai_response: list, count: int = 3) -> List[Insight]:
+    """
+    Convert the parsed AI response into Insight schema objects.
+    """
     # this would be a text content, so we have to cconvert to Insight schema object
-
-    # the approach: 
-    # we would jK;; map the list of dicts to Insight models directly
     insights = []
     for i, item in enumerate(ai_response[:count]):
-        try:
-            insight = Insight(
-                title=item.get("title", f"Insight {i + 1}"),
-                description=item.get("description", ""),
-                confidence_score=item.get("confidence_score", 0.9),
-                reference_rows=item.get("reference_rows", []),
-            )
+        insight = build_insight(item, i)
+        if insight is not None:
             insights.append(insight)
-        except Exception as e:
-            logger.error(f"[ERROR] Failed to parse insight {i}: {e}")
-            continue
 
     return insights
 
 
-def read_word_text_file(file_path: str, count: int = 5) -> List[str]:
+def build_insight(item: dict, index: int) -> Optional[Insight]:
     """
-    Attempts to read a text file, either plain text or Word document,
-    and returns the first `count` lines as a block of  text.
+    Convert one parsed insight into an Insight, or None if it is malformed.
     """
-    import os
-
-    import docx
-
-    ext = file_path.endswith((".txt", ".docx"))
-
-    if ext == ".docx":
-        # use python-docx to read Word documents
-        doc = docx.Document(file_path)
+    try:
+        return Insight(
+            title=item.get("title", f"Insight {index + 1}"),
+            description=item.get("description", ""),
+            confidence_score=item.get("confidence_score", 0.9),
+            reference_rows=item.get("reference_rows", []),
+        )
+    except Exception as e:
+        logger.error(f"[ERROR] Failed to parse insight {index}: {e}")
+        return None
 
-        # then read the  first `count` paragraphs
-        paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
 
-        # just some additional guard: we can never be too sure, return the first `count` paragraphs or all if less than `count`
-        return paragraphs[:count] if len(paragraphs) >= count else paragraphs
+def read_word_text_file(
+    file_path: str, count: int = 5, sample: bool = False
+) -> List[str]:
+    """
+    Attempts to read a text file, either plain text or Word document,
+    and returns the first `count` lines (or paragraphs) as a list of text.
 
-    else:
-        with open(file_path, "r") as f:
-            lines = f.readlines()
-            return lines[:count] if len(lines) >= count else lines
+    The document is streamed and reading stops after `count` lines. With
+    `sample`, `count` lines spread over the whole document are returned instead.
+    """
+    return read_text_lines(file_path, count, sample=sample)
 
 
-def persist_insights(file_id: str, insights: List[Insight]) -> None:
+def persist_insights(
+    file_id: str,
+    insights: List[Insight],
+    guard: Optional[Callable[[Session], bool]] = None,
+) -> bool:
     """
-    Save generated insights to the filesystem in JSON format.
+    Save generated insights to the database, replacing any earlier ones for
+    the file. The insights are written in one bulk insert.
+
+    `guard`, if given, is called first in the same transaction, and nothing
+    is saved (and False returned) unless it returns True, see
+    `jobs.JobQueue._run`.
     """
-    path = get_insights_path(file_id)
+    now = datetime.now(timezone.utc)
+    rows = [
+        {"file_id": file_id, "created_at": now, **insight.model_dump()}
+        for insight in insights
+    ]
     try:
-        with open(path, "w") as f:
-            json.dump([insight.dict() for insight in insights], f)
+        with timed("persist"), Session(engine) as session:
+            if guard is not None and not guard(session):
+                session.rollback()
+                return False
+            session.exec(delete(InsightRecord).where(InsightRecord.file_id == file_id))
+            if rows:
+                session.execute(insert(InsightRecord), rows)
+            session.commit()
             logger.info(f"[LOG] Insights saved for file ID: {file_id}")
+        insights_cache.invalidate(file_id)
+        return True
     except Exception as e:
         logger.error(f"[PersistError] Could not save insights: {e}")
         raise
 
 
-def retrieve_saved_insights(file_id: str) -> List[Insight]:
+INSIGHT_SORT_FIELDS = {
+    # "rank" is the order the model returned the insights in
+    "rank": InsightRecord.id,
+    "confidence_score": InsightRecord.confidence_score,
+    "title": InsightRecord.title,
+}
+
+
+def retrieve_saved_insights(
+    file_id: str,
+    min_confidence: Optional[float] = None,
+    max_confidence: Optional[float] = None,
+    search: Optional[str] = None,
+    sort_by: str = "rank",
+    order: str = "asc",
+    limit: Optional[int] = None,
+    offset: int = 0,
+    sheet: Optional[str] = None,
+) -> List[Insight]:
     """
-    Load previously saved insights from the filesystem.
+    Load previously saved insights from the database.
     Returns a list of Insight schema objects.
+
+    Insights can be filtered on their confidence score, on a search term in
+    their title or description and on their workbook sheet, sorted on any of `INSIGHT_SORT_FIELDS`, and
+    paginated with `limit`/`offset`.
     """
-    path = get_insights_path(file_id)
+    sort_column = INSIGHT_SORT_FIELDS[sort_by]
     try:
-        with open(path, "r") as f:
-            data = json.load(f)
-        return [Insight(**item) for item in data]
-    except FileNotFoundError as e:
-        raise InsightsNotFoundException(file_id) from e
+        with Session(engine) as session:
+            _ensure_insights_stored(session, file_id)
+            query = (
+                select(InsightRecord)
+                .where(
+                    *_insight_filters(
+                        file_id, min_confidence, max_confidence, search, sheet
+                    )
+                )
+                .order_by(sort_column.desc() if order == "desc" else sort_column.asc())
+                .offset(offset)
+                .limit(limit)
+            )
+            records = session.exec(query).all()
+        return [
+            Insight(
+                title=record.title,
+                description=record.description,
+                confidence_score=record.confidence_score,
+                reference_rows=record.reference_rows,
+                sheet=record.sheet,
+            )
+            for record in records
+        ]
+    except InsightsNotFoundException:
+        raise
     except Exception as e:
         logger.error(f"[RetrieveError] Could not load insights: {e}")
         raise
 
 
-def _read_dataframe(path: str, count: int = 20) -> pd.DataFrame:
-    # Reads a CSV or Excel file based on some row count
+def count_saved_insights(
+    file_id: str,
+    min_confidence: Optional[float] = None,
+    max_confidence: Optional[float] = None,
+    search: Optional[str] = None,
+    sheet: Optional[str] = None,
+) -> int:
+    """
+    Count the saved insights for a file that match the given filters.
+    """
+    with Session(engine) as session:
+        query = (
+            select(func.count())
+            .select_from(InsightRecord)
+            .where(
+                *_insight_filters(file_id, min_confidence, max_confidence, search, sheet)
+            )
+        )
+        return session.exec(query).one()
+
+
+def _insight_filters(
+    file_id: str,
+    min_confidence: Optional[float],
+    max_confidence: Optional[float],
+    search: Optional[str],
+    sheet: Optional[str] = None,
+) -> list:
+    filters = [InsightRecord.file_id == file_id]
+    if sheet is not None:
+        filters.append(InsightRecord.sheet == sheet)
+    if min_confidence is not None:
+        filters.append(InsightRecord.confidence_score >= min_confidence)
+    if max_confidence is not None:
+        filters.append(InsightRecord.confidence_score <= max_confidence)
+    if search:
+        pattern = f"%{search}%"
+        filters.append(
+            or_(
+                col(InsightRecord.title).ilike(pattern),
+                col(InsightRecord.description).ilike(pattern),
+            )
+        )
+    return filters
+
+
+def _ensure_insights_stored(session: Session, file_id: str) -> None:
+    # insights used to be stored as one JSON file per file ID: move those into
+    # the database the first time they're asked for
+    stored = session.exec(
+        select(InsightRecord.id).where(InsightRecord.file_id == file_id).limit(1)
+    ).first()
+    if stored is not None:
+        return
+
+    if not import_legacy_insights(file_id):
+        raise InsightsNotFoundException(file_id)
+
+
+def import_legacy_insights(file_id: str) -> bool:
+    """
+    Move the insights of a file stored as JSON by older versions into the
+    database, unless it already has insights there. Returns False when there
+    is no such JSON file.
+    """
+    path = get_insights_path(file_id)
+    if not os.path.exists(path):
+        return False
+    with Session(engine) as session:
+        stored = session.exec(
+            select(InsightRecord.id).where(InsightRecord.file_id == file_id).limit(1)
+        ).first()
+    if stored is None:
+        with open(path, "r") as f:
+            legacy = [Insight(**item) for item in json.load(f)]
+        persist_insights(file_id, legacy)
+        logger.info(f"[LOG] Migrated legacy insights file for file ID: {file_id}")
+    return True
+
+
+def _read_dataframe(path: str, count: Optional[int] = 20) -> "pd.DataFrame":
+    # Reads a CSV or Excel file based on some row count, from its columnar
+    # cache if it has one
     try:
-        if path.endswith(".xlsx") or path.endswith(".xls"):
-            return pd.read_excel(path, nrows=count)
-        return pd.read_csv(path, nrows=count)
+        return read_table(path, nrows=count)
     except Exception as e:
         logger.error(f"[ReadError] Could not read file {path}: {e}")
         raise
@@ -0,0 +1,72 @@
+"""
+Startup profiling and warm-up.
+
+The app imports none of its heavy dependencies (pandas, pyarrow, openpyxl,
+openai) at module level, so it boots quickly. `warm_up` then imports them on
+a background thread once the app is serving, timing each one; the profile is
+logged at startup. Whichever request comes first and needs one of them before
+the warm-up got to it simply imports it itself, as Python's import lock makes
+that safe.
+"""
+
+import importlib
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# in rough order of how soon a request needs them
+WARM_UP_MODULES = (
+    "pandas",
+    "pyarrow.parquet",
+    "openai",
+    "sampling",
+    "openpyxl",
+)
+
+import_profile: Dict[str, float] = {}
+
+
+def warm_up(
+    modules=WARM_UP_MODULES, after: Optional[Callable[[], None]] = None
+) -> threading.Thread:
+    """
+    Import `modules` on a daemon thread, recording how long each took, then
+    run `after` (e.g. creating the clients that need them) on the same thread.
+    """
+    thread = threading.Thread(
+        target=_import_all, args=(modules, after), name="warm-up", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def _import_all(modules, after: Optional[Callable[[], None]]) -> None:
+    start = time.perf_counter()
+    for name in modules:
+        elapsed = _timed_import(name)
+        if elapsed is not None:
+            import_profile[name] = elapsed
+    logger.info(
+        "Warmed up in %.2fs: %s",
+        time.perf_counter() - start,
+        ", ".join(f"{name} {seconds:.2f}s" for name, seconds in import_profile.items()),
+    )
+    if after is not None:
+        try:
+            after()
+        except Exception as e:
+            logger.warning("Warm-up failed: %s", e)
+
+
+def _timed_import(name: str) -> Optional[float]:
+    start = time.perf_counter()
+    try:
+        importlib.import_module(name)
+    except ImportError as e:
+        # optional dependencies (pyarrow) may be missing, that's fine
+        logger.info("Skipped warming up %s: %s", name, e)
+        return None
+    return time.perf_counter() - start
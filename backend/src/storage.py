@@ -0,0 +1,438 @@
+"""
+Where uploaded files are kept on disk, and for how long.
+
+Files are stored under `MEDIA_DIR` in subdirectories sharded on their file ID
+(`mediafiles/ab/cd/abcd...csv`, next to their columnar cache), see
+`utils.shard_path`, so no directory grows past a few thousand entries.
+
+A sweeper runs every `STORAGE_SWEEP_INTERVAL` seconds in each worker process,
+and:
+
+1. removes the files nobody looked up for `STORAGE_TTL` seconds, along with
+   their columnar cache and insights;
+2. removes the least recently looked up files while all of them together
+   take more than `STORAGE_MAX_BYTES`;
+3. compresses the originals nobody looked up for `STORAGE_COMPRESS_AFTER`
+   seconds with zstd, leaving their columnar cache (which most reads go to)
+   as is. A compressed file is restored the next time it's looked up, see
+   `file_index.FileIndex.get`;
+4. with `STORAGE_MIGRATE_FLAT_FILES`, moves files out of the unsharded
+   layout of older versions; and imports the insight JSON files they wrote
+   into `INSIGHT_DIR` into the database, `STORAGE_SWEEP_BATCH` of each at a
+   time.
+
+Files with a job queued or running are left alone. When a file was last
+looked up is kept in the `file` table, so every worker process goes by the
+same ages.
+"""
+
+import asyncio
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from fastapi.logger import logger
+from sqlalchemy import update
+from sqlmodel import Session, col, delete, exists, func, select
+
+from config.core import (
+    STORAGE_COMPRESS_AFTER,
+    STORAGE_MAX_BYTES,
+    STORAGE_MIGRATE_FLAT_FILES,
+    STORAGE_SWEEP_BATCH,
+    STORAGE_SWEEP_INTERVAL,
+    STORAGE_TTL,
+    UPLOAD_CHUNK_SIZE,
+    engine,
+)
+from executors import run_io
+from http_cache import insights_cache, preview_cache
+from models import FileRecord, JobRecord
+from models import Insight as InsightRecord
+from readers import CACHE_EXTENSION, parquet_cache_path
+from schemas import StorageStatsResponse, StorageSweepStats
+from utils import (
+    INSIGHT_DIR,
+    MEDIA_DIR,
+    MEDIA_ROOT,
+    UPLOAD_DIR,
+    file_lock,
+    shard_path,
+)
+
+COMPRESSED_EXTENSION = ".zst"
+# files with jobs in these states (see `jobs.JobStatus`) are never removed
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+
+def _zstd():
+    """The zstd module, if there is one: `open` works alike in both."""
+    try:
+        from compression import zstd  # Python 3.14+
+
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+
+        return zstandard
+    except ImportError:
+        return None
+
+
+def compression_available() -> bool:
+    return _zstd() is not None
+
+
+def compressed_path(path: str) -> str:
+    return path + COMPRESSED_EXTENSION
+
+
+def disk_usage(path: str) -> int:
+    """Bytes a stored file takes: its (compressed) original and columnar cache."""
+    return sum(
+        _size(candidate)
+        for candidate in (path, compressed_path(path), parquet_cache_path(path))
+    )
+
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _last_access():
+    return func.coalesce(FileRecord.accessed_at, FileRecord.created_at)
+
+
+def _idle():
+    # no job is waiting on the file, or generating insights for it
+    return ~exists().where(
+        JobRecord.file_id == FileRecord.file_id,
+        col(JobRecord.status).in_(ACTIVE_JOB_STATUSES),
+    )
+
+
+def restore_file(record: FileRecord) -> Optional[FileRecord]:
+    """
+    Decompress the original of a compressed file back in place. Returns None
+    if neither the original nor a compressed copy of it is on disk.
+    """
+    path = record.path
+    source = compressed_path(path)
+    with file_lock(path):
+        if os.path.exists(path):
+            # compressed in another process and restored again since, or the
+            # compression was interrupted: the original is as good
+            if os.path.exists(source):
+                os.remove(source)
+        elif os.path.exists(source):
+            zstd = _zstd()
+            if zstd is None:
+                logger.error(f"[Storage] {source} is compressed, but zstd isn't installed")
+                return None
+            tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                with zstd.open(source, "rb") as src, open(tmp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            os.remove(source)
+            logger.info(f"[Storage] Restored {path}")
+        else:
+            logger.warning(f"[Storage] The file of {record.file_id} is missing")
+            return None
+        record.compressed = None
+        record.stored_size = disk_usage(path)
+        _update(record.file_id, compressed=None, stored_size=record.stored_size)
+    return record
+
+
+def compress_file(record: FileRecord, cold_since: datetime) -> bool:
+    """
+    Compress the original of a file, unless it was looked up after
+    `cold_since` (or has gone) in the meantime.
+    """
+    zstd = _zstd()
+    path = record.path
+    target = compressed_path(path)
+    with file_lock(path):
+        with Session(engine) as session:
+            accessed = session.exec(
+                select(_last_access()).where(FileRecord.file_id == record.file_id)
+            ).first()
+        if accessed is None or accessed >= cold_since or not os.path.exists(path):
+            return False
+        tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(path, "rb") as src, zstd.open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        os.remove(path)
+        _update(record.file_id, compressed=True, stored_size=disk_usage(path))
+    return True
+
+
+def remove_file(record: FileRecord) -> Optional[int]:
+    """
+    Remove a stored file, its columnar cache and insights, returning the
+    bytes freed, or None if a job queued or running for the file kept it, or
+    it was used since `record` was read.
+    """
+    last_access = record.accessed_at or record.created_at
+    freed = 0
+    # the same content uploaded again finds the file (see
+    # `utils.store_staged_file`) either before we take the lock, and marks it
+    # as used, or after we're done, and stores it afresh
+    with file_lock(record.path):
+        with Session(engine) as session:
+            # checked in the same statement as the delete, so a job can't
+            # sneak in
+            removed = session.exec(
+                delete(FileRecord).where(
+                    FileRecord.file_id == record.file_id,
+                    _idle(),
+                    _last_access() <= last_access,
+                )
+            ).rowcount
+            if not removed:
+                session.rollback()
+                return None
+            session.exec(
+                delete(InsightRecord).where(InsightRecord.file_id == record.file_id)
+            )
+            session.commit()
+        for path in (
+            record.path,
+            compressed_path(record.path),
+            parquet_cache_path(record.path),
+        ):
+            if os.path.exists(path):
+                freed += _size(path)
+                os.remove(path)
+    # only this process's caches: the others notice the file is gone when
+    # they look it up, see `http_cache`
+    preview_cache.invalidate(record.file_id)
+    insights_cache.invalidate(record.file_id)
+    return freed
+
+
+def _update(file_id: str, **values) -> None:
+    with Session(engine) as session:
+        session.exec(update(FileRecord).where(FileRecord.file_id == file_id).values(**values))
+        session.commit()
+
+
+def _records(query) -> List[FileRecord]:
+    with Session(engine, expire_on_commit=False) as session:
+        return list(session.exec(query).all())
+
+
+def sweep() -> StorageSweepStats:
+    """Apply the retention rules once, see the module docstring."""
+    started_at, start = _now(), time.perf_counter()
+    expired = evicted = compressed = freed = 0
+
+    if STORAGE_TTL:
+        cutoff = started_at - timedelta(seconds=STORAGE_TTL)
+        for record in _records(select(FileRecord).where(_last_access() < cutoff, _idle())):
+            removed = remove_file(record)
+            if removed is not None:
+                freed += removed
+                expired += 1
+
+    if STORAGE_MAX_BYTES:
+        with Session(engine) as session:
+            total = session.exec(
+                select(func.sum(func.coalesce(FileRecord.stored_size, FileRecord.size)))
+            ).one() or 0
+        if total > STORAGE_MAX_BYTES:
+            # least recently looked up first
+            query = (
+                select(FileRecord)
+                .where(_idle())
+                .order_by(_last_access())
+                .limit(STORAGE_SWEEP_BATCH)
+            )
+            while total > STORAGE_MAX_BYTES:
+                removed_any = False
+                for record in _records(query):
+                    if total <= STORAGE_MAX_BYTES:
+                        break
+                    removed = remove_file(record)
+                    if removed is None:
+                        continue
+                    total -= record.stored_size or record.size
+                    freed += removed
+                    evicted += 1
+                    removed_any = True
+                if not removed_any:
+                    # what's left is all in use
+                    break
+
+    if STORAGE_COMPRESS_AFTER and compression_available():
+        cold_since = started_at - timedelta(seconds=STORAGE_COMPRESS_AFTER)
+        records = _records(
+            select(FileRecord)
+            .where(col(FileRecord.compressed).is_(None), _last_access() < cold_since)
+            .limit(STORAGE_SWEEP_BATCH)
+        )
+        for record in records:
+            # unsharded files are moved (below) before they are compressed
+            if os.path.dirname(record.path) == str(MEDIA_DIR):
+                continue
+            before = record.stored_size or record.size
+            if compress_file(record, cold_since):
+                freed += max(before - disk_usage(record.path), 0)
+                compressed += 1
+
+    migrated = 0
+    if STORAGE_MIGRATE_FLAT_FILES:
+        migrated += _migrate_flat_files(STORAGE_SWEEP_BATCH)
+    migrated += _migrate_legacy_insights(STORAGE_SWEEP_BATCH)
+
+    stats = StorageSweepStats(
+        started_at=started_at,
+        duration_ms=(time.perf_counter() - start) * 1000,
+        expired=expired,
+        evicted=evicted,
+        compressed=compressed,
+        migrated=migrated,
+        freed_bytes=freed,
+    )
+    if expired or evicted or compressed or migrated:
+        logger.info(
+            f"[Storage] Expired {expired}, evicted {evicted}, compressed "
+            f"{compressed} and moved {migrated} files, freeing {freed} bytes"
+        )
+    return stats
+
+
+def _migrate_flat_files(limit: int) -> int:
+    # files stored straight in MEDIA_DIR by older versions: move them, with
+    # their columnar cache, into their shard
+    moved = 0
+    with os.scandir(MEDIA_DIR) as entries:
+        originals = [
+            entry.path
+            for entry in entries
+            if entry.is_file()
+            and not entry.name.startswith(".")
+            and not entry.name.endswith(CACHE_EXTENSION)
+        ]
+    for path in originals[:limit]:
+        target = str(shard_path(MEDIA_DIR, os.path.basename(path)))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # the cache first: a reader finding the original but not its cache
+        # reads the original, which is slower but still right
+        if os.path.exists(parquet_cache_path(path)):
+            os.replace(parquet_cache_path(path), parquet_cache_path(target))
+        # the record is updated in the same transaction as the move, which is
+        # only committed once the file is in place (readers in the meantime
+        # find it there, see `file_index.FileIndex._load`)
+        with Session(engine) as session:
+            session.exec(update(FileRecord).where(FileRecord.path == path).values(path=target))
+            os.replace(path, target)
+            session.commit()
+        moved += 1
+    return moved
+
+
+def _migrate_legacy_insights(limit: int) -> int:
+    # insights used to be stored as a JSON file per file ID: nothing writes
+    # those anymore, so import whatever is left into the database
+    from services import import_legacy_insights
+
+    if not INSIGHT_DIR.exists():
+        return 0
+    moved = 0
+    with os.scandir(INSIGHT_DIR) as entries:
+        paths = [entry.path for entry in entries if entry.name.endswith(".json")]
+    for path in paths[:limit]:
+        file_id = os.path.basename(path).removesuffix(".json")
+        try:
+            import_legacy_insights(file_id)
+        except Exception as e:
+            logger.warning(f"[Storage] Could not import legacy insights {path}: {e}")
+            continue
+        os.remove(path)
+        moved += 1
+    return moved
+
+
+def storage_stats() -> StorageStatsResponse:
+    """How much the stored files take, and how the last sweep went."""
+    with Session(engine) as session:
+        files, stored_bytes, original_bytes, compressed_files = session.exec(
+            select(
+                func.count(),
+                func.sum(func.coalesce(FileRecord.stored_size, FileRecord.size)),
+                func.sum(FileRecord.size),
+                func.count(FileRecord.compressed),
+            )
+        ).one()
+    with os.scandir(UPLOAD_DIR) as entries:
+        staging_bytes = sum(entry.stat().st_size for entry in entries if entry.is_file())
+    disk = shutil.disk_usage(MEDIA_ROOT)
+    return StorageStatsResponse(
+        files=files,
+        stored_bytes=stored_bytes or 0,
+        original_bytes=original_bytes or 0,
+        compressed_files=compressed_files,
+        staging_bytes=staging_bytes,
+        disk_total_bytes=disk.total,
+        disk_free_bytes=disk.free,
+        ttl=STORAGE_TTL,
+        max_bytes=STORAGE_MAX_BYTES,
+        compress_after=STORAGE_COMPRESS_AFTER,
+        compression_available=compression_available(),
+        last_sweep=storage_sweeper.last_sweep,
+    )
+
+
+class StorageSweeper:
+    """Runs `sweep` in the background, every `interval` seconds."""
+
+    def __init__(self, interval: float = STORAGE_SWEEP_INTERVAL):
+        self.interval = interval
+        self.last_sweep: Optional[StorageSweepStats] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if not self.interval:
+            return
+        if STORAGE_COMPRESS_AFTER and not compression_available():
+            logger.info("[Storage] zstd isn't installed, files won't be compressed")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.last_sweep = await run_io(sweep)
+            except Exception as e:
+                logger.error(f"[Storage] Sweep failed: {e}")
+
+
+storage_sweeper = StorageSweeper()
@@ -0,0 +1,16 @@
+"""
+Helpers for streaming insights to clients while the model is still writing.
+
+Reasoning models take a long time to finish a completion, but the insights
+they return come one object at a time. `extraction.InsightStreamParser` picks
+each insight out of the completion as soon as its closing brace arrives, so it
+can be forwarded (as a Server-Sent Event) long before the completion is done.
+"""
+
+import json
+from typing import Any
+
+
+def format_sse(event: str, data: Any) -> str:
+    """Encode one Server-Sent Event, with `data` as (single-line) JSON."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
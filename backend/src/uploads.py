@@ -0,0 +1,392 @@
+"""
+Resumable uploads.
+
+`/api/upload` takes a whole file in one request, so an upload failing at 90%
+has to start over. Large files can be sent in parts instead:
+
+1. `POST /api/uploads` with the file's name and size starts an upload. The
+   file is preallocated under `UPLOAD_DIR`, and the client is told the part
+   size.
+2. `PUT /api/uploads/{id}/parts/{n}` sends part n (counting from 1), with
+   its SHA-256 in the `X-Part-SHA256` header. Parts are written straight at
+   their offset in the file, so they can be sent in any order, in parallel,
+   and sent again after a failure.
+3. `GET /api/uploads/{id}` lists the parts received so far, to resume from.
+4. `POST /api/uploads/{id}/complete` hashes the assembled file and moves it
+   (without copying) into `MEDIA_DIR` under its content-derived file ID,
+   like a file sent to `/api/upload`.
+
+Completing an upload and writing its parts exclude each other: every part
+being written holds a lease on the upload, and the upload is only marked
+completing (with a conditional update) while it has no live lease, after which
+no part is let in. Leases are renewed as parts stream in, so one left behind
+by a crashed writer lapses after `UPLOAD_WRITE_LEASE_SECONDS` rather than
+blocking the upload for good.
+
+Uploads are kept in the database, so parts may go through any worker process.
+"""
+
+import hashlib
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.logger import logger
+from sqlalchemy import exists, update
+from sqlmodel import Session, delete, select
+
+from config.core import (
+    MAX_UPLOAD_SIZE,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_MAX_PART_SIZE,
+    UPLOAD_PART_SIZE,
+    UPLOAD_SESSION_TTL,
+    UPLOAD_WRITE_LEASE_SECONDS,
+    engine,
+)
+from exceptions import (
+    FileTooLargeException,
+    InvalidUploadPartException,
+    UploadIncompleteException,
+    UploadNotFoundException,
+)
+from executors import run_io
+from models import UploadPart, UploadSession, UploadWrite
+from utils import UPLOAD_DIR, ContentDigest, StoredFile, store_staged_file
+
+MIN_PART_SIZE = 64 * 1024
+MAX_PARTS = 10_000
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _upload_path(upload_id: str) -> str:
+    return str(UPLOAD_DIR / f"{upload_id}.upload")
+
+
+def part_count(upload: UploadSession) -> int:
+    return -(-upload.size // upload.part_size)
+
+
+def expires_at(upload: UploadSession) -> datetime:
+    return upload.updated_at + timedelta(seconds=UPLOAD_SESSION_TTL)
+
+
+def create_upload(
+    filename: str, size: int, part_size: Optional[int] = None
+) -> UploadSession:
+    """
+    Start a resumable upload of a file of `size` bytes, preallocating it.
+    """
+    part_size = part_size or UPLOAD_PART_SIZE
+    if size > MAX_UPLOAD_SIZE:
+        raise FileTooLargeException(MAX_UPLOAD_SIZE)
+    if part_size > UPLOAD_MAX_PART_SIZE or (part_size < MIN_PART_SIZE < size):
+        raise InvalidUploadPartException(
+            f"Part size must be between {MIN_PART_SIZE} and {UPLOAD_MAX_PART_SIZE} bytes"
+        )
+    if -(-size // part_size) > MAX_PARTS:
+        raise InvalidUploadPartException(
+            f"An upload can have at most {MAX_PARTS} parts, use larger parts"
+        )
+
+    _prune()
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        filename=filename,
+        size=size,
+        part_size=min(part_size, size),
+        status="uploading",
+        created_at=_now(),
+        updated_at=_now(),
+    )
+    _preallocate(_upload_path(upload.id), size)
+    with Session(engine, expire_on_commit=False) as session:
+        session.add(upload)
+        session.commit()
+    logger.info(f"[Uploads] Started upload {upload.id} of {size} bytes")
+    return upload
+
+
+def get_upload(upload_id: str) -> Tuple[UploadSession, List[int]]:
+    """The upload, and the numbers of the parts received so far."""
+    with Session(engine, expire_on_commit=False) as session:
+        upload = session.get(UploadSession, upload_id)
+        if upload is None or expires_at(upload) < _now():
+            raise UploadNotFoundException(upload_id)
+        received = session.exec(
+            select(UploadPart.part_number)
+            .where(UploadPart.upload_id == upload_id)
+            .order_by(UploadPart.part_number)
+        ).all()
+    return upload, list(received)
+
+
+async def write_part(
+    upload_id: str, part_number: int, body: AsyncIterator[bytes], sha256: str
+) -> UploadPart:
+    """
+    Write part `part_number` of an upload at its offset in the file, as it
+    streams in, and record it once its size and checksum check out.
+    """
+    upload, _ = await run_io(get_upload, upload_id)
+    if not 1 <= part_number <= part_count(upload):
+        raise InvalidUploadPartException(
+            f"Part number must be between 1 and {part_count(upload)}"
+        )
+    offset = (part_number - 1) * upload.part_size
+    expected = min(upload.part_size, upload.size - offset)
+
+    lease_id = await run_io(_start_writing, upload_id, part_number)
+    if lease_id is None:
+        raise HTTPException(status_code=409, detail="The upload is being completed")
+    try:
+        return await _write_part(
+            upload_id, part_number, body, sha256, offset, expected, lease_id
+        )
+    finally:
+        await run_io(_stop_writing, lease_id)
+
+
+async def _write_part(
+    upload_id: str,
+    part_number: int,
+    body: AsyncIterator[bytes],
+    sha256: str,
+    offset: int,
+    expected: int,
+    lease_id: str,
+) -> UploadPart:
+    writer = await run_io(_PartWriter, _upload_path(upload_id), offset)
+    renewed = time.monotonic()
+
+    async def write(data: bytes) -> None:
+        nonlocal renewed
+        # check in before writing, so nothing is written once the lease has
+        # lapsed and the upload may have been completed without this part
+        if time.monotonic() - renewed > UPLOAD_WRITE_LEASE_SECONDS / 3:
+            if not await run_io(_renew_writing, upload_id, lease_id):
+                raise HTTPException(
+                    status_code=409, detail="The upload is being completed"
+                )
+            renewed = time.monotonic()
+        await run_io(writer.write, data)
+
+    try:
+        # hand the disk writes to the I/O threads in chunks, not per packet
+        buffer = bytearray()
+        async for chunk in body:
+            buffer += chunk
+            if writer.size + len(buffer) > expected:
+                raise InvalidUploadPartException(
+                    f"Part {part_number} must be {expected} bytes"
+                )
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                await write(bytes(buffer))
+                buffer.clear()
+        if buffer:
+            await write(bytes(buffer))
+    finally:
+        await run_io(writer.close)
+
+    if writer.size != expected:
+        raise InvalidUploadPartException(f"Part {part_number} must be {expected} bytes")
+    digest = writer.hasher.hexdigest()
+    if digest != sha256.strip().lower():
+        # whatever was written is overwritten when the part is sent again
+        raise InvalidUploadPartException(
+            f"Checksum mismatch for part {part_number}: got SHA-256 {digest}"
+        )
+    part = UploadPart(
+        upload_id=upload_id,
+        part_number=part_number,
+        size=writer.size,
+        sha256=digest,
+        created_at=_now(),
+    )
+    await run_io(_record_part, part)
+    return part
+
+
+def complete_upload(upload_id: str) -> StoredFile:
+    """
+    Check every part of the upload arrived, then store the assembled file
+    like any other upload, see `utils.store_staged_file`.
+    """
+    get_upload(upload_id)
+    if not _claim(upload_id):
+        raise HTTPException(
+            status_code=409,
+            detail="The upload is being completed, or parts of it are still being sent",
+        )
+    # no part can be written anymore: what's recorded now is what we have
+    upload, received = get_upload(upload_id)
+    missing = sorted(set(range(1, part_count(upload) + 1)) - set(received))
+    if missing:
+        _unclaim(upload_id)
+        raise UploadIncompleteException(missing)
+
+    path = _upload_path(upload_id)
+    try:
+        # the file ID is the hash of the whole content, which the hashes of
+        # the parts don't give us: read the file through once
+        digest = ContentDigest()
+        with open(path, "rb") as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+        ext = upload.filename.split(".")[-1].lower()
+        stored = store_staged_file(path, ext, digest)
+    finally:
+        _delete(upload_id)
+    logger.info(f"[Uploads] Completed upload {upload_id} as file {stored.file_id}")
+    return stored
+
+
+def abort_upload(upload_id: str) -> None:
+    """Drop an upload and whatever was received of it."""
+    get_upload(upload_id)
+    _delete(upload_id)
+
+
+class _PartWriter:
+    # runs on the I/O threads, one call at a time
+    def __init__(self, path: str, offset: int):
+        self.file = open(path, "r+b")
+        self.file.seek(offset)
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self.hasher.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def _preallocate(path: str, size: int) -> None:
+    with open(path, "wb") as f:
+        try:
+            # reserve the disk space now, so a full disk fails the upload
+            # before any part is sent
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            f.truncate(size)
+
+
+def _record_part(part: UploadPart) -> None:
+    with Session(engine) as session:
+        # a part sent again replaces the earlier one
+        session.merge(part)
+        session.exec(
+            update(UploadSession)
+            .where(UploadSession.id == part.upload_id)
+            .values(updated_at=_now())
+        )
+        session.commit()
+
+
+def _start_writing(upload_id: str, part_number: int) -> Optional[str]:
+    # parts are only let in until the upload is being completed; the upload's
+    # row is updated first so that this and `_claim` can't interleave
+    lease_id = uuid.uuid4().hex
+    with Session(engine) as session:
+        result = session.exec(
+            update(UploadSession)
+            .where(UploadSession.id == upload_id, UploadSession.status == "uploading")
+            .values(updated_at=_now())
+        )
+        if result.rowcount != 1:
+            return None
+        session.add(
+            UploadWrite(
+                id=lease_id,
+                upload_id=upload_id,
+                part_number=part_number,
+                writing_since=_now(),
+            )
+        )
+        session.commit()
+    return lease_id
+
+
+def _renew_writing(upload_id: str, lease_id: str) -> bool:
+    # a lapsed lease can still be renewed, as long as nobody took the chance
+    # to complete (or drop) the upload in the meantime
+    uploading = exists().where(
+        UploadSession.id == upload_id, UploadSession.status == "uploading"
+    )
+    with Session(engine) as session:
+        result = session.exec(
+            update(UploadWrite)
+            .where(UploadWrite.id == lease_id, uploading)
+            .values(writing_since=_now())
+        )
+        session.commit()
+        return result.rowcount == 1
+
+
+def _stop_writing(lease_id: str) -> None:
+    with Session(engine) as session:
+        session.exec(delete(UploadWrite).where(UploadWrite.id == lease_id))
+        session.commit()
+
+
+def _claim(upload_id: str) -> bool:
+    # only one request gets to complete an upload, and only once no part is
+    # being written (by a writer that is still checking in)
+    stale = _now() - timedelta(seconds=UPLOAD_WRITE_LEASE_SECONDS)
+    writing = exists().where(
+        UploadWrite.upload_id == upload_id, UploadWrite.writing_since >= stale
+    )
+    with Session(engine) as session:
+        result = session.exec(
+            update(UploadSession)
+            .where(
+                UploadSession.id == upload_id,
+                UploadSession.status == "uploading",
+                ~writing,
+            )
+            .values(status="completing", updated_at=_now())
+        )
+        session.commit()
+        return result.rowcount == 1
+
+
+def _unclaim(upload_id: str) -> None:
+    with Session(engine) as session:
+        session.exec(
+            update(UploadSession)
+            .where(UploadSession.id == upload_id, UploadSession.status == "completing")
+            .values(status="uploading", updated_at=_now())
+        )
+        session.commit()
+
+
+def _delete(upload_id: str) -> None:
+    with Session(engine) as session:
+        session.exec(delete(UploadPart).where(UploadPart.upload_id == upload_id))
+        session.exec(delete(UploadWrite).where(UploadWrite.upload_id == upload_id))
+        session.exec(delete(UploadSession).where(UploadSession.id == upload_id))
+        session.commit()
+    path = _upload_path(upload_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _prune() -> None:
+    # drop uploads nobody sent a part to for UPLOAD_SESSION_TTL seconds
+    cutoff = _now() - timedelta(seconds=UPLOAD_SESSION_TTL)
+    with Session(engine) as session:
+        expired = session.exec(
+            select(UploadSession.id).where(UploadSession.updated_at < cutoff)
+        ).all()
+    for upload_id in expired:
+        logger.info(f"[Uploads] Dropping abandoned upload {upload_id}")
+        _delete(upload_id)
@@ -1,28 +1,94 @@
+import csv
+import hashlib
 import os
-import random
+import threading
 import uuid
+import zipfile
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Iterator, Optional
 
 from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+
+from config.core import MAX_UPLOAD_SIZE, PREVIEW_HEAD_SIZE, UPLOAD_CHUNK_SIZE
+from exceptions import FileTooLargeException, InvalidFileTypeException
 
 BASE_PATH = Path(__file__).resolve().parent
-MEDIA_DIR = BASE_PATH / "mediafiles"
-UPLOAD_DIR = BASE_PATH / "uploads"
-INSIGHT_DIR = BASE_PATH / "insights"
+# uploads and insights live next to the app unless MEDIA_ROOT says otherwise
+MEDIA_ROOT = Path(os.getenv("MEDIA_ROOT", BASE_PATH))
+MEDIA_DIR = MEDIA_ROOT / "mediafiles"
+UPLOAD_DIR = MEDIA_ROOT / "uploads"
+INSIGHT_DIR = MEDIA_ROOT / "insights"
+LOCK_NAME = ".lock"
+
+# without fcntl, files are only locked against the other threads of this process
+_thread_lock = threading.Lock()
+
+
+def ensure_media_dirs() -> None:
+    """Create the upload and insight directories, if they don't exist yet."""
+    for directory in (MEDIA_DIR, UPLOAD_DIR, INSIGHT_DIR):
+        directory.mkdir(parents=True, exist_ok=True)
 
-for directory in (MEDIA_DIR, UPLOAD_DIR, INSIGHT_DIR):
-    directory.mkdir(parents=True, exist_ok=True)
 
+def generate_file_id(content_hash: Optional[str] = None, ext: str = "") -> str:
+    """
+    Generate a unique file ID.
 
-def generate_file_id() -> str:
-    """Generate a unique file ID."""
+    When the content hash of the file is known, the ID is derived from it (and
+    the extension, since the same bytes parse differently as CSV or TXT), so
+    identical uploads resolve to the same file ID.
+    """
+    if content_hash:
+        return hashlib.sha256(f"{ext}:{content_hash}".encode()).hexdigest()[:32]
     # converts the UUID to a string, converting the hypens to underscores
     # and returns it
     return str(uuid.uuid4()).replace("-", "_")
 
 
+def shard_path(directory: Path, name: str) -> Path:
+    """
+    Where a file named after a file ID lives under `directory`: two levels of
+    subdirectories named after the start of the ID, so that no directory ends
+    up holding more than a few thousand files.
+    """
+    return directory / name[:2] / name[2:4] / name
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """
+    Lock the shard directory of a stored file: storing, compressing, restoring
+    and removing files take turns within each shard, across worker processes.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        # nothing there to take turns on
+        yield
+        return
+    try:
+        import fcntl
+    except ImportError:
+        with _thread_lock:
+            yield
+        return
+    with open(os.path.join(directory, LOCK_NAME), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def resolve_file_path(file_id: str, ext: str = "xlsx") -> str:
     """Resolve the file path for a given file ID."""
+    return str(shard_path(MEDIA_DIR, f"{file_id}.{ext}"))
+
+
+def legacy_file_path(file_id: str, ext: str) -> str:
+    """Where files were stored before `MEDIA_DIR` was sharded."""
     return os.path.join(MEDIA_DIR, f"{file_id}.{ext}")
 
 
@@ -33,21 +99,244 @@ def get_insights_path(file_id: str) -> str:
     return str(INSIGHT_DIR / f"{file_id}.json")
 
 
-def save_file(file: UploadFile, file_id: str):
-    ext = file.filename.split(".")[-1]
-    path = resolve_file_path(file_id, ext)
+@dataclass
+class StoredFile:
+    """
+    Result of streaming an upload to disk.
+
+    Attributes:
+        file_id (str): Content-derived identifier of the file.
+        path (str): Where the upload was written.
+        file_type (str): Detected type, also the file's extension on disk.
+        size (int): Number of bytes written.
+        sha256 (str): Hex digest of the uploaded content.
+        head (bytes): The first few KB of the upload, kept for previews.
+        line_count (int): Number of lines in the upload, for text formats.
+        duplicate (bool): Whether identical content had already been uploaded.
+    """
+
+    file_id: str
+    path: str
+    file_type: str
+    size: int
+    sha256: str
+    head: bytes
+    line_count: Optional[int] = None
+    duplicate: bool = False
 
-    with open(path, "wb") as f:
-        f.write(file.file.read())
-    return path
+    @property
+    def head_lines(self) -> bytes:
+        """The preview head, cut back to the last complete line."""
+        if self.size <= len(self.head):
+            return self.head
+        return self.head[: self.head.rfind(b"\n") + 1]
 
 
-def generate_insights(file_id: str):
+class ContentDigest:
     """
-    Simulate insight generation for a file.
+    What we learn about a file while streaming it: its size, SHA-256, preview
+    head and number of lines.
+    """
+
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.head = bytearray()
+        self.size = 0
+        self.newlines = 0
+
+    def update(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if len(self.head) < PREVIEW_HEAD_SIZE:
+            self.head += chunk[: PREVIEW_HEAD_SIZE - len(self.head)]
+        self.hasher.update(chunk)
+        self.newlines += chunk.count(b"\n")
+
 
-    - Make call to our MCP server
-    - Return resposne to generate_insights_data service function call
+def save_file(file: UploadFile) -> StoredFile:
     """
-    # Placeholder logic for actual OpenRouter call or mock generation
-    pass
+    Copy the uploaded file to disk in fixed-size chunks.
+
+    By the time this runs Starlette has already spooled the request body (to
+    a temporary file once it outgrows memory); requests that are too large
+    are turned away while they stream in, by `UploadSizeLimitMiddleware`.
+    Here every chunk is hashed and written as it is copied, and we bail out
+    (removing the partial file) should it still grow past `MAX_UPLOAD_SIZE`.
+
+    The file is staged under `UPLOAD_DIR` and only moved into `MEDIA_DIR` once
+    its content hash (and so its file ID) is known, see `store_staged_file`.
+    """
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise FileTooLargeException(MAX_UPLOAD_SIZE)
+
+    ext = file.filename.split(".")[-1].lower()
+    path = str(UPLOAD_DIR / f"{uuid.uuid4().hex}.part")
+
+    digest = ContentDigest()
+    try:
+        with open(path, "wb") as f:
+            while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+                if digest.size + len(chunk) > MAX_UPLOAD_SIZE:
+                    raise FileTooLargeException(MAX_UPLOAD_SIZE)
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        # never leave half-written uploads lying around
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return store_staged_file(path, ext, digest)
+
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware rejecting form uploads to `path` that are too large with
+    a 413, before their body has been spooled: straight away when the
+    Content-Length says so, otherwise as soon as more than that has arrived.
+
+    The limit is `MAX_UPLOAD_SIZE` plus some room for the multipart framing
+    around the file. Register it inside `CORSMiddleware`, so that browsers
+    get to read the 413.
+    """
+
+    def __init__(self, app, path: str, slack: int = 64 * 1024):
+        self.app = app
+        self.path = path
+        self.limit = MAX_UPLOAD_SIZE + slack
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        for key, value in scope.get("headers", []):
+            if key == b"content-length" and value.isdigit() and int(value) > self.limit:
+                await self._reject(scope, receive, send)
+                return
+
+        received = 0
+        too_large = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            if too_large:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.limit:
+                    # stop the form parser as if the client had gone away,
+                    # the 413 is sent once the app has given up
+                    too_large = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            # whatever the app answers to the cut off body is dropped
+            if not too_large:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not too_large:
+                raise
+        if too_large:
+            await self._reject(scope, receive, send)
+
+    @staticmethod
+    async def _reject(scope, receive, send):
+        exc = FileTooLargeException(MAX_UPLOAD_SIZE)
+        response = JSONResponse(
+            status_code=exc.status_code,
+            content={"detail": exc.detail},
+            headers={"Connection": "close"},
+        )
+        await response(scope, receive, send)
+
+
+def store_staged_file(path: str, ext: str, digest: ContentDigest) -> StoredFile:
+    """
+    Move a fully written upload from `UPLOAD_DIR` into `MEDIA_DIR`, under the
+    file ID derived from its content.
+
+    If that content is already stored, the staged copy is dropped and the
+    existing file is reused (and marked as used, so that `storage` doesn't
+    remove it before the upload is indexed). Files of an unsupported type are
+    removed.
+    """
+    head = bytes(digest.head)
+    try:
+        # go by what the file is, not what it's called
+        file_type = detect_file_type(path, head, ext)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    sha256 = digest.hasher.hexdigest()
+    file_id = generate_file_id(sha256, file_type)
+    final_path = resolve_file_path(file_id, file_type)
+
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    with file_lock(final_path):
+        duplicate = os.path.exists(final_path)
+        if duplicate:
+            os.remove(path)
+            from file_index import file_index
+
+            file_index.mark_used(file_id)
+        else:
+            os.replace(path, final_path)
+
+    return StoredFile(
+        file_id=file_id,
+        path=final_path,
+        file_type=file_type,
+        size=digest.size,
+        sha256=sha256,
+        head=head,
+        line_count=digest.newlines if file_type in TEXT_TYPES else None,
+        duplicate=duplicate,
+    )
+
+
+ZIP_MAGIC = b"PK\x03\x04"
+OLE_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+TEXT_TYPES = {"csv", "txt"}
+
+
+def detect_file_type(path: str, head: bytes, ext: str = "") -> str:
+    """
+    Detect the type of a file from its leading (magic) bytes.
+
+    Returns one of "xlsx", "docx", "xls", "csv" or "txt". The extension is only
+    used to break ties between the text formats, which have no magic bytes.
+    """
+    if head.startswith(ZIP_MAGIC):
+        # both Office Open XML formats are zip archives, tell them apart by
+        # their main part
+        try:
+            with zipfile.ZipFile(path) as archive:
+                names = set(archive.namelist())
+        except zipfile.BadZipFile:
+            raise InvalidFileTypeException("corrupt zip archive")
+        if "xl/workbook.xml" in names:
+            return "xlsx"
+        if "word/document.xml" in names:
+            return "docx"
+        raise InvalidFileTypeException("zip archive")
+
+    if head.startswith(OLE_MAGIC):
+        return "xls"
+
+    if b"\x00" in head:
+        raise InvalidFileTypeException(ext or "binary")
+    if ext in TEXT_TYPES:
+        return ext
+
+    # no telling extension: call it CSV if it sniffs like comma separated data
+    sample = head.decode("utf-8", errors="ignore")
+    try:
+        csv.Sniffer().sniff(sample[:4096], delimiters=",")
+        return "csv"
+    except csv.Error:
+        return "txt"
@@ -0,0 +1,134 @@
+"""
+Shared setup: the app is pointed at a scratch database and media directory
+before any of its modules are imported, and `src` is put on the path.
+
+The `client` fixture runs the app (startup and shutdown included) for the
+tests of a module, and `model` stands in for the OpenRouter client, answering
+every completion from a script.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+SCRATCH = tempfile.mkdtemp(prefix="insights-tests-")
+
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(SCRATCH) / 'test.db'}"
+os.environ["MEDIA_ROOT"] = str(Path(SCRATCH) / "media")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+os.environ["LLM_CACHE_ENABLED"] = "false"
+os.environ["LLM_MAX_RETRIES"] = "0"
+os.environ["PARSE_WORKERS"] = "0"
+os.environ["JOB_POLL_INTERVAL"] = "0.05"
+os.environ["WARM_UP_ON_STARTUP"] = "false"
+os.environ["STORAGE_SWEEP_INTERVAL"] = "0"
+sys.path.insert(0, str(SRC_DIR))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    from config.core import create_db_and_tables
+    from utils import ensure_media_dirs
+
+    create_db_and_tables()
+    ensure_media_dirs()
+
+
+@pytest.fixture(scope="module")
+def client():
+    from fastapi.testclient import TestClient
+
+    from main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+def upload(client, content: bytes, filename: str = "data.csv") -> str:
+    """Upload `content` through `/api/upload`, returning its file ID."""
+    response = client.post("/api/upload", files={"file": (filename, content)})
+    assert response.status_code == 200, response.text
+    return response.json()["file_id"]
+
+
+def wait_for_job(client, job_id: str, timeout: float = 10) -> dict:
+    """Poll `/jobs/{job_id}` until the job has finished, returning it."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/api/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        assert time.monotonic() < deadline, f"job still {job['status']}"
+        time.sleep(0.02)
+
+
+def insights_json(*titles: str) -> str:
+    """A model answer holding an insight per title."""
+    return json.dumps(
+        [
+            {
+                "title": title,
+                "description": f"About {title}.",
+                "confidence_score": 0.8,
+                "reference_rows": [1],
+            }
+            for title in titles
+        ]
+    )
+
+
+class FakeModel:
+    """
+    Stand-in for the async OpenRouter client. `answer` is the completion
+    every request gets (an exception is raised instead), or a function of
+    the request's messages returning one.
+    """
+
+    def __init__(self):
+        self.answer = insights_json("first", "second", "third")
+        self.requests = []
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, extra_headers=None, stream=False):
+        self.requests.append(messages)
+        answer = self.answer(messages) if callable(self.answer) else self.answer
+        if isinstance(answer, Exception):
+            raise answer
+        if stream:
+            return FakeStream(answer)
+        message = SimpleNamespace(content=answer)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class FakeStream:
+    """A streamed completion, a few characters a chunk."""
+
+    def __init__(self, content: str, size: int = 7):
+        self.pieces = [content[i : i + size] for i in range(0, len(content), size)]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        for piece in self.pieces:
+            delta = SimpleNamespace(content=piece, reasoning=None)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+@pytest.fixture
+def model(monkeypatch):
+    import mcp_client
+
+    fake = FakeModel()
+    monkeypatch.setattr(mcp_client, "get_async_client", lambda: fake)
+    return fake
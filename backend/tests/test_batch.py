@@ -0,0 +1,155 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import update
+from sqlmodel import Session
+
+import services
+from config.core import engine
+from conftest import insights_json, upload
+from jobs import JobStatus
+from models import JobRecord
+from schemas import Insight
+from services import agenerate_batch_insights, persist_insights
+
+
+def batch(client, file_ids, **payload):
+    response = client.post("/api/process/batch", json={"file_ids": file_ids, **payload})
+    assert response.status_code == 200, response.text
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    return {
+        result["file_id"]: result
+        for result in map(json.loads, response.text.splitlines())
+    }
+
+
+def csv(tag: str) -> bytes:
+    return f"item,amount\n{tag},1\n{tag}-2,2\n{tag}-3,3\n".encode()
+
+
+def test_each_file_gets_a_line_failures_included(client, model):
+    first, second = upload(client, csv("batch-a")), upload(client, csv("batch-b"))
+    missing = "0" * 32
+
+    results = batch(client, [first, second, missing])
+
+    assert set(results) == {first, second, missing}
+    for file_id in (first, second):
+        assert results[file_id]["status"] == "succeeded"
+        assert len(results[file_id]["insights"]) == 3
+        assert not results[file_id]["cached"]
+    assert results[missing]["status"] == "failed"
+    assert missing in results[missing]["error"]
+
+
+def test_repeated_file_ids_are_processed_once(client, model):
+    file_id = upload(client, csv("batch-dup"))
+    response = client.post(
+        "/api/process/batch", json={"file_ids": [file_id, file_id, file_id]}
+    )
+    assert len(response.text.splitlines()) == 1
+    assert len(model.requests) == 1
+
+
+def test_stored_insights_are_reused_unless_forced(client, model):
+    file_id = upload(client, csv("batch-stored"))
+    batch(client, [file_id])
+    asked = len(model.requests)
+
+    assert batch(client, [file_id])[file_id]["cached"]
+    assert len(model.requests) == asked
+
+    assert not batch(client, [file_id], force=True)[file_id]["cached"]
+    assert len(model.requests) == asked + 1
+
+
+def test_insights_for_some_sheets_are_not_reused(client, model):
+    file_id = upload(client, csv("batch-sheets"))
+    persist_insights(
+        file_id,
+        [
+            Insight(
+                title="per sheet",
+                description="d",
+                confidence_score=0.5,
+                reference_rows=[1],
+                sheet="S1",
+            )
+        ],
+    )
+    result = batch(client, [file_id])[file_id]
+    assert not result["cached"]
+    assert [item["sheet"] for item in result["insights"]] == [None] * 3
+
+
+def test_file_with_a_running_job_waits_for_it(client, model):
+    file_id = upload(client, csv("batch-job"))
+    job_id = uuid.uuid4().hex
+    now = datetime.now(timezone.utc)
+    with Session(engine) as session:
+        # running in another worker process, which checked in just now
+        session.add(
+            JobRecord(
+                id=job_id,
+                file_id=file_id,
+                status=JobStatus.RUNNING.value,
+                worker="elsewhere",
+                heartbeat_at=now,
+                created_at=now,
+                updated_at=now,
+            )
+        )
+        session.commit()
+
+    def finish_job():
+        time.sleep(0.2)
+        insights = json.loads(insights_json("from", "the", "job"))
+        with Session(engine) as session:
+            session.exec(
+                update(JobRecord)
+                .where(JobRecord.id == job_id)
+                .values(status=JobStatus.SUCCEEDED.value, insights=insights)
+            )
+            session.commit()
+
+    threading.Thread(target=finish_job).start()
+    result = batch(client, [file_id])[file_id]
+    assert [item["title"] for item in result["insights"]] == ["from", "the", "job"]
+    assert model.requests == []
+
+
+def test_files_left_when_the_client_goes_away_are_cancelled(monkeypatch):
+    cancelled = []
+
+    async def generate(file_id, count=3, mode=None):
+        if file_id == "slow":
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(file_id)
+                raise
+        return [
+            Insight(
+                title=file_id, description="d", confidence_score=0.5, reference_rows=[]
+            )
+        ]
+
+    monkeypatch.setattr(services, "agenerate_insights", generate)
+    monkeypatch.setattr(services.file_index, "require", lambda file_id: None)
+    monkeypatch.setattr(services, "persist_insights", lambda file_id, insights: True)
+
+    async def main():
+        results = agenerate_batch_insights(["slow", "quick"], force=True)
+        first = await anext(results)
+        # what StreamingResponse does once the client disconnects
+        await results.aclose()
+        await asyncio.sleep(0.01)
+        return first
+
+    first = asyncio.run(main())
+    assert first.file_id == "quick" and first.status == "succeeded"
+    assert cancelled == ["slow"]
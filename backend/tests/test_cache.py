@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+import pytest
+from sqlmodel import Session, delete, func, select
+
+from cache import EVICTION_INTERVAL, DiskCache, LRUCache, ResponseCache, make_cache_key
+from config.core import engine
+from models import LLMCacheEntry
+
+
+@pytest.fixture(autouse=True)
+def empty_disk_tier():
+    DiskCache(1, 1)._ensure_table()
+    with Session(engine) as session:
+        session.exec(delete(LLMCacheEntry))
+        session.commit()
+
+
+def disk_rows():
+    with Session(engine) as session:
+        return session.exec(select(func.count()).select_from(LLMCacheEntry)).one()
+
+
+def test_keys_depend_on_model_and_prompt():
+    assert make_cache_key("a", "prompt") == make_cache_key("a", "prompt")
+    assert make_cache_key("a", "prompt") != make_cache_key("b", "prompt")
+    assert make_cache_key("a", "prompt") != make_cache_key("a", "prompt.")
+
+
+def test_memory_entries_expire_after_the_ttl():
+    memory = LRUCache(max_entries=10, ttl=0.05)
+    memory.set("k", "v")
+    assert memory.get("k") == "v"
+    time.sleep(0.06)
+    assert memory.get("k") is None
+    assert memory.expirations == 1 and len(memory) == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    memory = LRUCache(max_entries=2, ttl=60)
+    memory.set("a", "1")
+    memory.set("b", "2")
+    memory.get("a")  # b is now the least recently used
+    memory.set("c", "3")
+    assert memory.get("b") is None
+    assert memory.get("a") == "1" and memory.get("c") == "3"
+    assert memory.evictions == 1
+
+
+def test_disk_entries_expire_after_the_ttl():
+    disk = DiskCache(max_entries=10, ttl=0.05)
+    disk.set("k", "model", "v")
+    assert disk.get("k") == "v"
+    time.sleep(0.06)
+    assert disk.get("k") is None
+
+
+def test_disk_hits_are_promoted_to_memory():
+    disk = DiskCache(max_entries=10, ttl=60)
+    disk.set("k", "model", "v")
+    cache = ResponseCache(LRUCache(10, 60), disk)
+
+    assert cache.get("k") == "v"
+    assert disk.hits == 1
+    assert cache.get("k") == "v"
+    # the second lookup never reached the disk tier
+    assert disk.hits == 1 and cache.memory.hits == 1
+
+
+def test_async_lookups_promote_disk_hits_too():
+    disk = DiskCache(max_entries=10, ttl=60)
+    cache = ResponseCache(LRUCache(10, 60), disk)
+
+    async def main():
+        await cache.aset("k", "model", "v")
+        cache.memory = LRUCache(10, 60)  # as after a restart
+        assert await cache.aget("k") == "v"
+        assert await cache.aget("k") == "v"
+
+    asyncio.run(main())
+    assert disk.hits == 1 and cache.memory.hits == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResponseCache(LRUCache(10, 60), DiskCache(10, 60), enabled=False)
+    cache.set("k", "model", "v")
+    assert cache.get("k") is None
+    assert disk_rows() == 0
+
+
+def test_disk_tier_is_trimmed_every_interval_writes():
+    disk = DiskCache(max_entries=10, ttl=60)
+    for n in range(EVICTION_INTERVAL - 1):
+        disk.set(f"k{n}", "model", "v")
+    # over the limit, but not counted yet
+    assert disk_rows() == EVICTION_INTERVAL - 1
+
+    disk.set("last", "model", "v")
+    assert disk_rows() == 10
+    assert disk.evictions == EVICTION_INTERVAL - 10
+    # the oldest entries went, the newest stayed
+    assert disk.get("k0") is None and disk.get("last") == "v"
@@ -0,0 +1,47 @@
+from conftest import insights_json, upload, wait_for_job
+
+CSV = b"city,visitors\nlisbon,120\nporto,80\nfaro,45\n"
+
+
+def process(client, file_id, **payload):
+    response = client.post("/api/process", json={"file_id": file_id, **payload})
+    assert response.status_code == 202, response.text
+    return response.json()
+
+
+def titles(job):
+    return [insight["title"] for insight in job["insights"]]
+
+
+def test_identical_uploads_resolve_to_the_same_file_id(client):
+    first = upload(client, CSV, "visits.csv")
+    assert upload(client, CSV, "renamed.csv") == first
+    assert upload(client, CSV + b"braga,30\n", "visits.csv") != first
+
+
+def test_the_same_bytes_as_another_type_get_their_own_id(client):
+    assert upload(client, CSV, "visits.csv") != upload(client, CSV, "visits.txt")
+
+
+def test_stored_insights_are_reused_until_forced(client, model):
+    file_id = upload(client, CSV + b"coimbra,60\n")
+    model.answer = insights_json("a", "b", "c")
+    job = wait_for_job(client, process(client, file_id)["job_id"])
+    assert job["status"] == "succeeded" and titles(job) == ["a", "b", "c"]
+    asked = len(model.requests)
+
+    # the same content again, under another name: no new request to the model
+    again = upload(client, CSV + b"coimbra,60\n", "copy.csv")
+    reused = process(client, again)
+    assert reused["status"] == "succeeded" and titles(reused) == ["a", "b", "c"]
+    assert len(model.requests) == asked
+
+    model.answer = insights_json("x", "y", "z")
+    forced = process(client, file_id, force=True)
+    assert forced["status"] == "queued"
+    job = wait_for_job(client, forced["job_id"])
+    assert titles(job) == ["x", "y", "z"]
+    assert len(model.requests) > asked
+
+    stored = client.get("/api/insights", params={"file_id": file_id}).json()
+    assert [item["title"] for item in stored["insights"]] == ["x", "y", "z"]
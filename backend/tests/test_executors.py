@@ -0,0 +1,77 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from exceptions import ExecutorBusyException
+from executors import BoundedExecutor, io_executor
+from metrics import EXECUTOR_REJECTIONS, ROWS_PARSED
+
+
+def count_rows(rows: int) -> int:
+    # runs in a pool process
+    ROWS_PARSED.inc(rows)
+    return os.getpid()
+
+
+def rows_parsed() -> float:
+    return ROWS_PARSED._values.get((), 0)
+
+
+def test_work_past_the_queue_limit_is_refused():
+    executor = BoundedExecutor("test-busy", workers=1, queue_limit=0, processes=False)
+    release = threading.Event()
+
+    async def main():
+        busy = asyncio.create_task(executor.run(release.wait, 5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(ExecutorBusyException) as refused:
+            await executor.run(len, "x")
+        assert refused.value.status_code == 429
+
+        release.set()
+        assert await busy
+        # room again, now the worker is free
+        assert await executor.run(len, "xyz") == 3
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+    assert EXECUTOR_REJECTIONS._values[("test-busy",)] == 1
+
+
+def test_queued_work_waits_its_turn():
+    executor = BoundedExecutor("test-queue", workers=1, queue_limit=2, processes=False)
+
+    async def main():
+        return await asyncio.gather(*(executor.run(len, "x" * n) for n in range(3)))
+
+    try:
+        assert asyncio.run(main()) == [0, 1, 2]
+    finally:
+        executor.shutdown()
+
+
+def test_busy_executor_is_a_429(client, monkeypatch):
+    monkeypatch.setattr(
+        io_executor, "_pending", io_executor.workers + io_executor.queue_limit
+    )
+    response = client.post("/api/upload", files={"file": ("a.csv", b"a,b\n1,2\n")})
+    assert response.status_code == 429
+    assert "busy" in response.json()["detail"]
+
+
+def test_metrics_recorded_in_pool_processes_are_merged_back():
+    executor = BoundedExecutor("test-pool", workers=1, queue_limit=1, processes=True)
+    before = rows_parsed()
+    try:
+        pid = asyncio.run(executor.run(count_rows, 7))
+        assert pid != os.getpid()
+        assert rows_parsed() == before + 7
+        # handed over once, not again with the next result
+        asyncio.run(executor.run(count_rows, 0))
+        assert rows_parsed() == before + 7
+    finally:
+        executor.shutdown()
@@ -0,0 +1,138 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import mcp_client
+from extraction import InsightStreamParser, extract_insights, loads_lenient, repair_json
+
+
+def insight(title, score=0.9):
+    return {
+        "title": title,
+        "description": f"About {title}.",
+        "confidence_score": score,
+        "reference_rows": [1, 2],
+    }
+
+
+RESPONSE = json.dumps([insight("first"), insight("second"), insight("third")])
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_stream_parser_finds_insights_split_over_chunks(size):
+    parser = InsightStreamParser()
+    found = []
+    for start in range(0, len(RESPONSE), size):
+        found += parser.feed(RESPONSE[start : start + size])
+    assert [item["title"] for item in found] == ["first", "second", "third"]
+
+
+def test_stream_parser_reports_each_insight_once_it_is_complete():
+    parser = InsightStreamParser()
+    cut = RESPONSE.index("second")
+    assert [item["title"] for item in parser.feed(RESPONSE[:cut])] == ["first"]
+    assert [item["title"] for item in parser.feed(RESPONSE[cut:])] == ["second", "third"]
+
+
+def test_stream_parser_handles_an_escape_split_over_chunks():
+    text = json.dumps([insight('say "hi" \\ there')])
+    cut = text.index("\\") + 1
+    parser = InsightStreamParser()
+    found = parser.feed(text[:cut]) + parser.feed(text[cut:])
+    assert [item["title"] for item in found] == ['say "hi" \\ there']
+
+
+def test_extract_insights_from_fenced_output_with_reasoning():
+    raw = (
+        "Let me think. A draft: [{\"title\": \"draft\", \"confidence_score\": 0.1}]\n"
+        "Final answer:\n```json\n" + RESPONSE + "\n```\nHope this helps!"
+    )
+    assert [item["title"] for item in extract_insights(raw)] == ["first", "second", "third"]
+
+
+def test_extract_insights_from_a_wrapping_object():
+    raw = json.dumps({"insights": [insight("wrapped")]})
+    assert [item["title"] for item in extract_insights(raw)] == ["wrapped"]
+
+
+def test_extract_insights_keeps_the_complete_ones_of_a_truncated_response():
+    raw = RESPONSE[: RESPONSE.index("third") + 10]
+    assert [item["title"] for item in extract_insights(raw)] == ["first", "second"]
+
+
+def test_extract_insights_skips_invalid_objects():
+    raw = json.dumps([insight("ok"), {"title": "no score"}, insight("bad", score="high")])
+    assert [item["title"] for item in extract_insights(raw)] == ["ok"]
+
+
+def test_extract_insights_defaults_missing_optional_fields():
+    (item,) = extract_insights('[{"title": "t", "confidence_score": 0.5}]')
+    assert item["description"] == "" and item["reference_rows"] == []
+
+
+def test_repair_json_fixes_common_defects():
+    text = "{'title': 'it\\'s', \"ok\": True, \"none\": None, \"rows\": [1, 2,],}"
+    assert json.loads(repair_json(text)) == {
+        "title": "it's",
+        "ok": True,
+        "none": None,
+        "rows": [1, 2],
+    }
+
+
+def test_repair_json_leaves_strings_alone():
+    text = '{"title": "True, None, \'quoted\',]"}'
+    assert repair_json(text) == text
+
+
+def test_loads_lenient():
+    assert loads_lenient('{"a": 1,}') == {"a": 1}
+    assert loads_lenient("{not json at all") is None
+
+
+def completion(content):
+    message = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_unparseable_answer_is_asked_again(monkeypatch):
+    calls = []
+
+    async def complete(model, messages):
+        calls.append(messages)
+        return completion(RESPONSE)
+
+    monkeypatch.setattr(mcp_client, "_complete_with_retries", complete)
+    raw, insights = asyncio.run(
+        mcp_client._aparse_or_reask("model", "the prompt", "Sorry, I can't.")
+    )
+    assert raw == RESPONSE
+    assert [item["title"] for item in insights] == ["first", "second", "third"]
+    # the model is shown its previous answer along with the prompt
+    (messages,) = calls
+    assert messages[0]["content"] == "the prompt"
+    assert messages[1] == {"role": "assistant", "content": "Sorry, I can't."}
+
+
+def test_salvageable_answer_is_not_asked_again(monkeypatch):
+    async def complete(model, messages):
+        raise AssertionError("asked again")
+
+    monkeypatch.setattr(mcp_client, "_complete_with_retries", complete)
+    _, insights = asyncio.run(mcp_client._aparse_or_reask("model", "prompt", RESPONSE))
+    assert len(insights) == 3
+
+
+def test_reask_gives_up_after_the_configured_attempts(monkeypatch):
+    calls = []
+
+    async def complete(model, messages):
+        calls.append(messages)
+        return completion("still nothing")
+
+    monkeypatch.setattr(mcp_client, "_complete_with_retries", complete)
+    with pytest.raises(ValueError):
+        asyncio.run(mcp_client._aparse_or_reask("model", "prompt", "nothing"))
+    assert len(calls) == mcp_client.LLM_REASK_ATTEMPTS
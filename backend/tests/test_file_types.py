@@ -0,0 +1,88 @@
+import io
+import os
+import zipfile
+
+import pandas as pd
+import pytest
+
+from conftest import upload
+from exceptions import InvalidFileTypeException
+from file_index import file_index
+from utils import OLE_MAGIC, detect_file_type, legacy_file_path
+
+CSV = b"name,score\nada,3\ngrace,5\nlinus,4\n"
+
+
+def xlsx_bytes() -> bytes:
+    buffer = io.BytesIO()
+    pd.DataFrame({"name": ["ada"], "score": [3]}).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def zip_bytes(*names: str) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name in names:
+            archive.writestr(name, "<xml/>")
+    return buffer.getvalue()
+
+
+def detect(tmp_path, content: bytes, ext: str = "") -> str:
+    path = tmp_path / "upload"
+    path.write_bytes(content)
+    return detect_file_type(str(path), content[:4096], ext)
+
+
+@pytest.mark.parametrize(
+    "content, ext, expected",
+    [
+        (xlsx_bytes(), "csv", "xlsx"),
+        (zip_bytes("word/document.xml", "[Content_Types].xml"), "", "docx"),
+        (OLE_MAGIC + b"\x00" * 100, "csv", "xls"),
+        (CSV, "xlsx", "csv"),
+        (CSV, "txt", "txt"),
+        (b"Dear diary,\nnothing happened today.\n", "", "txt"),
+    ],
+)
+def test_type_comes_from_the_content_not_the_name(tmp_path, content, ext, expected):
+    assert detect(tmp_path, content, ext) == expected
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR",
+        zip_bytes("readme.md"),
+        b"PK\x03\x04 not really a zip",
+    ],
+)
+def test_unsupported_content_is_refused(tmp_path, content):
+    with pytest.raises(InvalidFileTypeException):
+        detect(tmp_path, content, "csv")
+
+
+def test_uploads_are_stored_under_their_detected_type(client):
+    file_id = upload(client, xlsx_bytes(), "mislabelled.csv")
+    info = client.get(f"/api/files/{file_id}").json()
+    assert info["file_type"] == "xlsx"
+    assert file_index.require(file_id).path.endswith(".xlsx")
+
+
+def test_binary_upload_is_a_400(client):
+    response = client.post(
+        "/api/upload", files={"file": ("photo.csv", b"\x89PNG\r\n\x1a\n\x00\x00IHDR")}
+    )
+    assert response.status_code == 400
+    assert "Unsupported file type" in response.json()["detail"]
+
+
+def test_files_from_before_the_index_are_found_once(client):
+    file_id = "f" * 32
+    path = legacy_file_path(file_id, "csv")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(CSV)
+
+    record = file_index.require(file_id)
+    assert record.path == path and record.file_type == "csv"
+    assert client.get(f"/api/files/{file_id}").json()["size"] == len(CSV)
@@ -0,0 +1,101 @@
+from conftest import upload
+from http_cache import etag_matches, preview_cache
+from schemas import Insight
+from services import persist_insights
+
+CSV = b"team,points,coach\nlions,12,ana\nbears,9,\nowls,15,rui\n"
+
+
+def insight(title):
+    return Insight(title=title, description="d", confidence_score=0.5, reference_rows=[1])
+
+
+def test_preview_carries_an_etag_and_revalidates_to_a_304(client):
+    file_id = upload(client, CSV, "teams.csv")
+    url = f"/api/files/{file_id}/preview"
+
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert etag.startswith('W/"') and first.headers["cache-control"] == "no-cache"
+
+    again = client.get(url, headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.content == b""
+    assert again.headers["etag"] == etag
+
+    # another preview is another response
+    other = client.get(url, params={"limit": 2}, headers={"If-None-Match": etag})
+    assert other.status_code == 200 and len(other.json()["rows"]) == 2
+
+
+def test_repeat_previews_are_served_from_the_cache(client, monkeypatch):
+    file_id = upload(client, CSV + b"foxes,3,eva\n", "teams.csv")
+    url = f"/api/files/{file_id}/preview"
+    first = client.get(url).json()
+
+    import routes
+
+    def no_parsing(*args):
+        raise AssertionError("the preview was built again")
+
+    monkeypatch.setattr(routes, "extract_data_preview", no_parsing)
+    assert client.get(url).json() == first
+
+
+def test_columnar_preview(client):
+    file_id = upload(client, CSV + b"hawks,7,jo\n", "teams.csv")
+    url = f"/api/files/{file_id}/preview"
+    records = client.get(url).json()
+    columnar = client.get(url, params={"orient": "columnar"}).json()
+
+    assert columnar["columns"] == records["columns"] == ["team", "points", "coach"]
+    assert len(columnar["data"]) == len(records["rows"]) == 4
+    assert columnar["data"][0] == [records["rows"][0][c] for c in columnar["columns"]]
+    assert "rows" not in columnar
+
+
+def test_saving_insights_invalidates_their_cached_responses(client):
+    file_id = upload(client, CSV + b"crows,1,li\n", "teams.csv")
+    persist_insights(file_id, [insight("before")])
+    url = "/api/insights"
+    params = {"file_id": file_id}
+
+    first = client.get(url, params=params)
+    assert [item["title"] for item in first.json()["insights"]] == ["before"]
+    etag = first.headers["etag"]
+    assert client.get(url, params=params, headers={"If-None-Match": etag}).status_code == 304
+
+    persist_insights(file_id, [insight("after")])
+    second = client.get(url, params=params, headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert [item["title"] for item in second.json()["insights"]] == ["after"]
+    assert second.headers["etag"] != etag
+
+
+def test_invalidation_leaves_other_files_alone():
+    preview_cache.set(preview_cache.key("one", 5), b"{}")
+    preview_cache.set(preview_cache.key("two", 5), b"{}")
+    preview_cache.invalidate("one")
+    assert preview_cache.get(preview_cache.key("one", 5)) is None
+    assert preview_cache.get(preview_cache.key("two", 5)) is not None
+
+
+def test_etag_matching():
+    etag = 'W/"abc"'
+    assert etag_matches('W/"abc"', etag)
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('"x", W/"abc"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"abd"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_removed_file_is_not_served_from_the_cache(client, monkeypatch):
+    file_id = upload(client, CSV + b"ducks,2,al\n", "teams.csv")
+    url = f"/api/files/{file_id}/preview"
+    assert client.get(url).status_code == 200
+
+    from file_index import file_index
+
+    monkeypatch.setattr(file_index, "get", lambda *args, **kwargs: None)
+    assert client.get(url).status_code == 404
@@ -0,0 +1,118 @@
+import json
+
+import pytest
+from sqlalchemy import event, text
+
+from config.core import _set_sqlite_pragmas, engine
+from exceptions import InsightsNotFoundException
+from schemas import Insight
+from services import count_saved_insights, persist_insights, retrieve_saved_insights
+from utils import get_insights_path
+
+FILE_ID = "insight-store"
+
+
+def insight(title, score, description="", sheet=None):
+    return Insight(
+        title=title,
+        description=description or f"About {title}.",
+        confidence_score=score,
+        reference_rows=[1, 2],
+        sheet=sheet,
+    )
+
+
+@pytest.fixture(autouse=True)
+def stored():
+    persist_insights(
+        FILE_ID,
+        [
+            insight("Revenue peaks in May", 0.9, sheet="2024"),
+            insight("Churn rises", 0.4, "Customers leave after the price change", "2024"),
+            insight("Refunds are rare", 0.7, sheet="2023"),
+            insight("Average order grows", 0.6, "Revenue per order is up", "2023"),
+        ],
+    )
+
+
+def titles(insights):
+    return [item.title for item in insights]
+
+
+def test_insights_come_back_in_the_order_they_were_generated():
+    assert titles(retrieve_saved_insights(FILE_ID)) == [
+        "Revenue peaks in May",
+        "Churn rises",
+        "Refunds are rare",
+        "Average order grows",
+    ]
+
+
+def test_saving_again_replaces_the_earlier_insights():
+    persist_insights(FILE_ID, [insight("Only one", 0.5)])
+    assert titles(retrieve_saved_insights(FILE_ID)) == ["Only one"]
+
+
+def test_filters_apply_to_retrieval_and_count_alike():
+    cases = [
+        (
+            {"min_confidence": 0.6},
+            ["Revenue peaks in May", "Refunds are rare", "Average order grows"],
+        ),
+        ({"max_confidence": 0.6}, ["Churn rises", "Average order grows"]),
+        # in the title or the description, whatever the case
+        ({"search": "REVENUE"}, ["Revenue peaks in May", "Average order grows"]),
+        ({"sheet": "2023"}, ["Refunds are rare", "Average order grows"]),
+        ({"sheet": "2024", "min_confidence": 0.5}, ["Revenue peaks in May"]),
+    ]
+    for filters, expected in cases:
+        assert titles(retrieve_saved_insights(FILE_ID, **filters)) == expected
+        assert count_saved_insights(FILE_ID, **filters) == len(expected)
+
+
+@pytest.mark.parametrize(
+    "sort_by, order, expected",
+    [
+        ("confidence_score", "desc", [0.9, 0.7, 0.6, 0.4]),
+        ("confidence_score", "asc", [0.4, 0.6, 0.7, 0.9]),
+    ],
+)
+def test_insights_are_sorted(sort_by, order, expected):
+    insights = retrieve_saved_insights(FILE_ID, sort_by=sort_by, order=order)
+    assert [item.confidence_score for item in insights] == expected
+
+
+def test_sorted_by_title():
+    assert titles(retrieve_saved_insights(FILE_ID, sort_by="title"))[0] == "Average order grows"
+
+
+def test_pagination():
+    pages = [
+        titles(retrieve_saved_insights(FILE_ID, limit=3, offset=offset))
+        for offset in (0, 3, 6)
+    ]
+    assert [len(page) for page in pages] == [3, 1, 0]
+    assert sum(pages, []) == titles(retrieve_saved_insights(FILE_ID))
+    # the count is of every match, not of a page
+    assert count_saved_insights(FILE_ID) == 4
+
+
+def test_unknown_file_has_no_insights():
+    with pytest.raises(InsightsNotFoundException):
+        retrieve_saved_insights("no-such-file")
+    assert count_saved_insights("no-such-file") == 0
+
+
+def test_legacy_json_insights_are_moved_into_the_database():
+    legacy = [insight("From JSON", 0.8).model_dump()]
+    with open(get_insights_path("legacy-file"), "w") as f:
+        json.dump(legacy, f)
+    assert titles(retrieve_saved_insights("legacy-file")) == ["From JSON"]
+    assert count_saved_insights("legacy-file") == 1
+
+
+def test_sqlite_connections_use_wal():
+    assert event.contains(engine, "connect", _set_sqlite_pragmas)
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() == 5000
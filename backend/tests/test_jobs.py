@@ -0,0 +1,185 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import update
+from sqlmodel import Session, delete, select
+
+import jobs
+from config.core import engine
+from jobs import JobQueue, JobStatus
+from models import Insight as InsightRecord
+from models import JobRecord
+from schemas import Insight
+
+INSIGHTS = [Insight(title="t", description="d", confidence_score=0.5, reference_rows=[1])]
+
+
+@pytest.fixture(autouse=True)
+def empty_queue():
+    with Session(engine) as session:
+        session.exec(delete(JobRecord))
+        session.exec(delete(InsightRecord))
+        session.commit()
+
+
+def queue(**options):
+    options = {"poll_interval": 0.02, "lease_seconds": 60, **options}
+    return JobQueue(**options)
+
+
+def expire_lease(job_id):
+    with Session(engine) as session:
+        session.exec(
+            update(JobRecord)
+            .where(JobRecord.id == job_id)
+            .values(heartbeat_at=jobs._now() - timedelta(hours=1))
+        )
+        session.commit()
+
+
+def saved_insights(file_id):
+    with Session(engine) as session:
+        return session.exec(
+            select(InsightRecord).where(InsightRecord.file_id == file_id)
+        ).all()
+
+
+def test_claim_takes_the_oldest_queued_job_once():
+    first, second = queue(), queue()
+    older = first.submit("file-1")
+    newer = first.submit("file-2")
+
+    claimed = first._claim()
+    assert claimed.id == older.id
+    assert second._claim().id == newer.id
+    assert first._claim() is None and second._claim() is None
+
+    record = first.get(older.id)
+    assert record.status is JobStatus.RUNNING
+
+
+def test_job_with_an_expired_lease_is_claimed_again():
+    first, second = queue(), queue()
+    job = first.submit("file")
+    assert first._claim().id == job.id
+    # still checked in for: nobody else gets it
+    assert second._claim() is None
+
+    expire_lease(job.id)
+    assert second._claim().id == job.id
+    # the first worker has lost it, and can no longer update it
+    assert not first._update(job.id, attempts=1)
+    assert first._heartbeat([job.id]) == [job.id]
+    assert second._heartbeat([job.id]) == []
+
+
+def test_released_jobs_are_queued_again():
+    first, second = queue(), queue()
+    job = first.submit("file")
+    first._claim()
+    first._release([job.id])
+    assert first.get(job.id).status is JobStatus.QUEUED
+    assert second._claim().id == job.id
+
+
+def test_cancelled_queued_job_is_never_claimed():
+    pool = queue()
+    job = pool.submit("file")
+    assert pool.cancel(job.id).status is JobStatus.CANCELLED
+    assert pool._claim() is None
+
+
+def test_finished_job_is_not_cancelled():
+    pool = queue()
+    job = pool.complete("file", INSIGHTS)
+    assert pool.cancel(job.id).status is JobStatus.SUCCEEDED
+
+
+async def run_workers(pool, until, timeout=2.0):
+    await pool.start()
+    try:
+        async with asyncio.timeout(timeout):
+            while not until():
+                await asyncio.sleep(0.01)
+    finally:
+        await pool.stop()
+
+
+def test_job_runs_and_persists_its_insights(monkeypatch):
+    async def generate(file_id, mode=None, sheets=None):
+        return INSIGHTS
+
+    monkeypatch.setattr(jobs, "agenerate_insights", generate)
+    pool = queue(concurrency=1)
+    job = pool.submit("file")
+    asyncio.run(run_workers(pool, lambda: pool.get(job.id).status is JobStatus.SUCCEEDED))
+    assert [insight.title for insight in pool.get(job.id).insights] == ["t"]
+    assert len(saved_insights("file")) == 1
+
+
+def test_cancelling_a_running_job_aborts_it(monkeypatch):
+    started = []
+
+    async def generate(file_id, mode=None, sheets=None):
+        started.append(file_id)
+        await asyncio.sleep(60)
+        return INSIGHTS
+
+    monkeypatch.setattr(jobs, "agenerate_insights", generate)
+    pool = queue(concurrency=1)
+    job = pool.submit("file")
+
+    async def main():
+        await pool.start()
+        try:
+            async with asyncio.timeout(2):
+                while not started:
+                    await asyncio.sleep(0.01)
+                pool.cancel(job.id)
+                while job.id in pool._running:
+                    await asyncio.sleep(0.01)
+        finally:
+            await pool.stop()
+
+    asyncio.run(main())
+    assert pool.get(job.id).status is JobStatus.CANCELLED
+    assert saved_insights("file") == []
+
+
+def test_job_cancelled_before_its_insights_are_saved_drops_them(monkeypatch):
+    pool = queue(concurrency=1)
+    job = pool.submit("file")
+    generated = []
+
+    async def generate(file_id, mode=None, sheets=None):
+        generated.append(file_id)
+        # cancelled (through another process, say) as generation finishes
+        with Session(engine) as session:
+            session.exec(
+                update(JobRecord)
+                .where(JobRecord.id == job.id)
+                .values(status=JobStatus.CANCELLED.value)
+            )
+            session.commit()
+        return INSIGHTS
+
+    monkeypatch.setattr(jobs, "agenerate_insights", generate)
+    asyncio.run(run_workers(pool, lambda: generated and job.id not in pool._running))
+    assert pool.get(job.id).status is JobStatus.CANCELLED
+    assert saved_insights("file") == []
+
+
+def test_failing_job_is_retried_then_failed(monkeypatch):
+    calls = []
+
+    async def generate(file_id, mode=None, sheets=None):
+        calls.append(file_id)
+        raise RuntimeError("model down")
+
+    monkeypatch.setattr(jobs, "agenerate_insights", generate)
+    pool = queue(concurrency=1, max_retries=2, retry_backoff=0.001)
+    job = pool.submit("file")
+    asyncio.run(run_workers(pool, lambda: pool.get(job.id).status is JobStatus.FAILED))
+    assert len(calls) == 3
+    assert pool.get(job.id).error == "model down"
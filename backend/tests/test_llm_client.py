@@ -0,0 +1,96 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+import mcp_client
+from routing import ModelRouter
+
+REQUEST = httpx.Request("POST", "https://openrouter.test/chat/completions")
+
+
+def status_error(code, **headers):
+    response = httpx.Response(code, request=REQUEST, headers=headers)
+    return openai.APIStatusError("upstream", response=response, body=None)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(mcp_client, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(mcp_client, "LLM_BACKOFF_BASE", 0.001)
+    # bound to the loop of each test's asyncio.run
+    monkeypatch.setattr(mcp_client, "_semaphore", None)
+    # every attempt is recorded against the model it went to
+    monkeypatch.setattr(mcp_client, "llm_router", ModelRouter(["m"]))
+
+
+def answers(model, *outcomes):
+    """Have the fake model fail or answer with `outcomes`, in turn."""
+    pending = list(outcomes)
+    model.answer = lambda messages: pending.pop(0)
+
+
+def complete():
+    return asyncio.run(mcp_client._complete_with_retries("m", [{"role": "user"}]))
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        openai.APITimeoutError(request=REQUEST),
+        openai.APIConnectionError(request=REQUEST),
+        status_error(429),
+        status_error(503),
+    ],
+)
+def test_transient_errors_are_retried(model, error):
+    answers(model, error, "fine")
+    assert complete().choices[0].message.content == "fine"
+    assert len(model.requests) == 2
+
+
+@pytest.mark.parametrize("error", [status_error(400), status_error(401), ValueError()])
+def test_other_errors_are_raised_straight_away(model, error):
+    answers(model, error, "fine")
+    with pytest.raises(type(error)):
+        complete()
+    assert len(model.requests) == 1
+
+
+def test_retries_give_up_after_the_configured_attempts(model):
+    answers(model, status_error(502), status_error(502), status_error(502), "late")
+    with pytest.raises(openai.APIStatusError):
+        complete()
+    assert len(model.requests) == 3
+
+
+def test_retry_after_is_honoured_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(mcp_client, "LLM_BACKOFF_MAX", 5)
+    assert mcp_client._backoff_delay(status_error(429, **{"retry-after": "2"}), 0) == 2
+    assert mcp_client._backoff_delay(status_error(429, **{"retry-after": "90"}), 0) == 5
+    assert 0 < mcp_client._backoff_delay(status_error(429), 3) <= 0.008
+
+
+def test_concurrent_completions_are_capped(model, monkeypatch):
+    monkeypatch.setattr(mcp_client, "LLM_CONCURRENCY", 2)
+    in_flight = peak = 0
+    create = model.create
+
+    async def slow_create(**kwargs):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        return await create(**kwargs)
+
+    monkeypatch.setattr(model, "create", slow_create)
+
+    async def main():
+        await asyncio.gather(
+            *(mcp_client._complete_with_retries("m", []) for _ in range(6))
+        )
+
+    asyncio.run(main())
+    assert peak == 2 and len(model.requests) == 6
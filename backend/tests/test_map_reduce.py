@@ -0,0 +1,80 @@
+import asyncio
+import json
+import re
+import threading
+import time
+
+import pytest
+
+import mcp_client
+import services
+from conftest import upload
+
+CHUNK_ROWS = 50
+CSV = b"day,visits\n" + b"".join(b"%d,%d\n" % (day, day * 7 % 31) for day in range(100))
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(services, "MAP_REDUCE_CHUNK_ROWS", CHUNK_ROWS)
+    monkeypatch.setattr(mcp_client, "_semaphore", None)
+
+
+def answer(messages):
+    """Cite the last sample row of each chunk, and pass every candidate on."""
+    prompt = messages[-1]["content"]
+    if "Candidate insights:" in prompt:
+        return prompt.split("Candidate insights:", 1)[1].strip()
+    sample = prompt.split("the row number in the file):", 1)[1]
+    rows = [int(row) for row in re.findall(r"^\s*(\d+),", sample, re.M)]
+    return json.dumps(
+        [
+            {
+                "title": f"up to row {max(rows)}",
+                "description": "A chunk.",
+                "confidence_score": 0.5,
+                "reference_rows": [max(rows)],
+            }
+        ]
+    )
+
+
+def test_reference_rows_are_global_across_chunks(client, model):
+    file_id = upload(client, CSV, "visits.csv")
+    model.answer = answer
+
+    insights = asyncio.run(services.agenerate_insights(file_id, mode="map_reduce"))
+
+    # a request per chunk, and one to reduce them
+    assert len(model.requests) == 3
+    assert sorted(insight.reference_rows[0] for insight in insights) == [49, 99]
+
+
+def test_cancelling_waits_for_the_chunk_being_read(client, model, monkeypatch):
+    file_id = upload(client, CSV + b"100,1\n", "visits.csv")
+    model.answer = answer
+    reading = threading.Event()
+    chunks_of = services.iter_frame_chunks
+
+    def slow_chunks(path, chunksize):
+        for n, chunk in enumerate(chunks_of(path, chunksize)):
+            if n:
+                reading.set()
+                time.sleep(0.2)
+            yield chunk
+
+    monkeypatch.setattr(services, "iter_frame_chunks", slow_chunks)
+
+    async def main():
+        task = asyncio.create_task(
+            services.agenerate_insights(file_id, mode="map_reduce")
+        )
+        while not reading.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        # closing the reader while a thread is in it would raise
+        # "generator already executing" instead
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+import logging
+import re
+
+import metrics
+from conftest import upload
+from metrics import Counter, Histogram, RequestIdFilter, request_id_var, timed
+
+
+def sample(text: str, name: str, **labels) -> float:
+    """The value of the sample of `name` with (at least) these labels."""
+    for line in text.splitlines():
+        if not line.startswith(name + "{") and not line.startswith(name + " "):
+            continue
+        if all(f'{key}="{value}"' in line for key, value in labels.items()):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"no {name} sample with {labels}")
+
+
+def test_metrics_are_rendered_in_the_prometheus_format(client):
+    file_id = upload(client, b"a,b\n1,2\n3,4\n")
+    client.get(f"/api/files/{file_id}")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    assert "# TYPE insights_stage_duration_seconds histogram" in text
+    assert sample(text, "insights_stage_duration_seconds_count", stage="save") >= 1
+    assert sample(text, "insights_uploaded_bytes_total", file_type="csv") >= 11
+    # requests are labelled by route template, not by path
+    assert sample(
+        text,
+        "insights_http_request_duration_seconds_count",
+        method="GET",
+        route="/api/files/{file_id}",
+        status="200",
+    ) >= 1
+    assert file_id not in text
+    assert 'insights_llm_cache_events_total{tier="memory",event="hits"}' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_histogram_seconds", "Test.", ["stage"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, stage="x")
+    lines = histogram.render()
+    metrics._registry.remove(histogram)
+
+    assert 'test_histogram_seconds_bucket{stage="x",le="0.1"} 1' in lines
+    assert 'test_histogram_seconds_bucket{stage="x",le="1"} 3' in lines
+    assert 'test_histogram_seconds_bucket{stage="x",le="+Inf"} 4' in lines
+    assert 'test_histogram_seconds_sum{stage="x"} 6.05' in lines
+    assert 'test_histogram_seconds_count{stage="x"} 4' in lines
+
+
+def test_label_values_are_escaped():
+    counter = Counter("test_escaped_total", "Test.", ["reason"])
+    counter.inc(reason='say "hi"\n')
+    lines = counter.render()
+    metrics._registry.remove(counter)
+    assert 'test_escaped_total{reason="say \\"hi\\"\\n"} 1' in lines
+
+
+def test_request_id_is_echoed_back(client):
+    response = client.get("/", headers={"X-Request-ID": "trace-1234"})
+    assert response.headers["x-request-id"] == "trace-1234"
+
+
+def test_request_id_is_made_up_when_missing_or_unusable(client):
+    generated = client.get("/").headers["x-request-id"]
+    assert re.fullmatch(r"[0-9a-f]{32}", generated)
+
+    response = client.get("/", headers={"X-Request-ID": "<script>"})
+    assert response.headers["x-request-id"] != "<script>"
+    assert re.fullmatch(r"[0-9a-f]{32}", response.headers["x-request-id"])
+
+
+def test_log_records_carry_the_request_id():
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "message", (), None)
+    RequestIdFilter().filter(record)
+    assert record.request_id == "-"
+
+    token = request_id_var.set("trace-5678")
+    try:
+        RequestIdFilter().filter(record)
+    finally:
+        request_id_var.reset(token)
+    assert record.request_id == "trace-5678"
+
+
+def test_nothing_is_recorded_when_disabled(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    counter = Counter("test_disabled_total", "Test.")
+    histogram = Histogram("test_disabled_seconds", "Test.")
+    try:
+        counter.inc()
+        histogram.observe(1.0)
+        with histogram.time():
+            pass
+        assert timed("parse") is metrics._DISABLED
+        assert counter._values == {} and histogram._values == {}
+    finally:
+        metrics._registry.remove(counter)
+        metrics._registry.remove(histogram)
+
+
+def test_disabled_metrics_still_tag_requests(client, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    before = metrics.HTTP_REQUEST_SECONDS._samples()
+    response = client.get("/", headers={"X-Request-ID": "trace-9"})
+    assert response.headers["x-request-id"] == "trace-9"
+    assert metrics.HTTP_REQUEST_SECONDS._samples() == before
@@ -0,0 +1,89 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+from readers import (
+    build_parquet_cache,
+    iter_frame_chunks,
+    parquet_cache_path,
+    read_table,
+    table_shape,
+)
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame(
+        {
+            "city": [f"city-{n}" for n in range(250)],
+            "visits": range(250),
+            "share": [n / 250 for n in range(250)],
+        }
+    )
+
+
+@pytest.fixture
+def csv_path(tmp_path, frame):
+    path = str(tmp_path / "visits.csv")
+    frame.to_csv(path, index=False)
+    return path
+
+
+def test_csv_round_trips_through_the_cache(csv_path, frame):
+    cache = build_parquet_cache(csv_path)
+    assert cache == parquet_cache_path(csv_path) and os.path.exists(cache)
+    assert table_shape(csv_path) == (250, 3)
+    pd.testing.assert_frame_equal(read_table(csv_path), frame)
+    # building it again reuses the cache
+    assert build_parquet_cache(csv_path) == cache
+
+
+def test_cache_reads_only_the_rows_and_columns_asked_for(csv_path, frame):
+    build_parquet_cache(csv_path)
+    head = read_table(csv_path, columns=["visits"], nrows=10)
+    pd.testing.assert_frame_equal(head, frame[["visits"]].head(10))
+
+
+def test_workbook_round_trips_with_mixed_columns(tmp_path):
+    path = str(tmp_path / "book.xlsx")
+    frame = pd.DataFrame({"code": [1, "A2", 3], "value": [1.5, 2.5, 3.5]})
+    frame.to_excel(path, index=False)
+
+    assert build_parquet_cache(path)
+    cached = read_table(path)
+    # the column mixing numbers and text is kept, as text
+    assert list(cached["code"].astype(str)) == ["1", "A2", "3"]
+    assert list(cached["value"]) == [1.5, 2.5, 3.5]
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_chunks_are_globally_indexed_with_or_without_the_cache(csv_path, frame, cached):
+    if cached:
+        build_parquet_cache(csv_path)
+    chunks = list(iter_frame_chunks(csv_path, 100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 50]
+    assert [chunk.index[0] for chunk in chunks] == [0, 100, 200]
+    pd.testing.assert_frame_equal(pd.concat(chunks), frame)
+
+
+def test_missing_cache_falls_back_to_the_original(csv_path, frame):
+    build_parquet_cache(csv_path)
+    os.remove(parquet_cache_path(csv_path))
+    assert table_shape(csv_path) is None
+    pd.testing.assert_frame_equal(read_table(csv_path, nrows=5), frame.head(5))
+
+
+def test_no_cache_without_pyarrow(csv_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    assert build_parquet_cache(csv_path) is None
+    assert not os.path.exists(parquet_cache_path(csv_path))
+
+
+def test_file_that_cannot_be_converted_leaves_nothing_behind(tmp_path):
+    path = str(tmp_path / "broken.csv")
+    with open(path, "w") as f:
+        f.write("a,b\n1,2\n3,4,5,6\n")
+    assert build_parquet_cache(path) is None
+    assert os.listdir(tmp_path) == ["broken.csv"]
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from profiling import (
+    TOP_CAPACITY,
+    ColumnProfiler,
+    HyperLogLog,
+    KLLSketch,
+    profile_chunks,
+)
+
+RNG_SEED = 7
+
+
+def chunked(frame, size=10_000):
+    return [frame.iloc[start : start + size] for start in range(0, len(frame), size)]
+
+
+@pytest.mark.parametrize("distinct", [10, 1_000, 50_000, 300_000])
+def test_hyperloglog_estimate_is_within_a_few_percent(distinct):
+    sketch = HyperLogLog()
+    values = np.arange(distinct, dtype=np.float64)
+    # added in pieces, and every value twice: duplicates don't count
+    for piece in np.array_split(np.concatenate([values, values]), 7):
+        sketch.add(pd.util.hash_array(piece))
+    # the standard error at the default precision is about 1.6%
+    assert sketch.estimate() == pytest.approx(distinct, rel=0.05)
+
+
+def test_kll_quantiles_are_within_a_few_percent_of_rank():
+    rng = np.random.default_rng(RNG_SEED)
+    values = rng.permutation(200_000).astype(np.float64)
+    sketch = KLLSketch()
+    for piece in np.array_split(values, 40):
+        sketch.add(piece)
+    fractions = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+    for q, estimate in zip(fractions, sketch.quantiles(fractions)):
+        # the values are 0..n-1, so a value is its own rank
+        assert abs(estimate / len(values) - q) <= 0.02
+    # the sketch stays small whatever it has seen
+    assert sum(len(level) for level in sketch.levels) < 1_000
+
+
+def test_kll_of_nothing():
+    assert KLLSketch().quantiles([0.5]) == [None]
+
+
+def test_misra_gries_keeps_the_frequent_values_with_bounded_undercounts():
+    rng = np.random.default_rng(RNG_SEED)
+    n = 100_000
+    # a few frequent values in a long tail of rare ones
+    values = pd.Series(
+        np.where(
+            rng.random(n) < 0.5,
+            rng.choice(["a", "b", "c", "d"], n, p=[0.4, 0.3, 0.2, 0.1]),
+            rng.integers(0, 50_000, n).astype(str),
+        )
+    )
+    profiler = ColumnProfiler("value")
+    for start in range(0, n, 5_000):
+        profiler.add(values.iloc[start : start + 5_000])
+    exact = values.value_counts()
+
+    assert len(profiler.top) <= TOP_CAPACITY
+    # anything above n / (k + 1) is guaranteed to be kept, and its count is
+    # low by at most that much
+    bound = n / (TOP_CAPACITY + 1)
+    for value in exact[exact > bound].index:
+        assert exact[value] - bound <= profiler.top[value] <= exact[value]
+    top = [value for value, _ in profiler.profile().top]
+    assert top[:4] == ["a", "b", "c", "d"]
+
+
+def test_exact_statistics_match_pandas_across_chunks():
+    rng = np.random.default_rng(RNG_SEED)
+    frame = pd.DataFrame(
+        {
+            "number": rng.normal(50, 10, 45_000),
+            "count": rng.integers(0, 1_000, 45_000),
+            "name": rng.choice(["x", "y", "z"], 45_000),
+        }
+    )
+    frame.loc[::9, "number"] = np.nan
+    profiles = {profile.name: profile for profile in profile_chunks(chunked(frame))}
+
+    number = profiles["number"]
+    assert number.dtype == "float64"
+    assert number.nulls == frame["number"].isna().sum()
+    assert number.count == frame["number"].count()
+    assert number.mean == pytest.approx(frame["number"].mean())
+    assert number.std == pytest.approx(frame["number"].std())
+    assert (number.min, number.max) == (frame["number"].min(), frame["number"].max())
+    assert number.quantiles["p50"] == pytest.approx(frame["number"].median(), rel=0.05)
+
+    assert profiles["count"].dtype == "int64"
+    assert profiles["count"].distinct == pytest.approx(1_000, rel=0.05)
+    assert profiles["name"].dtype == "string"
+    assert dict(profiles["name"].top) == frame["name"].value_counts().to_dict()
+
+
+def test_column_type_is_fixed_by_its_first_chunk():
+    chunks = [
+        pd.DataFrame({"value": [1, 2, 3], "when": pd.to_datetime(["2024-01-01"] * 3)}),
+        # a column of numbers with the odd word in it, dates with numbers
+        pd.DataFrame({"value": ["4", "n/a", None], "when": [5, 6, 7]}),
+        pd.DataFrame({"value": [5.5, 6.5, 7.5], "when": ["2023-06-01", "bad", None]}),
+    ]
+    profiles = {profile.name: profile for profile in profile_chunks(chunks)}
+
+    value = profiles["value"]
+    assert value.dtype == "float64"
+    assert (value.count, value.nulls) == (8, 1)
+    assert (value.min, value.max) == (1.0, 7.5)
+    assert value.mean == pytest.approx(np.mean([1, 2, 3, 4, 5.5, 6.5, 7.5]))
+
+    when = profiles["when"]
+    assert when.dtype == "datetime64"
+    assert (when.min, when.max) == ("2023-06-01T00:00:00", "2024-01-01T00:00:00")
@@ -0,0 +1,204 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import mcp_client
+from conftest import FakeModel
+from metrics import LLM_HEDGES
+from routing import ModelRouter
+
+
+class StubModels:
+    """
+    Models answering after a scripted delay, or failing, their requests
+    first waiting `queued` seconds for a slot.
+    """
+
+    def __init__(self, delays, failing=(), queued=None):
+        self.delays = delays
+        self.failing = set(failing)
+        self.queued = queued or {}
+        self.router = None
+        self.calls = []
+        self.cancelled = []
+
+    async def __call__(self, model):
+        self.calls.append(model)
+        try:
+            await asyncio.sleep(self.queued.get(model, 0))
+            with self.router.track(model):
+                await asyncio.sleep(self.delays[model])
+                if model in self.failing:
+                    raise RuntimeError(f"{model} is down")
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+        return model
+
+
+def race(router, models, prompt_tokens=10):
+    models.router = router
+    return asyncio.run(router.race(models, prompt_tokens))
+
+
+def router(*models, **options):
+    options = {"hedge_min_delay": 0.01, "hedge_max_delay": 0.05, **options}
+    return ModelRouter(models, small_prompt_tokens=100, max_error_rate=0.5, **options)
+
+
+def test_empty_pool_is_rejected():
+    with pytest.raises(ValueError):
+        ModelRouter([])
+
+
+def test_first_model_answering_in_time_is_not_hedged():
+    models = StubModels({"a": 0.0, "b": 0.0})
+    assert race(router("a", "b"), models) == "a"
+    assert models.calls == ["a"]
+
+
+def test_slow_model_is_hedged_and_the_faster_answer_wins():
+    LLM_HEDGES._drain()
+    models = StubModels({"slow": 1.0, "fast": 0.0})
+    assert race(router("slow", "fast"), models) == "fast"
+    assert models.calls == ["slow", "fast"]
+    # the losing request is cancelled rather than left running
+    assert models.cancelled == ["slow"]
+    assert LLM_HEDGES._drain() == {("hedge",): 1}
+
+
+def test_first_model_can_still_win_after_hedging():
+    models = StubModels({"a": 0.08, "b": 1.0})
+    assert race(router("a", "b"), models) == "a"
+    assert models.calls == ["a", "b"]
+    assert models.cancelled == ["b"]
+
+
+def test_without_hedging_the_slow_model_is_waited_for():
+    models = StubModels({"slow": 0.1, "fast": 0.0})
+    assert race(router("slow", "fast", hedge=False), models) == "slow"
+    assert models.calls == ["slow"]
+
+
+def test_failing_model_is_replaced_straight_away():
+    models = StubModels({"a": 0.0, "b": 0.0}, failing={"a"})
+    pool = router("a", "b", hedge_max_delay=10)
+    assert race(pool, models) == "b"
+    assert pool.stats["a"].error_rate > 0 and pool.stats["b"].error_rate == 0
+
+
+def test_last_error_is_raised_when_every_model_fails():
+    models = StubModels({"a": 0.0, "b": 0.0}, failing={"a", "b"})
+    with pytest.raises(RuntimeError, match="b is down"):
+        race(router("a", "b"), models)
+    assert models.calls == ["a", "b"]
+
+
+def test_at_most_two_models_are_in_flight():
+    models = StubModels({"a": 1.0, "b": 1.0, "c": 0.0})
+    pool = router("a", "b", "c", hedge_max_delay=0.01)
+    models.router = pool
+    with_timeout = asyncio.wait_for(pool.race(models, 10), 0.5)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(with_timeout)
+    assert models.calls == ["a", "b"]
+
+
+def test_a_request_waiting_for_a_slot_is_not_hedged():
+    models = StubModels({"a": 0.0, "b": 0.0}, queued={"a": 0.2})
+    pool = router("a", "b")
+    assert race(pool, models) == "a"
+    assert models.calls == ["a"]
+
+
+def test_the_hedge_timer_starts_once_the_request_is_sent():
+    models = StubModels({"a": 1.0, "b": 0.0}, queued={"a": 0.1})
+    assert race(router("a", "b"), models) == "b"
+    assert models.calls == ["a", "b"]
+
+
+def test_a_request_failing_before_it_is_sent_is_replaced():
+    async def call(model):
+        if model == "a":
+            raise RuntimeError("no slot for a")
+        return model
+
+    assert asyncio.run(router("a", "b").race(call, 10)) == "b"
+
+
+def test_latency_leaves_out_the_wait_for_a_slot():
+    models = StubModels({"a": 0.02, "b": 0.0}, queued={"a": 0.2})
+    pool = router("a", "b", hedge=False)
+    race(pool, models)
+    (latency,) = pool.stats["a"].latencies
+    assert 0.02 <= latency < 0.1
+
+
+def test_completions_are_timed_without_the_wait_for_a_slot(monkeypatch):
+    pool = router("a")
+    monkeypatch.setattr(mcp_client, "llm_router", pool)
+    monkeypatch.setattr(mcp_client, "_semaphore", None)
+    monkeypatch.setattr(mcp_client, "LLM_CONCURRENCY", 1)
+    fake = FakeModel()
+    monkeypatch.setattr(mcp_client, "get_async_client", lambda: fake)
+
+    async def main():
+        async def hold_the_slot():
+            async with mcp_client.get_semaphore():
+                await asyncio.sleep(0.2)
+
+        holder = asyncio.create_task(hold_the_slot())
+        await asyncio.sleep(0)
+        await mcp_client._complete_with_retries("a", [])
+        await holder
+
+    asyncio.run(main())
+    assert pool.stats["a"].latency < 0.1
+
+
+def test_streams_are_timed_until_they_open(monkeypatch):
+    pool = router("a")
+    monkeypatch.setattr(mcp_client, "llm_router", pool)
+    monkeypatch.setattr(mcp_client, "_semaphore", None)
+    fake = FakeModel()
+    monkeypatch.setattr(mcp_client, "get_async_client", lambda: fake)
+
+    async def main():
+        # a slow reader on our side says nothing about the model
+        async for _ in mcp_client.astream_ai_insights(SimpleNamespace()):
+            await asyncio.sleep(0.01)
+
+    monkeypatch.setattr(mcp_client, "build_prompt", lambda prompt, count: "prompt")
+    asyncio.run(main())
+    assert pool.stats["a"].latency < 0.05
+    assert pool.stats["a"].error_rate == 0
+
+
+def test_small_prompts_go_to_the_fastest_model():
+    pool = router("slow", "fast")
+    for _ in range(3):
+        pool.record("slow", 2.0)
+        pool.record("fast", 0.5)
+    assert pool.rank(10) == ["fast", "slow"]
+    # large prompts keep the configured order
+    assert pool.rank(1000) == ["slow", "fast"]
+
+
+def test_failing_models_are_tried_last():
+    pool = router("a", "b")
+    for _ in range(5):
+        pool.record("a", None)
+    assert pool.rank(1000) == ["b", "a"]
+
+
+def test_hedge_delay_follows_the_latency_quantile():
+    pool = router("a", hedge_min_delay=0.1, hedge_max_delay=5.0)
+    # not enough answers yet to go by
+    assert pool.hedge_delay("a") == 5.0
+    for latency in range(1, 21):
+        pool.record("a", latency / 10)
+    assert pool.hedge_delay("a") == pytest.approx(2.0)
+    for _ in range(100):
+        pool.record("a", 0.01)
+    assert pool.hedge_delay("a") == 0.1
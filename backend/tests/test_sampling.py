@@ -0,0 +1,66 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sampling import build_table_prompt, estimate_tokens, rank_sample_rows
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    rows = 5000
+    df = pd.DataFrame(
+        {
+            "region": rng.choice(["north", "south", "east", "west"], rows),
+            "sales": rng.normal(100, 10, rows).round(2),
+            "note": ["a fairly long free text remark " * 3] * rows,
+        }
+    )
+    df.loc[4321, "sales"] = 10_000  # the outlier
+    return df
+
+
+def sample_rows(prompt: str) -> pd.DataFrame:
+    rows = prompt.split("(the `row` column is the row number in the file):\n", 1)[1]
+    return pd.read_csv(io.StringIO(rows), index_col="row")
+
+
+@pytest.mark.parametrize("budget", [300, 1000, 4000])
+def test_prompt_fits_the_token_budget(table, budget):
+    prompt = build_table_prompt(table, token_budget=budget)
+    assert estimate_tokens(prompt) <= budget
+    # and the budget is used, rather than a fixed handful of rows
+    assert estimate_tokens(prompt) > budget * 0.8
+
+
+def test_more_budget_buys_more_rows(table):
+    small = sample_rows(build_table_prompt(table, token_budget=1000))
+    large = sample_rows(build_table_prompt(table, token_budget=4000))
+    assert len(large) > 2 * len(small)
+
+
+def test_sample_keeps_the_head_the_outlier_and_every_group(table):
+    rows = sample_rows(build_table_prompt(table, token_budget=1000))
+    assert {0, 1, 2, 4321} <= set(rows.index)
+    assert set(rows["region"]) == {"north", "south", "east", "west"}
+    # rows keep their position in the file
+    assert rows.loc[4321, "sales"] == 10_000
+
+
+def test_summary_covers_every_row(table):
+    prompt = build_table_prompt(table, token_budget=1000)
+    assert "The table has 5000 rows and 3 columns." in prompt
+    assert "max=1e+04" in prompt
+
+
+def test_wide_tables_are_cut_to_max_columns(table):
+    wide = pd.concat([table] + [table.add_suffix(f"_{n}") for n in range(5)], axis=1)
+    prompt = build_table_prompt(wide, token_budget=1000, max_columns=4)
+    assert "Only the first 4 columns are shown." in prompt
+    assert list(sample_rows(prompt).columns) == ["region", "sales", "note", "region_0"]
+
+
+def test_ranking_is_deterministic(table):
+    assert rank_sample_rows(table).equals(rank_sample_rows(table))
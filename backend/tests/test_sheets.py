@@ -0,0 +1,105 @@
+import io
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+from conftest import upload
+
+from readers import iter_frame_chunks, list_sheets, read_sheet
+
+
+def workbook_bytes() -> bytes:
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        pd.DataFrame({"region": ["north", "south", "east"], "sales": [10, 20, 30]}).to_excel(
+            writer, sheet_name="Sales", index=False
+        )
+        pd.DataFrame({"name": ["ann", "bob"], "team": ["a", "b"], "age": [30, 40]}).to_excel(
+            writer, sheet_name="People", index=False
+        )
+        writer.book.create_sheet("Empty")
+        writer.book["Empty"].sheet_state = "hidden"
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    path = tmp_path / "book.xlsx"
+    path.write_bytes(workbook_bytes())
+    return str(path)
+
+
+def test_sheets_are_listed_with_their_dimensions(workbook):
+    sheets = list_sheets(workbook)
+    assert [(s.index, s.name) for s in sheets] == [(0, "Sales"), (1, "People"), (2, "Empty")]
+    assert (sheets[0].row_count, sheets[0].column_count) == (3, 2)
+    assert (sheets[1].row_count, sheets[1].column_count) == (2, 3)
+    assert [s.hidden for s in sheets] == [False, False, True]
+
+
+def test_a_sheet_is_read_by_name_or_position(workbook):
+    by_name = read_sheet(workbook, "People")
+    assert list(by_name.columns) == ["name", "team", "age"]
+    assert by_name["name"].tolist() == ["ann", "bob"]
+    pd.testing.assert_frame_equal(read_sheet(workbook, 1), by_name)
+
+
+def test_only_the_columns_and_rows_asked_for_are_read(workbook):
+    df = read_sheet(workbook, "People", columns=["age", "name"], nrows=1)
+    assert df.to_dict("records") == [{"age": 30, "name": "ann"}]
+    assert df.attrs["total_columns"] == 3
+
+    df = read_sheet(workbook, "People", max_columns=1)
+    assert list(df.columns) == ["name"]
+
+    with pytest.raises(ValueError):
+        read_sheet(workbook, "People", columns=["salary"])
+
+
+def test_chunks_come_from_the_first_sheet_whichever_is_active(tmp_path):
+    book = Workbook()
+    first = book.active
+    first.title = "First"
+    first.append(["n"])
+    for n in range(5):
+        first.append([n])
+    second = book.create_sheet("Second")
+    second.append(["other"])
+    second.append(["x"])
+    # saved with the second sheet selected
+    book.active = 1
+    path = str(tmp_path / "active.xlsx")
+    book.save(path)
+
+    chunks = list(iter_frame_chunks(path, chunksize=2))
+    assert [list(chunk.columns) for chunk in chunks] == [["n"]] * 3
+    assert pd.concat(chunks)["n"].tolist() == list(range(5))
+
+
+def test_sheets_endpoint(client):
+    file_id = upload(client, workbook_bytes(), "book.xlsx")
+    response = client.get(f"/api/files/{file_id}/sheets")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["file_id"] == file_id
+    assert [sheet["name"] for sheet in body["sheets"]] == ["Sales", "People", "Empty"]
+
+
+def test_sheets_of_a_csv_are_a_bad_request(client):
+    file_id = upload(client, b"a,b\n1,2\n3,4\n")
+    assert client.get(f"/api/files/{file_id}/sheets").status_code == 400
+
+
+def test_sheets_of_an_unknown_file_are_not_found(client):
+    assert client.get(f"/api/files/{'0' * 32}/sheets").status_code == 404
+
+
+def test_processing_unknown_sheets_is_not_found(client, model):
+    file_id = upload(client, workbook_bytes(), "book.xlsx")
+    response = client.post(
+        "/api/process", json={"file_id": file_id, "sheets": ["Sales", "Costs"]}
+    )
+    assert response.status_code == 404
+    assert "Costs" in response.text
+    assert model.requests == []
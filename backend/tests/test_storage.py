@@ -0,0 +1,208 @@
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlmodel import Session, delete
+
+import storage
+from config.core import engine
+from conftest import upload
+from file_index import file_index
+from models import FileRecord, JobRecord
+from readers import parquet_cache_path
+from utils import (
+    MEDIA_DIR,
+    UPLOAD_DIR,
+    ContentDigest,
+    file_lock,
+    resolve_file_path,
+    store_staged_file,
+)
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    """Sweep with nothing turned on but what the test sets."""
+    for name in ("STORAGE_TTL", "STORAGE_MAX_BYTES", "STORAGE_COMPRESS_AFTER"):
+        monkeypatch.setattr(storage, name, 0)
+    monkeypatch.setattr(storage, "STORAGE_MIGRATE_FLAT_FILES", False)
+    return lambda **values: [monkeypatch.setattr(storage, k, v) for k, v in values.items()]
+
+
+def csv(rows: int = 20) -> bytes:
+    # unique content, so every test gets files of its own
+    tag = uuid.uuid4().hex
+    return b"tag,n\n" + b"".join(f"{tag},{n}\n".encode() for n in range(rows))
+
+
+def last_used(file_id: str, days_ago: float) -> FileRecord:
+    """Pretend the file was last looked up `days_ago` days ago."""
+    when = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    storage._update(file_id, accessed_at=when)
+    file_index._records.pop(file_id, None)
+    return record_of(file_id)
+
+
+def record_of(file_id: str):
+    with Session(engine, expire_on_commit=False) as session:
+        return session.get(FileRecord, file_id)
+
+
+def stage(content: bytes) -> str:
+    path = str(UPLOAD_DIR / f"{uuid.uuid4().hex}.part")
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def digest_of(content: bytes) -> ContentDigest:
+    digest = ContentDigest()
+    digest.update(content)
+    return digest
+
+
+def test_files_not_looked_up_within_the_ttl_are_removed(client, settings):
+    stale, fresh = upload(client, csv()), upload(client, csv())
+    record = last_used(stale, days_ago=30)
+    last_used(fresh, days_ago=1)
+    settings(STORAGE_TTL=7 * 24 * 3600)
+
+    stats = storage.sweep()
+    assert stats.expired >= 1 and stats.freed_bytes > 0
+    assert record_of(stale) is None and record_of(fresh) is not None
+    assert not os.path.exists(record.path)
+    assert not os.path.exists(parquet_cache_path(record.path))
+    assert client.get(f"/api/files/{stale}/profile").status_code == 404
+
+
+def test_least_recently_used_files_go_first_when_over_the_limit(client, settings):
+    oldest, older = upload(client, csv()), upload(client, csv())
+    last_used(oldest, days_ago=10000)
+    last_used(older, days_ago=9000)
+    total = storage.storage_stats().stored_bytes
+    settings(STORAGE_MAX_BYTES=total - 1)
+
+    assert storage.sweep().evicted == 1
+    assert record_of(oldest) is None and record_of(older) is not None
+
+
+def test_files_with_a_running_job_are_kept(client, settings):
+    file_id = upload(client, csv())
+    last_used(file_id, days_ago=30)
+    job_id = uuid.uuid4().hex
+    job = JobRecord(
+        id=job_id,
+        file_id=file_id,
+        status="running",
+        worker="elsewhere",
+        heartbeat_at=datetime.now(timezone.utc),
+        created_at=datetime.now(timezone.utc),
+        updated_at=datetime.now(timezone.utc),
+    )
+    with Session(engine) as session:
+        session.add(job)
+        session.commit()
+    settings(STORAGE_TTL=7 * 24 * 3600)
+    try:
+        storage.sweep()
+        assert record_of(file_id) is not None
+    finally:
+        with Session(engine) as session:
+            session.exec(delete(JobRecord).where(JobRecord.id == job_id))
+            session.commit()
+
+
+def test_a_file_uploaded_again_after_the_sweep_picked_it_is_kept(client):
+    content = csv()
+    file_id = upload(client, content)
+    # what the sweep read, before the same content comes in again
+    record = last_used(file_id, days_ago=30)
+
+    stored = store_staged_file(stage(content), "csv", digest_of(content))
+    assert stored.duplicate and stored.file_id == file_id
+
+    assert storage.remove_file(record) is None
+    assert os.path.exists(record.path) and record_of(file_id) is not None
+
+
+def test_a_file_removed_before_it_is_uploaded_again_is_stored_afresh(client):
+    content = csv()
+    file_id = upload(client, content)
+    record = last_used(file_id, days_ago=30)
+
+    assert storage.remove_file(record) > 0
+    assert upload(client, content) == file_id
+    assert os.path.exists(record_of(file_id).path)
+    assert client.get(f"/api/files/{file_id}/profile").status_code == 200
+
+
+def test_storing_waits_for_the_shard_lock(client):
+    content = csv()
+    file_id = upload(client, content)
+    path = record_of(file_id).path
+    staged = stage(content)
+    done = threading.Event()
+
+    def store():
+        store_staged_file(staged, "csv", digest_of(content))
+        done.set()
+
+    with file_lock(path):
+        thread = threading.Thread(target=store)
+        thread.start()
+        assert not done.wait(0.2)
+        assert os.path.exists(staged)
+    thread.join(5)
+    assert done.is_set() and not os.path.exists(staged)
+
+
+def test_without_zstd_nothing_is_compressed(client, settings, monkeypatch):
+    file_id = upload(client, csv())
+    last_used(file_id, days_ago=30)
+    settings(STORAGE_COMPRESS_AFTER=24 * 3600)
+    monkeypatch.setattr(storage, "_zstd", lambda: None)
+
+    assert storage.sweep().compressed == 0
+    assert not record_of(file_id).compressed
+
+
+@pytest.mark.skipif(
+    not storage.compression_available(), reason="zstandard isn't installed"
+)
+def test_cold_files_are_compressed_and_restored_on_lookup(client, settings):
+    content = csv(2000)
+    file_id = upload(client, content)
+    path = last_used(file_id, days_ago=30).path
+    settings(STORAGE_COMPRESS_AFTER=24 * 3600)
+
+    assert storage.sweep().compressed >= 1
+    record = record_of(file_id)
+    assert record.compressed and not os.path.exists(path)
+    assert os.path.exists(storage.compressed_path(path))
+    assert record.stored_size < record.size + os.path.getsize(parquet_cache_path(path))
+
+    assert file_index.require(file_id).path == path
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert not os.path.exists(storage.compressed_path(path))
+    assert not record_of(file_id).compressed
+
+
+def test_flat_files_are_moved_into_their_shard(client, settings):
+    file_id = upload(client, csv())
+    sharded = record_of(file_id).path
+    # where older versions kept it
+    flat = str(MEDIA_DIR / os.path.basename(sharded))
+    os.replace(sharded, flat)
+    os.replace(parquet_cache_path(sharded), parquet_cache_path(flat))
+    storage._update(file_id, path=flat)
+    file_index._records.pop(file_id, None)
+    settings(STORAGE_MIGRATE_FLAT_FILES=True)
+
+    assert storage.sweep().migrated >= 1
+    assert record_of(file_id).path == sharded == resolve_file_path(file_id, "csv")
+    assert os.path.exists(sharded) and os.path.exists(parquet_cache_path(sharded))
+    assert not os.path.exists(flat)
+    assert client.get(f"/api/files/{file_id}/profile").status_code == 200
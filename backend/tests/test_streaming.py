@@ -0,0 +1,86 @@
+import json
+
+from conftest import insights_json, upload
+
+from streaming import format_sse
+
+CSV = b"region,sales\nnorth,10\nsouth,20\neast,30\nwest,40\n"
+
+
+def events(response):
+    """The (event, data) pairs of a Server-Sent Events response."""
+    parsed = []
+    for block in response.text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        parsed.append((lines["event"], json.loads(lines["data"])))
+    return parsed
+
+
+def stream(client, file_id, **payload):
+    return client.post("/api/process/stream", json={"file_id": file_id, **payload})
+
+
+def test_format_sse():
+    assert format_sse("done", {"a": 1}) == 'event: done\ndata: {"a": 1}\n\n'
+
+
+def test_tokens_and_insights_are_streamed_then_done(client, model):
+    file_id = upload(client, CSV)
+    model.answer = insights_json("north leads", "west trails")
+
+    response = stream(client, file_id, mode="sample")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    sent = events(response)
+    kinds = [event for event, _ in sent]
+
+    assert kinds[:2] == ["status", "status"]
+    assert kinds[-1] == "done"
+    tokens = [data["text"] for event, data in sent if event == "token"]
+    assert "".join(tokens) == model.answer
+    insights = [data for event, data in sent if event == "insight"]
+    assert [item["index"] for item in insights] == [0, 1]
+    assert [item["insight"]["title"] for item in insights] == ["north leads", "west trails"]
+    # each insight is sent as soon as it is complete, before the answer ends
+    assert kinds.index("insight") < len(kinds) - 2 - kinds[::-1].index("token")
+
+    done = sent[-1][1]
+    assert done["file_id"] == file_id and not done["cached"]
+    assert [item["title"] for item in done["insights"]] == ["north leads", "west trails"]
+
+
+def test_stored_insights_are_replayed_without_the_model(client, model):
+    file_id = upload(client, CSV + b"north,50\n")
+    stream(client, file_id, mode="sample")
+    asked = len(model.requests)
+
+    sent = events(stream(client, file_id, mode="sample"))
+    assert len(model.requests) == asked
+    assert [event for event, _ in sent] == ["insight"] * 3 + ["done"]
+    assert sent[-1][1]["cached"]
+
+
+def test_model_failure_ends_the_stream_with_an_error_event(client, model):
+    file_id = upload(client, CSV + b"south,60\n")
+    model.answer = RuntimeError("upstream exploded")
+
+    response = stream(client, file_id, mode="sample")
+    assert response.status_code == 200
+    event, data = events(response)[-1]
+    assert event == "error"
+    assert data == {"detail": "Could not generate insights"}
+
+
+def test_unusable_answer_ends_the_stream_with_an_error_event(client, model):
+    file_id = upload(client, CSV + b"east,70\n")
+    model.answer = "I'd rather not."
+
+    sent = events(stream(client, file_id, mode="sample"))
+    assert "insight" not in [event for event, _ in sent]
+    assert sent[-1] == ("error", {"detail": "Could not generate insights"})
+
+
+def test_unknown_file_fails_before_the_stream_opens(client, model):
+    response = stream(client, "0" * 32)
+    assert response.status_code == 404
+    assert model.requests == []
@@ -0,0 +1,109 @@
+import zipfile
+from xml.etree import ElementTree
+
+import pytest
+
+import readers
+from readers import iter_docx_paragraphs, read_text_lines
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+
+def paragraph(text: str) -> str:
+    return f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>"
+
+
+def write_docx(path, body: str) -> str:
+    document = f'<w:document xmlns:w="{W}"><w:body>{body}'
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("word/document.xml", document)
+    return str(path)
+
+
+@pytest.fixture
+def docx(tmp_path):
+    body = "".join(paragraph(f"para {n}") for n in range(200)) + "</w:body></w:document>"
+    return write_docx(tmp_path / "doc.docx", body)
+
+
+@pytest.fixture
+def text_file(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("".join(f"line {n}\n" for n in range(1000)))
+    return str(path)
+
+
+def test_first_lines_of_a_text_file(text_file):
+    assert read_text_lines(text_file, 3) == ["line 0\n", "line 1\n", "line 2\n"]
+
+
+def test_first_paragraphs_of_a_document(docx):
+    assert read_text_lines(docx, 3) == ["para 0", "para 1", "para 2"]
+
+
+def test_reading_stops_after_the_paragraphs_asked_for(tmp_path):
+    # everything past the fifth paragraph is garbage: only a reader that
+    # stops early gets away with that
+    body = "".join(paragraph(f"para {n}") for n in range(5)) + "<<< not xml"
+    path = write_docx(tmp_path / "truncated.docx", body)
+
+    assert read_text_lines(path, 5) == [f"para {n}" for n in range(5)]
+    with pytest.raises(ElementTree.ParseError):
+        read_text_lines(path, 6)
+
+
+def test_paragraphs_in_tables_and_empty_ones(tmp_path):
+    body = (
+        paragraph("before")
+        + "<w:p/>"
+        + f"<w:tbl><w:tr><w:tc>{paragraph('cell')}</w:tc></w:tr></w:tbl>"
+        + paragraph("after")
+        + "</w:body></w:document>"
+    )
+    path = write_docx(tmp_path / "table.docx", body)
+    assert list(iter_docx_paragraphs(path)) == ["before", "cell", "after"]
+
+
+def test_finished_paragraphs_are_detached(tmp_path, monkeypatch):
+    body = "".join(paragraph(f"para {n}") for n in range(20_000))
+    path = write_docx(tmp_path / "long.docx", body + "</w:body></w:document>")
+    roots = []
+    iterparse = ElementTree.iterparse
+
+    def capture(source, events):
+        # parse with start events too, to catch the root element first
+        for event, element in iterparse(source, ("start", "end")):
+            if not roots:
+                roots.append(element)
+            if event in events:
+                yield event, element
+
+    monkeypatch.setattr(readers.ElementTree, "iterparse", capture)
+    paragraphs = iter_docx_paragraphs(path)
+    for _ in range(15_000):
+        next(paragraphs)
+    # what's left of the tree is what the parser has read ahead, not an
+    # element for every paragraph read so far
+    assert len(list(roots[0].iter())) < 2_000
+
+
+def test_sampled_lines_are_spread_over_a_text_file(text_file):
+    lines = read_text_lines(text_file, 10, sample=True)
+    numbers = [int(line.split()[1]) for line in lines]
+    assert len(numbers) == 10 and numbers == sorted(numbers)
+    assert numbers[0] == 0 and numbers[-1] >= 850
+
+
+def test_sampled_paragraphs_are_spread_over_a_document(docx):
+    paragraphs = read_text_lines(docx, 10, sample=True)
+    numbers = [int(text.split()[1]) for text in paragraphs]
+    assert len(numbers) == 10 and numbers == sorted(numbers)
+    assert numbers[-1] > 100
+    # the same sample every time
+    assert read_text_lines(docx, 10, sample=True) == paragraphs
+
+
+def test_sampling_a_short_file_returns_every_line(tmp_path):
+    path = tmp_path / "short.txt"
+    path.write_text("a\nb\nc\n")
+    assert read_text_lines(str(path), 10, sample=True) == ["a\n", "b\n", "c\n"]
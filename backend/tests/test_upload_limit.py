@@ -0,0 +1,69 @@
+import pytest
+
+from utils import UploadSizeLimitMiddleware
+
+BOUNDARY = "limit-test"
+ORIGIN = {"Origin": "http://app.example"}
+
+
+@pytest.fixture
+def limit(client):
+    """Shrink the upload limit of the running app to 1 KB."""
+    client.get("/")  # the middleware stack is built on the first request
+    layer = client.app.middleware_stack
+    while not isinstance(layer, UploadSizeLimitMiddleware):
+        layer = layer.app
+    saved, layer.limit = layer.limit, 1024
+    yield layer.limit
+    layer.limit = saved
+
+
+def form(size: int) -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="big.csv"\r\n'
+        "Content-Type: text/csv\r\n\r\n"
+    ).encode() + b"a,b\n" + b"1,2\n" * (size // 4) + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def post(client, body, **headers):
+    return client.post(
+        "/api/upload",
+        content=body,
+        headers={
+            "Content-Type": f"multipart/form-data; boundary={BOUNDARY}",
+            **ORIGIN,
+            **headers,
+        },
+    )
+
+
+def test_declared_size_over_the_limit_is_refused_up_front(client, limit):
+    response = post(client, form(4 * limit))
+    assert response.status_code == 413
+    assert "detail" in response.json()
+    # the answer comes from inside CORS, so browsers get to read it
+    assert response.headers["access-control-allow-origin"] == ORIGIN["Origin"]
+
+
+def test_streamed_body_over_the_limit_is_refused(client, limit):
+    body = form(4 * limit)
+
+    def chunks():
+        for start in range(0, len(body), 256):
+            yield body[start : start + 256]
+
+    response = post(client, chunks())
+    assert response.status_code == 413
+    assert "detail" in response.json()
+    assert response.headers["access-control-allow-origin"] == ORIGIN["Origin"]
+
+
+def test_uploads_under_the_limit_pass(client, limit):
+    response = post(client, form(limit // 2))
+    assert response.status_code == 200, response.text
+
+
+def test_other_paths_are_not_limited(client, limit):
+    response = client.post("/api/process", json={"file_id": "x" * (4 * limit)})
+    assert response.status_code != 413
@@ -0,0 +1,261 @@
+import asyncio
+import hashlib
+import os
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import uploads
+from exceptions import (
+    FileTooLargeException,
+    InvalidUploadPartException,
+    UploadIncompleteException,
+    UploadNotFoundException,
+)
+
+PART_SIZE = uploads.MIN_PART_SIZE
+CONTENT = b"a,b\n" + b"".join(f"{i},{i * 2}\n".encode() for i in range(30000))
+
+
+def parts(content=CONTENT, size=PART_SIZE):
+    return [content[i : i + size] for i in range(0, len(content), size)]
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+async def body(data, pieces=3):
+    # the part arrives in several pieces, like a streamed request body
+    step = -(-len(data) // pieces)
+    for i in range(0, len(data), step):
+        yield data[i : i + step]
+
+
+def send(upload_id, number, data, checksum=None):
+    return asyncio.run(
+        uploads.write_part(upload_id, number, body(data), checksum or sha256(data))
+    )
+
+
+def start(content=CONTENT):
+    return uploads.create_upload("data.csv", len(content), PART_SIZE)
+
+
+def test_parts_sent_out_of_order_assemble_the_file():
+    upload = start()
+    chunks = parts()
+    assert uploads.part_count(upload) == len(chunks) > 2
+    for number in reversed(range(1, len(chunks) + 1)):
+        send(upload.id, number, chunks[number - 1])
+    _, received = uploads.get_upload(upload.id)
+    assert received == list(range(1, len(chunks) + 1))
+
+    stored = uploads.complete_upload(upload.id)
+    assert stored.sha256 == sha256(CONTENT)
+    with open(stored.path, "rb") as f:
+        assert f.read() == CONTENT
+    # the upload is gone once completed
+    assert not os.path.exists(uploads._upload_path(upload.id))
+    with pytest.raises(UploadNotFoundException):
+        uploads.get_upload(upload.id)
+
+
+def test_parts_sent_in_parallel():
+    upload = start()
+    chunks = parts()
+
+    async def send_all():
+        await asyncio.gather(
+            *(
+                uploads.write_part(upload.id, number, body(chunk), sha256(chunk))
+                for number, chunk in enumerate(chunks, 1)
+            )
+        )
+
+    asyncio.run(send_all())
+    assert uploads.complete_upload(upload.id).sha256 == sha256(CONTENT)
+
+
+def test_completed_upload_matches_a_single_shot_upload_of_the_same_content():
+    first, second = start(), start()
+    for upload in (first, second):
+        for number, chunk in enumerate(parts(), 1):
+            send(upload.id, number, chunk)
+    stored = uploads.complete_upload(first.id)
+    again = uploads.complete_upload(second.id)
+    assert again.file_id == stored.file_id and again.duplicate
+
+
+def test_checksum_mismatch_is_rejected_and_the_part_can_be_sent_again():
+    upload = start()
+    chunk = parts()[0]
+    with pytest.raises(InvalidUploadPartException, match="Checksum mismatch"):
+        send(upload.id, 1, chunk, checksum=sha256(b"something else"))
+    assert uploads.get_upload(upload.id)[1] == []
+    send(upload.id, 1, chunk)
+    assert uploads.get_upload(upload.id)[1] == [1]
+
+
+def test_part_of_the_wrong_size_is_rejected():
+    upload = start()
+    chunk = parts()[0]
+    with pytest.raises(InvalidUploadPartException):
+        send(upload.id, 1, chunk[:-1])
+    with pytest.raises(InvalidUploadPartException):
+        send(upload.id, 1, chunk + b"x")
+
+
+def test_part_number_out_of_range_is_rejected():
+    upload = start()
+    with pytest.raises(InvalidUploadPartException):
+        send(upload.id, 0, b"x")
+    with pytest.raises(InvalidUploadPartException):
+        send(upload.id, uploads.part_count(upload) + 1, b"x")
+
+
+def test_completing_with_parts_missing_lists_them():
+    upload = start()
+    chunks = parts()
+    send(upload.id, 2, chunks[1])
+    with pytest.raises(UploadIncompleteException) as error:
+        uploads.complete_upload(upload.id)
+    missing = [n for n in range(1, len(chunks) + 1) if n != 2]
+    assert error.value.detail.endswith(", ".join(map(str, missing)))
+    # the upload carries on taking parts
+    for number, chunk in enumerate(chunks, 1):
+        send(upload.id, number, chunk)
+    assert uploads.complete_upload(upload.id).sha256 == sha256(CONTENT)
+
+
+def test_completing_waits_for_parts_being_written():
+    upload = start()
+    chunks = parts()
+    for number, chunk in enumerate(chunks[1:], 2):
+        send(upload.id, number, chunk)
+
+    async def main():
+        arrived = asyncio.Event()
+        resume = asyncio.Event()
+
+        async def slow_body():
+            yield chunks[0][:10]
+            arrived.set()
+            await resume.wait()
+            yield chunks[0][10:]
+
+        writing = asyncio.create_task(
+            uploads.write_part(upload.id, 1, slow_body(), sha256(chunks[0]))
+        )
+        await arrived.wait()
+        with pytest.raises(HTTPException) as error:
+            uploads.complete_upload(upload.id)
+        assert error.value.status_code == 409
+        resume.set()
+        await writing
+
+    asyncio.run(main())
+    assert uploads.complete_upload(upload.id).sha256 == sha256(CONTENT)
+
+
+def test_parts_are_rejected_once_the_upload_is_being_completed():
+    upload = start()
+    assert uploads._claim(upload.id)
+    with pytest.raises(HTTPException) as error:
+        send(upload.id, 1, parts()[0])
+    assert error.value.status_code == 409
+    # only one request gets to complete it
+    assert not uploads._claim(upload.id)
+
+
+def test_oversized_upload_is_refused_up_front(monkeypatch):
+    monkeypatch.setattr(uploads, "MAX_UPLOAD_SIZE", 1024)
+    with pytest.raises(FileTooLargeException):
+        uploads.create_upload("big.csv", 2048, PART_SIZE)
+
+
+def test_aborted_upload_is_dropped():
+    upload = start()
+    send(upload.id, 1, parts()[0])
+    uploads.abort_upload(upload.id)
+    assert not os.path.exists(uploads._upload_path(upload.id))
+    with pytest.raises(UploadNotFoundException):
+        uploads.get_upload(upload.id)
+
+
+def test_a_crashed_writer_only_holds_off_completion_until_its_lease_lapses(monkeypatch):
+    upload = start()
+    for number, chunk in enumerate(parts(), 1):
+        send(upload.id, number, chunk)
+    # a writer that died mid-part never gives its lease back
+    assert uploads._start_writing(upload.id, 1)
+    with pytest.raises(HTTPException) as error:
+        uploads.complete_upload(upload.id)
+    assert error.value.status_code == 409
+
+    monkeypatch.setattr(uploads, "UPLOAD_WRITE_LEASE_SECONDS", 0.05)
+    time.sleep(0.1)
+    assert uploads.complete_upload(upload.id).sha256 == sha256(CONTENT)
+
+
+def test_a_slow_part_keeps_its_lease(monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_WRITE_LEASE_SECONDS", 0.3)
+    monkeypatch.setattr(uploads, "UPLOAD_CHUNK_SIZE", 1024)
+    upload = start()
+    chunks = parts()
+    for number, chunk in enumerate(chunks[1:], 2):
+        send(upload.id, number, chunk)
+
+    async def main():
+        async def slow_body():
+            # longer in all than the lease, but never silent for that long
+            for i in range(0, len(chunks[0]), 8192):
+                await asyncio.sleep(0.05)
+                yield chunks[0][i : i + 8192]
+
+        writing = asyncio.create_task(
+            uploads.write_part(upload.id, 1, slow_body(), sha256(chunks[0]))
+        )
+        while not writing.done():
+            await asyncio.sleep(0.05)
+            if not writing.done():
+                assert not uploads._claim(upload.id)
+        await writing
+
+    asyncio.run(main())
+    assert uploads.complete_upload(upload.id).sha256 == sha256(CONTENT)
+
+
+def test_a_writer_whose_lease_lapsed_writes_nothing_once_the_upload_completes(monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_WRITE_LEASE_SECONDS", 0.05)
+    upload = start()
+    chunks = parts()
+    for number, chunk in enumerate(chunks, 1):
+        send(upload.id, number, chunk)
+
+    async def main():
+        arrived = asyncio.Event()
+        resume = asyncio.Event()
+
+        async def stalled_body():
+            yield chunks[0][:10]
+            arrived.set()
+            await resume.wait()
+            yield chunks[0][10:]
+
+        writing = asyncio.create_task(
+            uploads.write_part(upload.id, 1, stalled_body(), sha256(chunks[0]))
+        )
+        await arrived.wait()
+        await asyncio.sleep(0.1)
+        stored = uploads.complete_upload(upload.id)
+        resume.set()
+        with pytest.raises(HTTPException) as error:
+            await writing
+        assert error.value.status_code == 409
+        return stored
+
+    stored = asyncio.run(main())
+    with open(stored.path, "rb") as f:
+        assert f.read() == CONTENT
@@ -43,6 +43,8 @@ class ApiService {
     }
   }
 
+  static const Duration jobPollInterval = Duration(seconds: 2);
+
   static Future<List<dynamic>> processInsights(String fileId) async {
     final uri = Uri.parse('$baseUrl/process');
     debugPrint('[ApiService] Sending process request for fileId: $fileId to $uri');
@@ -57,18 +59,38 @@ class ApiService {
       debugPrint('[ApiService] Process response status: ${response.statusCode}');
       debugPrint('[ApiService] Process response body: ${response.body}');
 
-    // we want to check for succecessful response codes, we return 201 on the backend, but well ideally that was menat to be 200
-      if (response.statusCode == 200 || response.statusCode == 201) {
-        return jsonDecode(response.body)['insights'];
-      } else {
+      // processing runs as a job on the backend: we get the job back straight
+      // away (202), and poll it until the insights are ready
+      if (response.statusCode != 200 && response.statusCode != 202) {
         throw Exception('Failed to process insights (Status: ${response.statusCode})');
       }
+
+      var job = jsonDecode(response.body);
+      while (job['status'] == 'queued' || job['status'] == 'running') {
+        await Future.delayed(jobPollInterval);
+        job = await fetchJob(job['job_id']);
+      }
+
+      if (job['status'] != 'succeeded') {
+        throw Exception('Failed to process insights (${job['status']}: ${job['error']})');
+      }
+      return job['insights'];
     } catch (e) {
       debugPrint('[ApiService] Error during processInsights: $e');
       rethrow;
     }
   }
 
+  static Future<Map<String, dynamic>> fetchJob(String jobId) async {
+    final response = await http.get(Uri.parse('$baseUrl/jobs/$jobId'));
+    debugPrint('[ApiService] Job $jobId status: ${response.statusCode}');
+
+    if (response.statusCode != 200) {
+      throw Exception('Failed to fetch job (Status: ${response.statusCode})');
+    }
+    return jsonDecode(response.body);
+  }
+
   static Future<List<dynamic>> fetchInsightsByFileId(String fileId) async {
     final uri = Uri.parse('$baseUrl/insights?file_id=$fileId');
     debugPrint('[ApiService] Fetching insights for fileId: $fileId from $uri');